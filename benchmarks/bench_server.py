@@ -0,0 +1,253 @@
+#!/usr/bin/python
+"""
+End to end benchmark of the repository server (standalone.py) against a local fake GitHub server.
+
+For each catalog size (and max_threads value), a fresh server is started and driven by concurrent
+simulated Kodi clients, measuring:
+
+- cold: the first /addons.xml request, which fetches every add-on from (fake) GitHub
+- addons.xml: warm /addons.xml requests (gzip, as Kodi does) and /addons.xml.md5 checks
+- assets: add-on icons and zips, downloaded once from GitHub and then served from cache
+
+Usage: python -m benchmarks.bench_server [--entries N [N ...]] [--max-threads N [N ...]] [--clients N] [--graphql]
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from httplib import HTTPConnection
+except ImportError:
+    from http.client import HTTPConnection
+
+from benchmarks.fake_github import start_server
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(sorted_values, p):
+    """
+    Get the ``p`` percentile (nearest-rank) of a sorted list.
+    """
+    if not sorted_values:
+        return float("nan")
+    index = max(0, int(round(p / 100.0 * len(sorted_values) + 0.5)) - 1)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def make_entries(count, path):
+    with open(path, "w") as f:
+        json.dump([{"id": "plugin.video.bench{}".format(i), "username": "bench",
+                    "assets": {"icon.png": "icon.png"}} for i in range(count)], f)
+
+
+def free_port():
+    s = socket.socket()
+    try:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+    finally:
+        s.close()
+
+
+def wait_for_port(port, process, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("Server exited with code {}".format(process.returncode))
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except socket.error:
+            time.sleep(0.05)
+    raise RuntimeError("Server did not start listening on port {}".format(port))
+
+
+def peak_rss(pid):
+    """
+    Get the peak resident set size (in bytes) of process ``pid``, or None if not available (only on Linux).
+    """
+    try:
+        with open("/proc/{}/status".format(pid)) as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+class Client(object):
+    """
+    Simulated Kodi client, using a keep-alive connection.
+    """
+
+    def __init__(self, port):
+        self._port = port
+        self._connection = None
+
+    def get(self, path, headers=None):
+        """
+        Do a GET request, returning (status, body size, latency in seconds).
+        """
+        start = time.time()
+        for attempt in range(2):
+            if self._connection is None:
+                self._connection = HTTPConnection("127.0.0.1", self._port, timeout=120)
+            try:
+                self._connection.request("GET", path, headers=headers or {})
+                response = self._connection.getresponse()
+                size = len(response.read())
+                if response.getheader("Connection", "").lower() == "close":
+                    self.close()
+                return response.status, size, time.time() - start
+            except (socket.error, IOError):
+                # The server may close idle keep-alive connections
+                self.close()
+                if attempt:
+                    raise
+        raise RuntimeError("Unreachable")
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+class Result(object):
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.bytes = 0
+        self.errors = 0
+        self.elapsed = 0
+        self._lock = threading.Lock()
+
+    def add(self, status, size, latency):
+        with self._lock:
+            self.latencies.append(latency)
+            self.bytes += size
+            if status >= 400:
+                self.errors += 1
+
+    def report(self):
+        latencies = sorted(self.latencies)
+        return "{:<12} {:>6} req {:>9.1f} req/s {:>8.2f} MB/s  p50 {:>8.2f}ms  p95 {:>8.2f}ms  p99 {:>8.2f}ms{}".format(
+            self.name, len(latencies), len(latencies) / self.elapsed if self.elapsed else 0,
+            self.bytes / self.elapsed / 1024 / 1024 if self.elapsed else 0,
+            percentile(latencies, 50) * 1000, percentile(latencies, 95) * 1000, percentile(latencies, 99) * 1000,
+            "  ({} errors)".format(self.errors) if self.errors else "")
+
+
+def run_clients(name, port, clients, requests, make_request):
+    """
+    Run ``clients`` concurrent clients, each doing ``requests`` requests of ``make_request(rng) -> (path, headers)``.
+    """
+    result = Result(name)
+
+    def worker(index):
+        client = Client(port)
+        rng = random.Random(index)
+        try:
+            for _ in range(requests):
+                result.add(*client.get(*make_request(rng)))
+        finally:
+            client.close()
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(clients)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    result.elapsed = time.time() - start
+    return result
+
+
+def run(entries, max_threads, clients=10, requests=50, engine="threaded", fetch_strategy="api",
+        graphql=False, latency=0.05, asset_size=16 * 1024, zip_size=256 * 1024):
+    github = start_server(latency=latency, asset_size=asset_size, zip_size=zip_size)
+    work_dir = tempfile.mkdtemp(prefix="bench-server-")
+    entries_path = os.path.join(work_dir, "repository.json")
+    make_entries(entries, entries_path)
+    port = free_port()
+    # GraphQL requires a token (any token is accepted by the fake server)
+    graphql_args = ["--graphql", "--token", "bench"] if graphql else []
+    process = subprocess.Popen([
+        sys.executable, os.path.join(ROOT_PATH, "standalone.py"), "--port", str(port), "--host", "127.0.0.1",
+        "--engine", engine, "--fetch-strategy", fetch_strategy, "--files", entries_path,
+        "--api-url", github.url, "--raw-url", github.url, "--codeload-url", github.url,
+        "--max-threads", str(max_threads), "--cache-dir", os.path.join(work_dir, "cache"), "--log-level", "WARNING",
+    ] + graphql_args, cwd=ROOT_PATH)
+
+    try:
+        wait_for_port(port, process)
+        addon_ids = ["plugin.video.bench{}".format(i) for i in range(entries)]
+        version = "1.0.{}".format(github.tags - 1)
+
+        client = Client(port)
+        status, size, cold_latency = client.get("/addons.xml")
+        client.close()
+        if status != 200:
+            raise RuntimeError("Unexpected status {} for /addons.xml".format(status))
+        upstream_requests = github.requests
+
+        results = [
+            run_clients("addons.xml", port, clients, requests,
+                        lambda rng: ("/addons.xml", {"Accept-Encoding": "gzip"})),
+            run_clients("md5", port, clients, requests, lambda rng: ("/addons.xml.md5", None)),
+            run_clients("icon.png", port, clients, requests,
+                        lambda rng: ("/{}/icon.png".format(rng.choice(addon_ids)), None)),
+            run_clients("zip", port, clients, max(1, requests // 5),
+                        lambda rng: ("/{0}/{0}-{1}.zip".format(rng.choice(addon_ids), version), None)),
+        ]
+        rss = peak_rss(process.pid)
+    finally:
+        process.terminate()
+        process.wait()
+        github.shutdown()
+        github.server_close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print("entries={} max_threads={} engine={} fetch_strategy={} graphql={}".format(
+        entries, max_threads, engine, fetch_strategy, graphql))
+    print("  {:<12} {:>8.1f}ms ({} upstream requests)".format("cold", cold_latency * 1000, upstream_requests))
+    for result in results:
+        print("  " + result.report())
+    print("  {:<12} {}".format("peak RSS", "{:.1f} MB".format(rss / 1024.0 / 1024) if rss else "n/a"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the repository server against a fake GitHub server")
+    parser.add_argument("--entries", type=int, nargs="+", default=[10, 100, 500, 2000],
+                        help="Catalog sizes (number of add-ons)")
+    parser.add_argument("--max-threads", type=int, nargs="+", default=[5],
+                        help="Repository max_threads values")
+    parser.add_argument("--clients", type=int, default=10, help="Number of concurrent clients")
+    parser.add_argument("--requests", type=int, default=50, help="Number of requests per client and scenario")
+    parser.add_argument("--engine", choices=("threaded", "asyncio"), default="threaded", help="Server engine")
+    parser.add_argument("--fetch-strategy", choices=("api", "cdn", "cdn_fallback"), default="api",
+                        help="Repository fetch strategy")
+    parser.add_argument("--graphql", action="store_true", help="Batch add-ons metadata requests using GraphQL")
+    parser.add_argument("--latency", type=float, default=0.05, help="Fake GitHub latency, in seconds")
+    parser.add_argument("--asset-size", type=int, default=16 * 1024, help="Size of each asset, in bytes")
+    parser.add_argument("--zip-size", type=int, default=256 * 1024, help="Size of each zipball payload, in bytes")
+    args = parser.parse_args()
+    for entries in args.entries:
+        for max_threads in args.max_threads:
+            run(entries, max_threads, clients=args.clients, requests=args.requests, engine=args.engine,
+                fetch_strategy=args.fetch_strategy, graphql=args.graphql, latency=args.latency,
+                asset_size=args.asset_size, zip_size=args.zip_size)
+
+
+if __name__ == "__main__":
+    main()
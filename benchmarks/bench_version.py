@@ -0,0 +1,87 @@
+#!/usr/bin/python
+"""
+Parse and compare throughput of lib.version on realistic tag corpora.
+
+Usage: python -m benchmarks.bench_version [--tags N] [--repeat N]
+"""
+
+import argparse
+import random
+import timeit
+
+from lib.version import Version, DebianVersion, try_parse_version
+
+
+def make_tags(count, seed=0):
+    """
+    Generate tag names as found on add-on repositories: plain/prefixed releases,
+    pre-releases, build metadata and some names which are not versions at all.
+    """
+    rng = random.Random(seed)
+    formats = (
+        "{}.{}.{}", "v{}.{}.{}", "{}.{}.{}-beta{}", "v{}.{}.{}-rc.{}", "{}.{}.{}+build{}", "{}.{}", "v{}.{}.{}.{}")
+    tags = []
+    for _ in range(count):
+        if rng.random() < 0.05:
+            tags.append("nightly-{}".format(rng.randint(0, 10000)))
+        else:
+            tags.append(rng.choice(formats).format(*(rng.randint(0, 20) for _ in range(4))))
+    return tags
+
+
+def make_debian_versions(count, seed=0):
+    rng = random.Random(seed)
+    formats = ("{}.{}.{}", "{}.{}.{}~rc{}", "{}:{}.{}-{}", "{}.{}+dfsg{}")
+    return [rng.choice(formats).format(*(rng.randint(0, 20) for _ in range(4))) for _ in range(count)]
+
+
+def _report(name, count, times):
+    best = min(times)
+    print("{:<32} {:>10.0f} ops/s  (best of {}: {:.4f}s for {} ops)".format(
+        name, count / best, len(times), best, count))
+
+
+def run(tags_count=10000, repeat=5):
+    tags = make_tags(tags_count)
+    debian_versions = make_debian_versions(tags_count)
+
+    def parse_uncached():
+        for tag in tags:
+            try:
+                Version(tag)
+            except ValueError:
+                pass
+
+    def parse_cached():
+        for tag in tags:
+            try_parse_version(tag)
+
+    def parse_debian():
+        for version in debian_versions:
+            DebianVersion(version)
+
+    versions = [v for v in (try_parse_version(t) for t in tags) if v is not None]
+    parsed_debian_versions = [DebianVersion(v) for v in debian_versions]
+
+    benchmarks = (
+        ("Version (uncached)", len(tags), parse_uncached),
+        ("try_parse_version (cached)", len(tags), parse_cached),
+        ("DebianVersion", len(debian_versions), parse_debian),
+        ("sort Version", len(versions), lambda: sorted(versions)),
+        ("sort DebianVersion", len(parsed_debian_versions), lambda: sorted(parsed_debian_versions)),
+        ("hash Version (set)", len(versions), lambda: set(versions)),
+    )
+    for name, count, func in benchmarks:
+        _report(name, count, timeit.repeat(func, number=1, repeat=repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark version parsing and comparison")
+    parser.add_argument("--tags", type=int, default=10000, help="Number of tags on the corpus")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of repetitions")
+    args = parser.parse_args()
+    run(args.tags, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+#!/usr/bin/python
+"""
+Local fake of the GitHub endpoints used by the repository (REST and GraphQL APIs, raw contents and
+archives), with configurable latency and payload sizes.
+
+Every repository of every user exists, with ``tags`` tags ("v1.0.0" up to "v1.0.{tags - 1}"), the last
+one being the latest release. Contents and archives are deterministic, so ETags are stable across runs.
+
+Usage: python -m benchmarks.fake_github [--port N] [--latency S] [--asset-size N] [--zip-size N]
+"""
+
+import argparse
+import io
+import json
+import re
+import threading
+import time
+import zipfile
+from hashlib import md5
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+ADDON_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<addon id="{id}" name="{id}" version="{version}" provider-name="bench">\n'
+    '  <requires><import addon="xbmc.python" version="3.0.0"/></requires>\n'
+    '  <extension point="xbmc.python.pluginsource" library="main.py"><provides>video</provides></extension>\n'
+    '  <extension point="xbmc.addon.metadata">\n'
+    '    <summary lang="en_GB">Benchmark add-on {id}</summary>\n'
+    '    <assets><icon>icon.png</icon></assets>\n'
+    '  </extension>\n'
+    '</addon>\n')
+
+_api_re = re.compile(r"^/repos/([^/]+)/([^/]+)(/.*)?$")
+_codeload_re = re.compile(r"^/([^/]+)/([^/]+)/zip/(.+)$")
+_raw_re = re.compile(r"^/([^/]+)/([^/]+)/([^/]+)/(.+)$")
+_graphql_alias_re = re.compile(r"\b(r\d+): repository\(")
+
+
+class FakeGitHubHandler(BaseHTTPRequestHandler, object):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, fmt, *args):
+        pass
+
+    # noinspection PyPep8Naming
+    def do_GET(self):
+        self.server.count_request()
+        time.sleep(self.server.latency)
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+
+        match = _api_re.match(url.path)
+        if match:
+            user, repo, path = match.groups()
+            return self._handle_api(repo, path or "", query)
+        match = _codeload_re.match(url.path)
+        if match:
+            return self._send_zip(match.group(2), match.group(3))
+        match = _raw_re.match(url.path)
+        if match:
+            return self._send_contents(match.group(2), match.group(4), match.group(3))
+        self._send(404)
+
+    do_HEAD = do_GET
+
+    # noinspection PyPep8Naming
+    def do_POST(self):
+        self.server.count_request()
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.server.latency)
+        if urlparse(self.path).path != "/graphql":
+            return self._send(404)
+        self._handle_graphql(json.loads(body.decode("utf-8")))
+
+    def _handle_graphql(self, request):
+        # Answers the batched queries of GitHubGraphQLApi.get_repositories_metadata (aliases "r0", "r1", ...)
+        tags = self.server.tag_names()
+        variables = request.get("variables") or {}
+        data = {}
+        for alias in _graphql_alias_re.findall(request["query"]):
+            data[alias] = {
+                "defaultBranchRef": {"name": "main"},
+                "latestRelease": {"tagName": tags[-1]} if tags else None,
+                "refs": {"nodes": [{"name": t} for t in reversed(tags)], "pageInfo": {"hasNextPage": False}},
+            } if "n" + alias[1:] in variables else None
+        body = json.dumps({"data": data}).encode("utf-8")
+        self._send(200, body, {"Content-Type": "application/json"})
+
+    def _handle_api(self, repo, path, query):
+        tags = self.server.tag_names()
+        if path == "":
+            return self._send_json({"name": repo, "default_branch": "main"})
+        elif path == "/releases/latest":
+            return self._send_json({"tag_name": tags[-1], "assets": []}) if tags else self._send(404)
+        elif path.startswith("/releases/tags/"):
+            tag = path[len("/releases/tags/"):]
+            return self._send_json({"tag_name": tag, "assets": []}) if tag in tags else self._send(404)
+        elif path == "/git/refs/tags":
+            return self._send_json([self._tag_ref(repo, t) for t in tags])
+        elif path.startswith("/git/matching-refs/tags/"):
+            prefix = path[len("/git/matching-refs/tags/"):]
+            return self._send_json([self._tag_ref(repo, t) for t in tags if t.startswith(prefix)])
+        elif path.startswith("/contents/"):
+            return self._send_contents(repo, path[len("/contents/"):], query.get("ref", ["main"])[0])
+        elif path.startswith("/zipball"):
+            return self._send_zip(repo, path[len("/zipball/"):] or "main")
+        self._send(404)
+
+    @staticmethod
+    def _tag_ref(repo, tag):
+        return {"ref": "refs/tags/" + tag, "object": {"sha": md5((repo + tag).encode("utf-8")).hexdigest()}}
+
+    def _send_contents(self, repo, path, ref):
+        if path == "addon.xml":
+            version = ref[1:] if ref.startswith("v") else "0.0.1"
+            body = ADDON_XML.format(id=repo, version=version).encode("utf-8")
+        else:
+            body = self.server.asset_payload
+        self._send_cacheable(body, "application/octet-stream", etag=md5(body).hexdigest())
+
+    def _send_zip(self, repo, ref):
+        body = self.server.zipball(repo, ref)
+        self._send_cacheable(body, "application/zip", etag=md5(body).hexdigest())
+
+    def _send_cacheable(self, body, content_type, etag):
+        etag = '"{}"'.format(etag)
+        if self.headers.get("If-None-Match") == etag:
+            return self._send(304, headers={"ETag": etag})
+        self._send(200, body, {"Content-Type": content_type, "ETag": etag})
+
+    def _send_json(self, data):
+        body = json.dumps(data).encode("utf-8")
+        self._send_cacheable(body, "application/json", etag=md5(body).hexdigest())
+
+    def _send(self, code, body=b"", headers=None):
+        self.send_response(code)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-RateLimit-Limit", "1000000")
+        self.send_header("X-RateLimit-Remaining", "1000000")
+        self.send_header("X-RateLimit-Reset", str(int(time.time()) + 3600))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+
+class FakeGitHubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # Many concurrent connections are expected (up to max_threads, plus downloads)
+    request_queue_size = 128
+
+    def __init__(self, server_address, latency=0.05, asset_size=16 * 1024, zip_size=256 * 1024, tags=10):
+        HTTPServer.__init__(self, server_address, FakeGitHubHandler)
+        self.latency = latency
+        self.asset_payload = _payload(asset_size)
+        self.zip_payload = _payload(zip_size)
+        self.tags = tags
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.server_address[:2])
+
+    def tag_names(self):
+        return ["v1.0.{}".format(i) for i in range(self.tags)]
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def zipball(self, repo, ref):
+        # Stored (not deflated), so that building the archive is cheap compared to the server under test
+        root = "bench-{}-{}/".format(repo, md5((repo + ref).encode("utf-8")).hexdigest()[:7])
+        version = ref[1:] if ref.startswith("v") else "0.0.1"
+        fp = io.BytesIO()
+        with zipfile.ZipFile(fp, "w", zipfile.ZIP_STORED) as z:
+            z.writestr(root + "addon.xml", ADDON_XML.format(id=repo, version=version))
+            z.writestr(root + "resources/data.bin", self.zip_payload)
+        return fp.getvalue()
+
+
+def _payload(size):
+    chunk = md5(b"bench").digest() * 64
+    return (chunk * (size // len(chunk) + 1))[:size]
+
+
+def start_server(host="127.0.0.1", port=0, **kwargs):
+    """
+    Start a FakeGitHubServer on a daemon thread. Returns the server (use ``shutdown`` to stop it).
+    """
+    server = FakeGitHubServer((host, port), **kwargs)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake GitHub server")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8081, help="Port to listen on")
+    parser.add_argument("--latency", type=float, default=0.05, help="Latency added to each response, in seconds")
+    parser.add_argument("--asset-size", type=int, default=16 * 1024, help="Size of each asset, in bytes")
+    parser.add_argument("--zip-size", type=int, default=256 * 1024, help="Size of each zipball payload, in bytes")
+    parser.add_argument("--tags", type=int, default=10, help="Number of tags of each repository")
+    args = parser.parse_args()
+    server = FakeGitHubServer((args.host, args.port), latency=args.latency, asset_size=args.asset_size,
+                              zip_size=args.zip_size, tags=args.tags)
+    print("Serving fake GitHub at {}".format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
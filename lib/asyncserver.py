@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio based HTTP server engine (python 3 only).
+
+Connections are handled by an event loop, so idle keep-alive connections and slow clients do not
+hold any thread. Route handlers are the same as the ones used by ThreadedHTTPServer and run on a
+bounded pool of worker threads, while bodies sent with ``stream_response`` are streamed by the
+event loop itself (upstream reads are done on the pool, one chunk at a time).
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from lib.httpserver import HTTPRequestHandler, active_connections
+
+
+class _LoopWriter(object):
+    """
+    File-like object which writes to an asyncio StreamWriter, waiting for the data to be drained.
+    """
+
+    def __init__(self, server, writer):
+        self._server = server
+        self._writer = writer
+
+    async def _write(self, data):
+        self._writer.write(data)
+        await self._writer.drain()
+
+    def write(self, data):
+        if threading.current_thread().ident == self._server.loop_thread_id:
+            # Errors detected while parsing the request are sent from the loop thread
+            self._writer.write(data)
+        else:
+            asyncio.run_coroutine_threadsafe(self._write(data), self._server.loop).result()
+
+    def flush(self):
+        pass
+
+
+class AsyncRequestHandler(HTTPRequestHandler):
+    chunk_size = 16 * 1024
+
+    # noinspection PyMissingConstructor
+    def __init__(self, server, reader, writer):
+        # BaseHTTPRequestHandler.__init__ is not called, as it handles the request synchronously
+        self.server = server
+        self.client_address = writer.get_extra_info("peername")
+        self.close_connection = True
+        self._reader = reader
+        self._writer = writer
+        self._loop = server.loop
+        self._executor = server.executor
+        self._deferred_response = None
+        self.wfile = _LoopWriter(server, writer)
+
+    def _parse(self, head):
+        request_line, _, headers = head.partition(b"\r\n")
+        self.raw_requestline = request_line + b"\r\n"
+        self.rfile = BytesIO(headers)
+        return self.parse_request()
+
+    async def handle_async(self, head):
+        """
+        Handle a request whose head (request line and headers) is ``head``.
+        Returns whether the connection can be kept alive.
+        """
+        if not self._parse(head):
+            return False
+
+        # Discard any request body
+        content_length = self.headers.get("Content-Length")
+        if content_length and content_length.isdigit() and int(content_length) > 0:
+            await self._reader.readexactly(int(content_length))
+
+        method = getattr(self, "do_" + self.command, None)
+        if method is None:
+            self.send_error(501, "Unsupported method ({})".format(self.command))
+            return False
+
+        await self._loop.run_in_executor(self._executor, method)
+        if self._deferred_response is not None:
+            try:
+                await self._stream_deferred_response()
+            finally:
+                self._record_request()
+        await self._writer.drain()
+        return not self.close_connection
+
+    def _record_request(self):
+        # Requests whose body is streamed by the event loop are only recorded once it is sent
+        if self._deferred_response is None:
+            super(AsyncRequestHandler, self)._record_request()
+
+    def stream_response(self, response):
+        if self.is_head:
+            # There is no body to stream
+            super(AsyncRequestHandler, self).stream_response(response)
+            return
+        # Only send the headers now. The body is streamed afterwards by the event loop,
+        # so that slow clients do not hold a worker thread
+        self._deferred_response = (response, self._send_file_headers(
+            response.status_code,
+            length=response.headers.get("Content-Length"),
+            content_type=response.headers.get("Content-Type"),
+            content_disposition=response.headers.get("Content-Disposition"),
+            chunked=True,
+            headers=self.forwarded_headers(response)))
+
+    async def _stream_deferred_response(self):
+        response, chunked = self._deferred_response
+        self._deferred_response = None
+        start = time.time()
+        try:
+            while True:
+                buf = await self._loop.run_in_executor(self._executor, response.raw.read, self.chunk_size)
+                if not buf:
+                    break
+                self._bytes_sent += len(buf)
+                if chunked:
+                    self._writer.write(self.chunk_header(buf))
+                    self._writer.write(buf)
+                    self._writer.write(b"\r\n")
+                else:
+                    self._writer.write(buf)
+                await self._writer.drain()
+            if chunked:
+                self._writer.write(b"0\r\n\r\n")
+        finally:
+            self._timings.add("send", time.time() - start)
+            await self._loop.run_in_executor(self._executor, response.close)
+
+
+class AsyncHTTPServer(object):
+    """
+    HTTP server with the same interface as ThreadedHTTPServer (serve_forever/shutdown/server_close).
+    """
+
+    def __init__(self, server_address, handler_class=AsyncRequestHandler, max_workers=32,
+                 keep_alive_timeout=60, max_header_size=64 * 1024):
+        self.server_address = server_address
+        self.handler_class = handler_class
+        self.keep_alive_timeout = keep_alive_timeout
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.loop_thread_id = None
+        self._stopped = None
+        self._shutdown_requested = False
+        self._is_shut_down = threading.Event()
+        self._is_shut_down.set()
+
+        host, port = server_address
+        self._server = self.loop.run_until_complete(
+            asyncio.start_server(self._handle_connection, host or None, port, limit=max_header_size))
+        self.server_port = self._server.sockets[0].getsockname()[1]
+
+    async def _handle_connection(self, reader, writer):
+        active_connections.inc()
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.keep_alive_timeout)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError,
+                        ConnectionError):
+                    break
+                if not await self.handler_class(self, reader, writer).handle_async(head):
+                    break
+        except ConnectionError as e:
+            logging.debug("Connection error: %s", e)
+        except Exception as e:
+            logging.error("Failed handling request: %s", e, exc_info=True)
+        finally:
+            active_connections.dec()
+            writer.close()
+
+    async def _serve(self):
+        self.loop_thread_id = threading.current_thread().ident
+        self._stopped = asyncio.Event()
+        if not self._shutdown_requested:
+            await self._stopped.wait()
+
+    def serve_forever(self):
+        self._is_shut_down.clear()
+        try:
+            self.loop.run_until_complete(self._serve())
+        finally:
+            self._shutdown_requested = False
+            self._is_shut_down.set()
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self._stop)
+        self._is_shut_down.wait()
+
+    def _stop(self):
+        self._shutdown_requested = True
+        if self._stopped is not None:
+            self._stopped.set()
+
+    def server_close(self):
+        self._server.close()
+        self.loop.run_until_complete(self._server.wait_closed())
+        self.executor.shutdown(wait=False)
+        self.loop.close()
+
+
+def async_http_server(host, port):
+    return AsyncHTTPServer((host, port), AsyncRequestHandler)
@@ -1,14 +1,34 @@
+import json
+import logging
+import os
+import random
+import tempfile
 import time
-from operator import attrgetter
-from threading import Lock
+from collections import OrderedDict, namedtuple
+from hashlib import sha1
+from io import BytesIO
+from threading import Condition, Event, Lock, Thread
+
+from lib.utils import RawResponse, Response, str_to_bytes
+
+try:
+    from os import replace as _replace_file
+except ImportError:
+    from os import rename as _replace_file
+
+
+CacheStats = namedtuple("CacheStats", (
+    "hits", "stale_hits", "misses", "loads", "load_failures", "load_time", "evictions", "size", "weight"))
 
 
 class _CacheValue(object):
-    __slots__ = ["_value", "_modified"]
+    __slots__ = ["_value", "_modified", "weight", "arguments"]
 
-    def __init__(self, value):
+    def __init__(self, value, weight=1, arguments=None):
         self._value = value
         self._modified = time.time()
+        self.weight = weight
+        self.arguments = arguments
 
     @property
     def modified(self):
@@ -62,40 +82,745 @@ def _make_key(args, kwargs, typed, kwd_mark=(_HashedTuple,), fast_types=(int, st
     return _HashedTuple(key)
 
 
+class _PendingLoad(object):
+    __slots__ = ["_event", "_value", "_error"]
+
+    def __init__(self):
+        self._event = Event()
+        self._value = None
+        self._error = None
+
+    def set_result(self, value):
+        self._value = value
+        self._event.set()
+
+    def set_error(self, error):
+        self._error = error
+        self._event.set()
+
+    def result(self):
+        self._event.wait()
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+
 class LoadingCache(object):
-    __slots__ = ["_func", "_store", "_ttl", "_max_size", "_typed", "_lru", "_get_modifier", "_lock"]
+    """
+    Cache which loads missing/expired values using ``func``.
+
+    Concurrent callers for the same key share a single load, while other keys can be loaded
+    in parallel. If ``stale_while_revalidate`` is set, expired entries are still returned while
+    a single background refresh is performed.
+
+    Entries are kept in eviction order, so that evicting is O(1): by modification time or, if
+    ``lru`` is set, by access time. Besides ``max_size`` (None for unbounded), the cache can be
+    bounded by ``max_weight``, where each value weights ``weigher(value)`` (e.g. its size in bytes).
+
+    ``version`` changes whenever any value is stored or removed, so that values derived from
+    the whole cache can be reused while it stays the same (and no value expires).
+
+    If ``executor`` (e.g. a ThreadPoolExecutor) is provided, background refreshes run on it instead of
+    on new threads, and ``refresh_expiring`` reloads entries in parallel.
+    """
+    __slots__ = ["_func", "_store", "_ttl", "_max_size", "_max_weight", "_weigher", "_typed", "_lru",
+                 "_stale_while_revalidate", "_executor", "_lock", "_loading", "_generation", "_version", "_weight",
+                 "_hits", "_stale_hits", "_misses", "_loads", "_load_failures", "_load_time", "_evictions"]
 
-    def __init__(self, func, ttl_seconds=60 * 60, max_size=128, typed=False, lru=False):
+    def __init__(self, func, ttl_seconds=60 * 60, max_size=128, typed=False, lru=False, stale_while_revalidate=False,
+                 max_weight=None, weigher=None, executor=None):
         self._func = func
-        self._store = {}
+        self._store = OrderedDict()
         self._ttl = ttl_seconds
         self._max_size = max_size
+        self._max_weight = max_weight
+        self._weigher = weigher
         self._typed = typed
         self._lru = lru
-        self._get_modifier = attrgetter("modified")
+        self._stale_while_revalidate = stale_while_revalidate
+        self._executor = executor
         self._lock = Lock()
+        self._loading = {}
+        self._generation = 0
+        self._version = 0
+        self._weight = 0
+        self._hits = self._stale_hits = self._misses = 0
+        self._loads = self._load_failures = self._evictions = 0
+        self._load_time = 0.0
 
     def get(self, *args, **kwargs):
         key = _make_key(args, kwargs, self._typed)
         with self._lock:
             cache_entry = self._store.get(key)  # type: _CacheValue
-            if cache_entry is None:
-                # Check cache size first and clean if necessary
-                if len(self._store) >= self._max_size:
-                    min_key = min(self._store, key=self._get_modifier)
-                    del self._store[min_key]
-                result = self._func(*args, **kwargs)
-                self._store[key] = _CacheValue(result)
-            elif cache_entry.expired(self._ttl):
-                result = self._func(*args, **kwargs)
-                self._store[key] = _CacheValue(result)
+            if cache_entry is not None:
+                if not cache_entry.expired(self._ttl):
+                    if self._lru:
+                        cache_entry.update()
+                        self._store[key] = self._store.pop(key)
+                    self._hits += 1
+                    return cache_entry.value
+                elif self._stale_while_revalidate:
+                    if key not in self._loading:
+                        self._start_refresh(key, args, kwargs)
+                    self._stale_hits += 1
+                    return cache_entry.value
+
+            self._misses += 1
+            pending = self._loading.get(key)
+            if pending is None:
+                pending = self._loading[key] = _PendingLoad()
+                generation = self._generation
             else:
-                if self._lru:
-                    cache_entry.update()
-                result = cache_entry.value
+                generation = None
+
+        if generation is None:
+            return pending.result()
+        return self._load(key, pending, generation, args, kwargs)
+
+    def contains(self, *args, **kwargs):
+        """
+        Check if there is a non expired value for the provided arguments.
+        """
+        key = _make_key(args, kwargs, self._typed)
+        with self._lock:
+            cache_entry = self._store.get(key)
+            return cache_entry is not None and not cache_entry.expired(self._ttl)
+
+    def stored(self, *args, **kwargs):
+        """
+        Check if there is a value (even if expired) for the provided arguments.
+        """
+        key = _make_key(args, kwargs, self._typed)
+        with self._lock:
+            return key in self._store
 
+    def peek(self, *args, **kwargs):
+        """
+        Get the value for the provided arguments, even if expired, without loading it (None if there is none).
+        """
+        key = _make_key(args, kwargs, self._typed)
+        with self._lock:
+            cache_entry = self._store.get(key)
+            return None if cache_entry is None else cache_entry.value
+
+    def put(self, value, *args, **kwargs):
+        """
+        Store ``value`` as if it was loaded for the provided arguments.
+        """
+        key = _make_key(args, kwargs, self._typed)
+        weight = self._weigher(value) if self._weigher else 1
+        with self._lock:
+            self._add(key, _CacheValue(value, weight, (args, kwargs)))
+
+    def _load(self, key, pending, generation, args, kwargs):
+        start = time.time()
+        try:
+            result = self._func(*args, **kwargs)
+        except Exception as e:
+            with self._lock:
+                self._load_failures += 1
+                self._load_time += time.time() - start
+                if self._loading.get(key) is pending:
+                    del self._loading[key]
+            pending.set_error(e)
+            raise
+
+        weight = self._weigher(result) if self._weigher else 1
+        with self._lock:
+            self._loads += 1
+            self._load_time += time.time() - start
+            # Results of loads which were invalidated (or cleared) in the meantime are not stored
+            current = self._loading.get(key) is pending
+            if current:
+                del self._loading[key]
+            if current and generation == self._generation:
+                self._add(key, _CacheValue(result, weight, (args, kwargs)))
+        pending.set_result(result)
         return result
 
+    def _add(self, key, cache_entry):
+        self._remove(key)
+        self._store[key] = cache_entry
+        self._weight += cache_entry.weight
+        self._version += 1
+        self._evict()
+
+    def _remove(self, key):
+        cache_entry = self._store.pop(key, None)
+        if cache_entry is not None:
+            self._weight -= cache_entry.weight
+            self._version += 1
+        return cache_entry
+
+    def _evict(self):
+        # The most recently stored entry (last one) is never evicted
+        while len(self._store) > 1 and ((self._max_size is not None and len(self._store) > self._max_size) or (
+                self._max_weight is not None and self._weight > self._max_weight)):
+            self._remove(next(iter(self._store)))
+            self._evictions += 1
+
+    @property
+    def version(self):
+        return self._version
+
+    def next_expiry(self):
+        """
+        Get the time at which the first of the values expires (None if empty).
+        Only available if not ``lru``, as otherwise values are not kept by modification time.
+        """
+        if self._lru:
+            raise ValueError("Expiry order is not available for LRU caches")
+        with self._lock:
+            if not self._store:
+                return None
+            return next(iter(self._store.values())).modified + self._ttl
+
+    def refresh_expiring(self, margin, jitter=0.0):
+        """
+        Reload the entries which expire within ``margin`` seconds (refresh-ahead), returning once all are done.
+        Each entry's margin is randomly increased by up to ``jitter`` (fraction of the margin), so
+        that entries loaded at the same time do not need to be refreshed all at once.
+        Returns the number of refreshed entries.
+        """
+        now = time.time()
+        with self._lock:
+            expiring = []
+            for key, cache_entry in self._store.items():
+                threshold = self._ttl - margin * (1 + random.uniform(0, jitter))
+                if now - cache_entry.modified > threshold and key not in self._loading:
+                    self._loading[key] = _PendingLoad()
+                    expiring.append((key, self._loading[key], cache_entry.arguments))
+            generation = self._generation
+
+        if self._executor is None:
+            for key, pending, (args, kwargs) in expiring:
+                self._refresh(key, pending, generation, args, kwargs)
+        else:
+            futures = [self._executor.submit(self._refresh, key, pending, generation, args, kwargs)
+                       for key, pending, (args, kwargs) in expiring]
+            for future in futures:
+                future.result()
+        return len(expiring)
+
+    def _start_refresh(self, key, args, kwargs):
+        pending = self._loading[key] = _PendingLoad()
+        if self._executor is not None:
+            self._executor.submit(self._refresh, key, pending, self._generation, args, kwargs)
+            return
+        thread = Thread(target=self._refresh, args=(key, pending, self._generation, args, kwargs))
+        thread.daemon = True
+        thread.start()
+
+    def _refresh(self, key, pending, generation, args, kwargs):
+        try:
+            self._load(key, pending, generation, args, kwargs)
+        except Exception as e:
+            logging.warning("Failed refreshing cache entry %r, keeping stale value: %s", key, e, exc_info=True)
+
+    def stats(self):
+        with self._lock:
+            return CacheStats(
+                hits=self._hits, stale_hits=self._stale_hits, misses=self._misses, loads=self._loads,
+                load_failures=self._load_failures, load_time=self._load_time, evictions=self._evictions,
+                size=len(self._store), weight=self._weight)
+
+    def invalidate(self, *args, **kwargs):
+        """
+        Remove the value for the provided arguments, including any load in progress.
+        """
+        key = _make_key(args, kwargs, self._typed)
+        with self._lock:
+            self._loading.pop(key, None)
+            # A load in progress is not stored anymore, which is a change as well
+            self._version += 1
+            return self._remove(key) is not None
+
     def clear(self):
         with self._lock:
             self._store.clear()
+            self._loading.clear()
+            self._weight = 0
+            self._generation += 1
+            self._version += 1
+
+
+class _BlobEntry(object):
+    __slots__ = ["size", "created", "immutable"]
+
+    def __init__(self, size, created, immutable):
+        self.size = size
+        self.created = created
+        self.immutable = immutable
+
+    def expired(self, ttl):
+        return not self.immutable and time.time() - self.created > ttl
+
+
+class BlobCache(object):
+    """
+    Disk backed cache for downloaded blobs (zips, addon.xml files, images, ...).
+
+    Entries are evicted by LRU order once the total size exceeds ``max_bytes``. Immutable entries
+    (e.g. pinned to a tag or commit) never expire, while the remaining ones expire after ``ttl_seconds``.
+    """
+    BLOB_EXTENSION = ".blob"
+    META_EXTENSION = ".json"
+    TEMP_EXTENSION = ".tmp"
+    CACHED_HEADERS = ("Content-Type", "Content-Disposition", "ETag", "Last-Modified")
+
+    def __init__(self, path, max_bytes=256 * 1024 * 1024, ttl_seconds=60 * 60, spool_timeout=60):
+        self._path = path
+        self._max_bytes = max_bytes
+        self._ttl = ttl_seconds
+        self._spool_timeout = spool_timeout
+        self._entries = OrderedDict()
+        self._spools = {}
+        self._size = 0
+        self._lock = Lock()
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self._load()
+
+    @property
+    def size(self):
+        return self._size
+
+    def _load(self):
+        entries = []
+        for name in os.listdir(self._path):
+            file_path = os.path.join(self._path, name)
+            if name.endswith(self.TEMP_EXTENSION):
+                self._remove_file(file_path)
+            elif name.endswith(self.META_EXTENSION):
+                entry_id = name[:-len(self.META_EXTENSION)]
+                try:
+                    with open(file_path) as f:
+                        meta = json.load(f)
+                    stat = os.stat(self._blob_path(entry_id))
+                except (OSError, IOError, ValueError):
+                    self._remove_entry_files(entry_id)
+                    continue
+                entries.append((stat.st_mtime, entry_id, _BlobEntry(
+                    stat.st_size, meta.get("created", 0), meta.get("immutable", False))))
+
+        # Most recently used entries have the most recent modification times
+        for _, entry_id, entry in sorted(entries, key=lambda e: e[0]):
+            self._entries[entry_id] = entry
+            self._size += entry.size
+        with self._lock:
+            self._evict()
+
+    @staticmethod
+    def make_id(key):
+        return sha1(str_to_bytes(json.dumps(key))).hexdigest()
+
+    def _blob_path(self, entry_id):
+        return os.path.join(self._path, entry_id + self.BLOB_EXTENSION)
+
+    def _meta_path(self, entry_id):
+        return os.path.join(self._path, entry_id + self.META_EXTENSION)
+
+    def get(self, key, byte_range=None, if_range=None, allow_expired=False):
+        """
+        Get a Response for the cached blob identified by ``key`` or None if there is no valid entry
+        (expired entries are only considered if ``allow_expired`` is set).
+        If ``byte_range`` is provided (and ``if_range``, if any, matches the blob validators), the
+        response only has the requested range (206), or is a 416 if the range is not satisfiable.
+        """
+        entry_id = self.make_id(key)
+        with self._lock:
+            entry = self._entries.get(entry_id)
+            if entry is None:
+                return None
+            if entry.expired(self._ttl) and not allow_expired:
+                # Expired entries are kept until replaced or evicted, as they can still be used as fallback
+                return None
+            self._touch(entry_id)
+            try:
+                with open(self._meta_path(entry_id)) as f:
+                    headers = json.load(f).get("headers")
+                fp = open(self._blob_path(entry_id), "rb")
+            except (OSError, IOError, ValueError) as e:
+                logging.warning("Failed reading cached blob %s: %s", entry_id, e)
+                self._discard(entry_id)
+                return None
+
+        headers = dict(headers or {})
+        headers["Accept-Ranges"] = "bytes"
+        if byte_range is not None and (if_range is None or self._validator_matches(if_range, headers)):
+            resolved_range = byte_range.resolve(entry.size)
+            if resolved_range is None:
+                fp.close()
+                headers["Content-Range"] = "bytes */{}".format(entry.size)
+                headers["Content-Length"] = "0"
+                return Response(RawResponse(BytesIO(), headers, code=416))
+            start, end = resolved_range
+            fp.seek(start)
+            headers["Content-Range"] = "bytes {}-{}/{}".format(start, end, entry.size)
+            headers["Content-Length"] = str(end - start + 1)
+            return Response(RawResponse(_LimitedReader(fp, end - start + 1), headers, code=206))
+
+        headers["Content-Length"] = str(entry.size)
+        return Response(RawResponse(fp, headers))
+
+    def revalidation_headers(self, key):
+        """
+        Get the headers for a conditional request of the (possibly expired) blob identified by ``key``.
+        If upstream responds with 304, the blob can be renewed (see ``renew``) instead of downloaded again.
+        """
+        entry_id = self.make_id(key)
+        with self._lock:
+            if entry_id not in self._entries:
+                return {}
+            try:
+                with open(self._meta_path(entry_id)) as f:
+                    headers = json.load(f).get("headers") or {}
+            except (OSError, IOError, ValueError):
+                return {}
+
+        conditional_headers = {}
+        if headers.get("ETag"):
+            conditional_headers["If-None-Match"] = headers["ETag"]
+        if headers.get("Last-Modified"):
+            conditional_headers["If-Modified-Since"] = headers["Last-Modified"]
+        return conditional_headers
+
+    def renew(self, key):
+        """
+        Restart the expiration time of the blob identified by ``key``. Returns whether there is such blob.
+        """
+        entry_id = self.make_id(key)
+        with self._lock:
+            entry = self._entries.get(entry_id)
+            if entry is None:
+                return False
+            try:
+                with open(self._meta_path(entry_id)) as f:
+                    meta = json.load(f)
+                meta["created"] = time.time()
+                with open(self._meta_path(entry_id), "w") as f:
+                    json.dump(meta, f)
+            except (OSError, IOError, ValueError) as e:
+                logging.warning("Failed renewing cached blob %s: %s", entry_id, e)
+                self._discard(entry_id)
+                return False
+            entry.created = meta["created"]
+            self._touch(entry_id)
+            return True
+
+    @staticmethod
+    def _validator_matches(if_range, headers):
+        # If-Range requires a strong comparison, so weak entity tags never match
+        if_range = if_range.strip()
+        if if_range.startswith("W/"):
+            return False
+        return if_range in (headers.get("ETag"), headers.get("Last-Modified"))
+
+    def wrap(self, key, response, immutable=False):
+        """
+        Wrap ``response`` so that its body is stored on the cache while being read.
+        Only successful responses are stored. ``immutable`` may be a callable, called once the body is stored.
+        """
+        if response.status_code != 200:
+            return response
+        return Response(_BlobWriter(self, self.make_id(key), response.raw, immutable))
+
+    def fetch(self, key, fetch, immutable=False):
+        """
+        Get the Response of ``fetch()`` wrapped so that it is stored on the cache (as ``wrap`` does).
+        Concurrent calls for the same ``key`` share a single download: the first call downloads it into
+        a spool file, while the remaining ones read the spool as it grows.
+        """
+        entry_id = self.make_id(key)
+        with self._lock:
+            spool = self._spools.get(entry_id)
+            leader = spool is None
+            if leader:
+                spool = self._spools[entry_id] = _Spool()
+
+        if not leader:
+            response = spool.join(self._spool_timeout)
+            if response is not None:
+                logging.debug("Joining in-flight download of blob %s", entry_id)
+                return response
+            # The download failed to start, so do not depend on it
+            return fetch()
+
+        try:
+            response = fetch()
+        except Exception:
+            self._end_spool(entry_id, spool)
+            raise
+        if response.status_code != 200:
+            self._end_spool(entry_id, spool)
+            return response
+        return Response(_BlobWriter(self, entry_id, response.raw, immutable, spool=spool))
+
+    def _end_spool(self, entry_id, spool, failed=True):
+        with self._lock:
+            if self._spools.get(entry_id) is spool:
+                del self._spools[entry_id]
+        spool.finish(failed=failed)
+
+    def _touch(self, entry_id):
+        # Move the entry to the end (most recently used) and persist the access time
+        self._entries[entry_id] = self._entries.pop(entry_id)
+        try:
+            os.utime(self._blob_path(entry_id), None)
+        except OSError:
+            pass
+
+    def _commit(self, entry_id, spool, headers, immutable):
+        """
+        Store the spool file of a complete download as the blob of ``entry_id``. Returns whether it was stored
+        (if not, the spool file is left as is).
+        """
+        size = spool.size
+        content_length = headers.get("Content-Length")
+        if size > self._max_bytes or (content_length and content_length.isdigit() and int(content_length) != size):
+            return False
+
+        if callable(immutable):
+            immutable = immutable()
+        meta = dict(
+            created=time.time(), immutable=immutable,
+            headers={h: headers.get(h) for h in self.CACHED_HEADERS if headers.get(h)})
+        with self._lock:
+            if self._spools.get(entry_id) is spool:
+                del self._spools[entry_id]
+            if entry_id in self._entries:
+                self._discard(entry_id)
+            try:
+                # Spool readers reopen the file (path) on each read, so they keep reading the committed blob
+                with spool.lock:
+                    _replace_file(spool.path, self._blob_path(entry_id))
+                    spool.path = self._blob_path(entry_id)
+                with open(self._meta_path(entry_id), "w") as f:
+                    json.dump(meta, f)
+            except (OSError, IOError) as e:
+                logging.warning("Failed storing cached blob %s: %s", entry_id, e)
+                self._remove_file(self._meta_path(entry_id))
+                return False
+            self._entries[entry_id] = _BlobEntry(size, meta["created"], immutable)
+            self._size += size
+            self._evict()
+        return True
+
+    def _evict(self):
+        while self._size > self._max_bytes and self._entries:
+            self._discard(next(iter(self._entries)))
+
+    def _discard(self, entry_id):
+        entry = self._entries.pop(entry_id)
+        self._size -= entry.size
+        self._remove_entry_files(entry_id)
+
+    def _remove_entry_files(self, entry_id):
+        self._remove_file(self._meta_path(entry_id))
+        self._remove_file(self._blob_path(entry_id))
+
+    @staticmethod
+    def _remove_file(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _temp_file(self):
+        fd, path = tempfile.mkstemp(suffix=self.TEMP_EXTENSION, dir=self._path)
+        return os.fdopen(fd, "wb"), path
+
+    def clear(self):
+        with self._lock:
+            while self._entries:
+                self._discard(next(iter(self._entries)))
+
+
+class _LimitedReader(object):
+    def __init__(self, fp, length):
+        self._fp = fp
+        self._remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._fp.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def close(self):
+        self._fp.close()
+
+
+class _Spool(object):
+    """
+    File of a download in progress, written by a _BlobWriter and read (as it grows) by any number of _SpoolReader.
+    ``lock`` must be held while accessing or moving the file, so that it can be moved while being read.
+    If the download is not committed to the cache, the file is only removed once the last reader is closed.
+    """
+
+    def __init__(self):
+        self.lock = Condition()
+        self.path = None
+        self.headers = None
+        self.size = 0
+        self.readers = 0
+        self.done = False
+        self.failed = False
+        self.discarded = False
+        self.removed = False
+
+    def start(self, path, headers):
+        with self.lock:
+            self.path = path
+            self.headers = headers
+            self.lock.notify_all()
+
+    def advance(self, size):
+        with self.lock:
+            self.size += size
+            self.lock.notify_all()
+
+    def finish(self, failed=False):
+        with self.lock:
+            self.done = True
+            self.failed = self.failed or failed
+            self.lock.notify_all()
+
+    def discard(self):
+        """
+        Remove the file (which was not committed) as soon as it is not being read.
+        """
+        with self.lock:
+            self.discarded = True
+            self._remove_if_unused()
+
+    def close_reader(self):
+        with self.lock:
+            self.readers -= 1
+            self._remove_if_unused()
+
+    def _remove_if_unused(self):
+        if self.discarded and self.readers == 0 and not self.removed:
+            self.removed = True
+            BlobCache._remove_file(self.path)
+
+    def wait(self, predicate, timeout):
+        with self.lock:
+            end = time.time() + timeout
+            while not predicate():
+                remaining = end - time.time()
+                if remaining <= 0:
+                    return False
+                self.lock.wait(remaining)
+            return True
+
+    def join(self, timeout):
+        """
+        Get a Response which reads the spool, or None if the download did not start successfully.
+        """
+        if not self.wait(lambda: self.headers is not None or self.done, timeout) or self.headers is None or self.failed:
+            return None
+        with self.lock:
+            if self.removed:
+                return None
+            self.readers += 1
+        return Response(RawResponse(_SpoolReader(self, timeout), self.headers))
+
+
+class _SpoolReader(object):
+    def __init__(self, spool, timeout):
+        self._spool = spool
+        self._timeout = timeout
+        self._offset = 0
+        self._closed = False
+
+    def read(self, size=-1):
+        spool = self._spool
+        if not spool.wait(lambda: spool.size > self._offset or spool.done, self._timeout):
+            raise IOError("Timed out waiting for the download of {}".format(spool.path))
+        with spool.lock:
+            if spool.failed:
+                raise IOError("Download of {} failed".format(spool.path))
+            available = spool.size - self._offset
+            if size is not None and 0 <= size < available:
+                available = size
+            if available <= 0:
+                return b""
+            with open(spool.path, "rb") as f:
+                f.seek(self._offset)
+                data = f.read(available)
+        self._offset += len(data)
+        return data
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._spool.close_reader()
+
+
+class _BlobWriter(object):
+    """
+    Response-like object which copies everything read from the wrapped response into the cache.
+    The entry is only committed once the response is fully read. If the response is closed before
+    that while other readers share its spool, the rest of the response is downloaded in background.
+    """
+
+    def __init__(self, cache, entry_id, response, immutable, spool=None):
+        self._cache = cache
+        self._entry_id = entry_id
+        self._response = response
+        self._immutable = immutable
+        self._spool = spool or _Spool()
+        self._file, temp_path = cache._temp_file()
+        self._spool.start(temp_path, response.info())
+
+    def read(self, *args):
+        data = self._response.read(*args)
+        if self._file is not None:
+            if data:
+                with self._spool.lock:
+                    self._file.write(data)
+                    self._file.flush()
+                self._spool.advance(len(data))
+            if not data or not args or args[0] is None or args[0] < 0:
+                self._finish(commit=True)
+        return data
+
+    def info(self):
+        return self._response.info()
+
+    def getcode(self):
+        return self._response.getcode()
+
+    def _finish(self, commit):
+        self._file.close()
+        self._file = None
+        committed = commit and self._cache._commit(self._entry_id, self._spool, self.info(), self._immutable)
+        if not committed:
+            # Readers sharing the spool may still be reading it, so it is only removed once they are done
+            self._spool.discard()
+        self._cache._end_spool(self._entry_id, self._spool, failed=not commit)
+
+    def _drain(self):
+        try:
+            while self._file is not None:
+                self.read(64 * 1024)
+        except Exception as e:
+            logging.warning("Failed downloading blob %s in background: %s", self._entry_id, e)
+            if self._file is not None:
+                self._finish(commit=False)
+        finally:
+            self._response.close()
+
+    def close(self):
+        if self._file is not None and self._spool.readers > 0:
+            thread = Thread(target=self._drain)
+            thread.daemon = True
+            thread.start()
+            return
+        try:
+            if self._file is not None:
+                self._finish(commit=False)
+        finally:
+            self._response.close()
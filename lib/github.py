@@ -1,86 +1,530 @@
-from lib.utils import request
-
-
-class _Dict(dict):
-    def __getattr__(self, name):
-        return self[name]
-
-
-class GitHubApiError(Exception):
-    pass
-
-
-class GitHubRepositoryApi(object):
-    def __init__(self, username, repository, base_url="https://api.github.com", version="2022-11-28", token=None):
-        self._base_url = "{}/repos/{username}/{repository}".format(
-            base_url, username=username, repository=repository)
-        self._version = version
-        self._token = token
-
-    def get_repository_info(self):
-        return self._request_json("")
-
-    def get_refs_tags(self):
-        return self._request_json("/git/refs/tags")
-
-    def get_release(self, release):
-        return self._request_json("/releases/{}".format(release))
-
-    def get_latest_release(self):
-        return self.get_release("latest")
-
-    def get_release_by_tag(self, tag_name):
-        return self.get_release("tags/{}".format(tag_name))
-
-    def get_release_asset(self, asset_id):
-        return self._request(
-            "/releases/assets/{}".format(asset_id),
-            headers={"Accept": "application/octet-stream"})
-
-    def get_zip(self, ref=None):
-        # One could also use "https://github.com/{username}/{repository}/archive/{branch}.zip"
-        # to avoid GitHub API rate limiting
-        return self._request(
-            "/zipball/{}".format(ref) if ref else "/zipball",
-            headers={"Accept": "application/vnd.github.raw"})
-
-    def get_contents(self, path, ref=None):
-        # One could also use "https://raw.githubusercontent.com/{username}/{repository}/{branch}/{path}"
-        # to avoid GitHub API rate limiting
-        return self._request(
-            "/contents/{}".format(path),
-            params=dict(ref=ref) if ref else None,
-            headers={"Accept": "application/vnd.github.raw"})
-
-    def _request_json(self, url, params=None):
-        with self._request(url, params=params, headers={"Accept": "application/vnd.github+json"}) as response:
-            return response.json(object_pairs_hook=_Dict)
-
-    def _request(self, url, params=None, headers=None):
-        full_url = self._base_url + url
-        response = request(full_url, params=params, headers=self._headers(headers))
-        if response.status_code >= 400:
-            try:
-                response.close()
-            finally:
-                raise GitHubApiError("Call to {} failed with HTTP {}".format(full_url, response.status_code))
-        return response
-
-    def _headers(self, headers):
-        if headers is None:
-            headers = {}
-        if self._token:
-            headers["Authorization"] = "Bearer {}".format(self._token)
-        headers["X-GitHub-Api-Version"] = self._version
-        return headers
-
-    def __eq__(self, other):
-        if isinstance(other, self.__class__):
-            return self._base_url == other._base_url and self._version == other._version and self._token == other._token
-        return NotImplemented
-
-    def __ne__(self, other):
-        return not self == other
-
-    def __hash__(self):
-        return hash((self._base_url, self._version, self._token))
+import json
+import logging
+import socket
+import time
+from collections import OrderedDict
+from io import BytesIO
+from threading import Lock
+
+from lib.httpclient import PoolTimeoutError
+from lib.metrics import default_registry
+from lib.ratelimit import default_rate_limiter, RateLimitExceeded, RESOURCE_CORE, RESOURCE_GRAPHQL
+from lib.retry import default_circuit_breakers, CircuitOpenError, RetryPolicy
+from lib.timing import add_timing
+from lib.utils import request, Response, RawResponse, str_to_bytes, iter_json_array
+
+try:
+    from http.client import HTTPException
+    from urllib.parse import urlparse, quote
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from httplib import HTTPException
+    # noinspection PyUnresolvedReferences
+    from urlparse import urlparse
+    # noinspection PyUnresolvedReferences
+    from urllib import quote
+
+TRANSIENT_STATUS_CODES = (500, 502, 503, 504)
+NETWORK_ERRORS = (socket.error, HTTPException)
+
+_calls = default_registry.counter(
+    "github_requests_total", "Calls to GitHub, by endpoint and HTTP status code", ("endpoint", "code"))
+_call_duration = default_registry.histogram(
+    "github_request_duration_seconds", "Time until GitHub responded to a call, by endpoint", ("endpoint",))
+
+
+def _endpoint(path):
+    # Keep the label cardinality low (e.g. "/contents/addon.xml" -> "contents")
+    parts = path.strip("/").split("/")
+    if not parts[0]:
+        return "repository"
+    return "/".join(parts[:2]) if parts[0] == "git" else parts[0]
+
+
+def _observe_call(endpoint, started, response=None):
+    duration = time.time() - started
+    _calls.inc(endpoint=endpoint, code=response.status_code if response is not None else "error")
+    _call_duration.observe(duration, endpoint=endpoint)
+    # Time to the response headers, as the body is read by the caller
+    add_timing("upstream", duration)
+
+
+class _Dict(dict):
+    def __getattr__(self, name):
+        return self[name]
+
+
+class GitHubApiError(Exception):
+    def __init__(self, message, status_code=None):
+        super(GitHubApiError, self).__init__(message)
+        self.status_code = status_code
+
+
+class GitHubTransientError(GitHubApiError):
+    """
+    Raised when a call fails due to a temporary condition, so its result must not be
+    replaced by (and cached as) a fallback value.
+    """
+    pass
+
+
+class GitHubRateLimitError(GitHubTransientError):
+    """
+    Raised when a call is rejected (or known beforehand to be rejected) due to rate limiting.
+    """
+    pass
+
+
+class GitHubNotModifiedError(GitHubApiError):
+    """
+    Raised when a conditional call is answered with 304, but only the validators (not the body)
+    of the previous response were stored, so the caller must use its own copy.
+    """
+    pass
+
+
+class GitHubUnavailableError(GitHubTransientError):
+    """
+    Raised when GitHub is unreachable or keeps failing (5xx/timeouts), even after retrying.
+    """
+    pass
+
+
+class _StoredResponse(object):
+    __slots__ = ["etag", "last_modified", "body", "headers", "size"]
+
+    def __init__(self, etag, last_modified, body, headers, size):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.body = body
+        self.headers = headers
+        self.size = size
+
+    def response(self):
+        return Response(RawResponse(BytesIO(self.body), self.headers))
+
+
+class _PrefixedResponse(object):
+    def __init__(self, prefix, response):
+        self._prefix = BytesIO(prefix)
+        self._response = response
+
+    def read(self, *args):
+        size = args[0] if args and args[0] is not None else -1
+        data = self._prefix.read(size)
+        if size < 0:
+            return data + self._response.read()
+        elif len(data) < size:
+            data += self._response.read(size - len(data))
+        return data
+
+    def info(self):
+        return self._response.info()
+
+    def getcode(self):
+        return self._response.getcode()
+
+    def close(self):
+        self._response.close()
+
+
+class ValidatorStore(object):
+    """
+    LRU store of response validators (ETag/Last-Modified) and respective bodies, used for doing
+    conditional requests. GitHub does not count 304 responses against the rate limit.
+
+    The store is bounded by ``max_bytes``, the total size of the stored bodies (plus an estimate
+    of the size of each entry). Bodies which the caller keeps on its own are not stored.
+    """
+    STORED_HEADERS = ("Content-Type", "Content-Disposition", "ETag", "Last-Modified")
+    ENTRY_SIZE = 512
+
+    def __init__(self, max_bytes=4 * 1024 * 1024, max_body_size=256 * 1024):
+        self._max_bytes = max_bytes
+        self._max_body_size = max_body_size
+        self._store = OrderedDict()
+        self._size = 0
+        self._lock = Lock()
+
+    @property
+    def size(self):
+        return self._size
+
+    def get(self, key):
+        with self._lock:
+            stored = self._store.pop(key, None)
+            if stored is not None:
+                self._store[key] = stored
+            return stored
+
+    def store(self, key, response, keep_body=True):
+        """
+        Store ``response`` body and validators, returning a Response which replaces ``response``.
+        If the response has no validators or is too big to be stored, ``response`` is returned as is.
+        If ``keep_body`` is not set, only the validators are stored and ``response`` is returned as is.
+        """
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if not (etag or last_modified):
+            return response
+        if not keep_body:
+            self._put(key, _StoredResponse(etag, last_modified, None, None, self.ENTRY_SIZE))
+            return response
+        content_length = response.headers.get("Content-Length")
+        if content_length and int(content_length) > self._max_body_size:
+            return response
+
+        # Content-Length may not be available (chunked responses), so read at most max_body_size bytes
+        body = response.raw.read(self._max_body_size + 1)
+        if len(body) > self._max_body_size:
+            return Response(_PrefixedResponse(body, response.raw))
+        response.close()
+        headers = {h: response.headers.get(h) for h in self.STORED_HEADERS}
+        headers["Content-Length"] = str(len(body))
+        stored = _StoredResponse(etag, last_modified, body, headers, self.ENTRY_SIZE + len(body))
+        self._put(key, stored)
+        return stored.response()
+
+    def _put(self, key, stored):
+        with self._lock:
+            previous = self._store.pop(key, None)
+            if previous is not None:
+                self._size -= previous.size
+            self._store[key] = stored
+            self._size += stored.size
+            while self._size > self._max_bytes and self._store:
+                self._size -= self._store.popitem(last=False)[1].size
+
+    def clear(self):
+        with self._lock:
+            self._store.clear()
+            self._size = 0
+
+
+class _GitHubApiClient(object):
+    """
+    Base of the GitHub API clients, which do their calls within the rate limit, retrying transient failures.
+    """
+    rate_limiter = default_rate_limiter
+    circuit_breakers = default_circuit_breakers
+    retry_policy = RetryPolicy()
+    _token = None
+
+    def _send(self, full_url, params, headers, endpoint, method="GET", data=None, resource=RESOURCE_CORE,
+              breaker_name=None):
+        """
+        Do a request, retrying on network errors and 5xx responses (with backoff).
+        Calls to hosts (or ``breaker_name``) which keep failing are refused while their circuit is open.
+        """
+        breaker = self.circuit_breakers.get(breaker_name or urlparse(full_url).netloc)
+        attempt = 0
+        while True:
+            # Once allowed by the breaker, the call must be done (or the breaker released)
+            try:
+                self.rate_limiter.acquire(self._token, resource)
+            except RateLimitExceeded as e:
+                raise GitHubRateLimitError("Not calling {}: {}".format(full_url, e), 429)
+            try:
+                breaker.allow()
+            except CircuitOpenError as e:
+                raise GitHubUnavailableError("Not calling {}: {}".format(full_url, e), 503)
+
+            started = time.time()
+            try:
+                response = request(full_url, params=params, data=data, headers=headers, method=method)
+            except PoolTimeoutError as e:
+                # Local contention, which says nothing about the host
+                breaker.release()
+                raise GitHubUnavailableError("Not calling {}: {}".format(full_url, e), 503)
+            except NETWORK_ERRORS as e:
+                _observe_call(endpoint, started)
+                breaker.record_failure()
+                error = GitHubUnavailableError("Call to {} failed: {}".format(full_url, e))
+            except Exception:
+                breaker.release()
+                raise
+            else:
+                _observe_call(endpoint, started, response)
+                limited = self.rate_limiter.update(self._token, response, resource)
+                if response.status_code not in TRANSIENT_STATUS_CODES:
+                    breaker.record_success()
+                    if response.status_code >= 400 and response.status_code != 304:
+                        try:
+                            response.close()
+                        finally:
+                            error = GitHubRateLimitError if limited else GitHubApiError
+                            raise error("Call to {} failed with HTTP {}".format(full_url, response.status_code),
+                                        response.status_code)
+                    return response
+                response.close()
+                breaker.record_failure()
+                error = GitHubUnavailableError(
+                    "Call to {} failed with HTTP {}".format(full_url, response.status_code), response.status_code)
+
+            if attempt >= self.retry_policy.retries:
+                raise error
+            logging.debug("%s, retrying (attempt %d)", error, attempt + 1)
+            self.retry_policy.sleep(attempt)
+            attempt += 1
+
+
+class GitHubRepositoryApi(_GitHubApiClient):
+    validators = ValidatorStore()
+
+    def __init__(self, username, repository, base_url="https://api.github.com", version="2022-11-28", token=None):
+        self._base_url = "{}/repos/{username}/{repository}".format(
+            base_url, username=username, repository=repository)
+        self._version = version
+        self._token = token
+
+    def get_repository_info(self):
+        return self._request_json("")
+
+    def get_refs_tags(self, prefix=None, conditional=True):
+        """
+        Get the tag refs (lazily, as they are parsed). If ``prefix`` is provided, only
+        the tags starting with it are requested.
+        Refs listings can be large, so only their validators are stored: if ``conditional`` is set and
+        the refs were not modified since the last call, GitHubNotModifiedError is raised.
+        """
+        if prefix:
+            return self._iter_json_array("/git/matching-refs/tags/{}".format(quote(prefix)), conditional=conditional)
+        return self._iter_json_array("/git/refs/tags", conditional=conditional)
+
+    def get_release(self, release):
+        return self._request_json("/releases/{}".format(release))
+
+    def get_latest_release(self):
+        return self.get_release("latest")
+
+    def get_release_by_tag(self, tag_name):
+        return self.get_release("tags/{}".format(tag_name))
+
+    def get_release_asset(self, asset_id, headers=None, method="GET"):
+        return self._request(
+            "/releases/assets/{}".format(asset_id),
+            headers=dict(headers or {}, Accept="application/octet-stream"), method=method)
+
+    def get_zip(self, ref=None, headers=None, method="GET"):
+        # One could also use "https://github.com/{username}/{repository}/archive/{branch}.zip"
+        # to avoid GitHub API rate limiting
+        return self._request(
+            "/zipball/{}".format(ref) if ref else "/zipball",
+            headers=dict(headers or {}, Accept="application/vnd.github.raw"), method=method)
+
+    def get_contents(self, path, ref=None, headers=None, method="GET"):
+        """
+        Get the contents of ``path``. If ``headers`` are not provided, the request is revalidated using
+        the stored validators (and body). Callers which store the body themselves (e.g. on a BlobCache)
+        provide ``headers`` instead, with their own validators, if any.
+        """
+        # One could also use "https://raw.githubusercontent.com/{username}/{repository}/{branch}/{path}"
+        # to avoid GitHub API rate limiting
+        return self._request(
+            "/contents/{}".format(path),
+            params=dict(ref=ref) if ref else None,
+            headers=dict(headers or {}, Accept="application/vnd.github.raw"),
+            conditional=headers is None and method == "GET", method=method)
+
+    def _request_json(self, url, params=None):
+        with self._request(url, params=params, headers={"Accept": "application/vnd.github+json"},
+                           conditional=True) as response:
+            return response.json(object_pairs_hook=_Dict)
+
+    def _iter_json_array(self, url, params=None, conditional=True):
+        with self._request(url, params=params, headers={"Accept": "application/vnd.github+json"},
+                           conditional=conditional, keep_body=False) as response:
+            # The body is read while iterating, so network errors may happen after the call returned
+            try:
+                for item in iter_json_array(response.raw, object_pairs_hook=_Dict):
+                    yield item
+            except NETWORK_ERRORS as e:
+                raise GitHubUnavailableError("Reading response of {} failed: {}".format(self._base_url + url, e))
+
+    def _request(self, url, params=None, headers=None, conditional=False, method="GET", keep_body=True):
+        full_url = self._base_url + url
+        headers = self._headers(headers)
+        stored = None
+        if conditional:
+            key = (full_url, tuple(sorted(params.items())) if params else None, headers.get("Accept"), self._token)
+            stored = self.validators.get(key)
+            if stored is not None:
+                if stored.etag:
+                    headers["If-None-Match"] = stored.etag
+                if stored.last_modified:
+                    headers["If-Modified-Since"] = stored.last_modified
+
+        try:
+            response = self._send(full_url, params, headers, _endpoint(url), method)
+        except GitHubTransientError as e:
+            if stored is not None and stored.body is not None:
+                logging.debug("Not able to call %s (%s), using stored response instead", full_url, e)
+                return stored.response()
+            raise
+
+        if response.status_code == 304 and stored is not None:
+            response.close()
+            if stored.body is None:
+                raise GitHubNotModifiedError("{} was not modified".format(full_url), 304)
+            return stored.response()
+        if conditional and response.status_code == 200:
+            response = self.validators.store(key, response, keep_body=keep_body)
+        return response
+
+    def _headers(self, headers):
+        if headers is None:
+            headers = {}
+        if self._token:
+            headers["Authorization"] = "Bearer {}".format(self._token)
+        headers["X-GitHub-Api-Version"] = self._version
+        return headers
+
+    def __eq__(self, other):
+        if isinstance(other, self.__class__):
+            return self._base_url == other._base_url and self._version == other._version and self._token == other._token
+        return NotImplemented
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self._base_url, self._version, self._token))
+
+
+class GitHubCdnApi(object):
+    """
+    Client for the contents and archives of a repository served by GitHub CDNs (raw.githubusercontent.com
+    and codeload.github.com), which are faster and not subject to the REST API rate limit.
+    If ``fallback`` (e.g. a GitHubRepositoryApi) is provided, failed calls are done with it instead.
+    """
+    circuit_breakers = default_circuit_breakers
+
+    def __init__(self, username, repository, raw_url="https://raw.githubusercontent.com",
+                 codeload_url="https://codeload.github.com", token=None, fallback=None):
+        self._raw_url = "{}/{}/{}".format(raw_url, username, repository)
+        self._codeload_url = "{}/{}/{}".format(codeload_url, username, repository)
+        self._token = token
+        self._fallback = fallback
+
+    def get_contents(self, path, ref=None, headers=None, method="GET"):
+        raw_headers = dict(headers or {})
+        if self._token:
+            raw_headers["Authorization"] = "token {}".format(self._token)
+        return self._request(
+            "{}/{}/{}".format(self._raw_url, quote(ref or "HEAD"), quote(path)), raw_headers, "raw", method,
+            lambda api: api.get_contents(path, ref=ref, headers=headers, method=method))
+
+    def get_zip(self, ref=None, headers=None, method="GET"):
+        # Private repositories archives are not available (without a session), so these require the fallback
+        return self._request(
+            "{}/zip/{}".format(self._codeload_url, quote(ref or "HEAD")), headers, "codeload", method,
+            lambda api: api.get_zip(ref, headers=headers, method=method))
+
+    def _request(self, url, headers, endpoint, method, fallback_call):
+        try:
+            return self._send(url, headers, endpoint, method)
+        except GitHubApiError as e:
+            if self._fallback is None:
+                raise
+            logging.debug("%s, falling back to the API", e)
+            return fallback_call(self._fallback)
+
+    def _send(self, url, headers, endpoint, method="GET"):
+        breaker = self.circuit_breakers.get(urlparse(url).netloc)
+        try:
+            breaker.allow()
+        except CircuitOpenError as e:
+            raise GitHubUnavailableError("Not calling {}: {}".format(url, e), 503)
+        started = time.time()
+        try:
+            response = request(url, headers=headers, method=method)
+        except PoolTimeoutError as e:
+            breaker.release()
+            raise GitHubUnavailableError("Not calling {}: {}".format(url, e), 503)
+        except NETWORK_ERRORS as e:
+            _observe_call(endpoint, started)
+            breaker.record_failure()
+            raise GitHubUnavailableError("Call to {} failed: {}".format(url, e))
+        except Exception:
+            breaker.release()
+            raise
+        _observe_call(endpoint, started, response)
+
+        if response.status_code in TRANSIENT_STATUS_CODES:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        if response.status_code >= 400:
+            try:
+                response.close()
+            finally:
+                error = GitHubUnavailableError if response.status_code in TRANSIENT_STATUS_CODES else GitHubApiError
+                raise error("Call to {} failed with HTTP {}".format(url, response.status_code), response.status_code)
+        return response
+
+
+class GitHubGraphQLApi(_GitHubApiClient):
+    _repository_fields = """
+        defaultBranchRef { name }
+        latestRelease { tagName }
+        refs(refPrefix: "refs/tags/", first: %d, orderBy: {field: ALPHABETICAL, direction: DESC}) {
+            nodes { name }
+            pageInfo { hasNextPage }
+        }
+    """
+
+    def __init__(self, url="https://api.github.com/graphql", token=None):
+        self._url = url
+        self._token = token
+
+    def query(self, query, variables=None):
+        headers = {"Content-Type": "application/json", "Accept": "application/json"}
+        if self._token:
+            headers["Authorization"] = "Bearer {}".format(self._token)
+        data = str_to_bytes(json.dumps(dict(query=query, variables=variables or {})))
+        # Queries are read only, so these are retried as any other call, but have their own circuit
+        with self._send(self._url, None, headers, "graphql", method="POST", data=data, resource=RESOURCE_GRAPHQL,
+                        breaker_name=urlparse(self._url).netloc + "/graphql") as response:
+            result = response.json(object_pairs_hook=_Dict)
+
+        errors = result.get("errors")
+        if errors:
+            logging.debug("GraphQL query returned errors: %s", "; ".join(e.get("message", "") for e in errors))
+        if result.get("data") is None:
+            raise GitHubApiError("GraphQL query failed: {}".format(errors))
+        return result.data
+
+    def get_repositories_metadata(self, repositories, max_tags=100):
+        """
+        Get the default branch, latest release tag and tag refs of each ``(username, repository)`` pair
+        in a single query. Tag refs are returned in the same format/order as the REST API, but only the
+        last ``max_tags`` tags are included (``refs_tags_complete`` tells if there are more).
+        Returns a list with a _Dict per repository, or None if the repository is not accessible.
+        """
+        if not repositories:
+            return []
+        variables = {}
+        arguments = []
+        selections = []
+        for i, (username, repository) in enumerate(repositories):
+            variables["o{}".format(i)] = username
+            variables["n{}".format(i)] = repository
+            arguments.append("$o{0}: String!, $n{0}: String!".format(i))
+            selections.append("r{0}: repository(owner: $o{0}, name: $n{0}) {{ {1} }}".format(
+                i, self._repository_fields % max_tags))
+
+        data = self.query("query({}) {{ {} }}".format(", ".join(arguments), " ".join(selections)), variables)
+        results = []
+        for i in range(len(repositories)):
+            info = data.get("r{}".format(i))
+            if info is None:
+                results.append(None)
+                continue
+            refs = info.refs or _Dict(nodes=[], pageInfo=_Dict(hasNextPage=False))
+            results.append(_Dict(
+                default_branch=info.defaultBranchRef.name if info.defaultBranchRef else None,
+                latest_release=info.latestRelease.tagName if info.latestRelease else None,
+                refs_tags=[_Dict(ref="refs/tags/" + node.name) for node in reversed(refs.nodes)],
+                refs_tags_complete=not refs.pageInfo.hasNextPage,
+            ))
+        return results
@@ -0,0 +1,197 @@
+import logging
+import socket
+import ssl
+import time
+from threading import Condition
+
+try:
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
+    from urllib.parse import urlparse, urljoin
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
+    # noinspection PyUnresolvedReferences
+    from urlparse import urlparse, urljoin
+
+USER_AGENT = "repository.github"
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+
+class PoolTimeoutError(Exception):
+    pass
+
+
+class _HostPool(object):
+    def __init__(self, max_connections):
+        self._max_connections = max_connections
+        self._idle = []
+        self._active = 0
+        self._condition = Condition()
+
+    def acquire(self, factory, timeout):
+        deadline = time.time() + timeout
+        with self._condition:
+            # Another waiter may take the released connection first, so wait until the deadline
+            while not self._idle and self._active >= self._max_connections:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolTimeoutError("Timed out waiting for a free connection")
+                self._condition.wait(remaining)
+            self._active += 1
+            if self._idle:
+                return self._idle.pop(), True
+        try:
+            return factory(), False
+        except Exception:
+            self.release(None)
+            raise
+
+    def release(self, connection):
+        with self._condition:
+            self._active -= 1
+            if connection is not None:
+                self._idle.append(connection)
+            self._condition.notify()
+
+    def close(self):
+        with self._condition:
+            while self._idle:
+                self._idle.pop().close()
+
+
+class HTTPConnectionPool(object):
+    """
+    Keep-alive HTTP/HTTPS client which reuses connections per host.
+
+    At most ``max_connections`` connections are open at the same time for each host. When all of them
+    are busy, callers wait up to ``pool_timeout`` seconds for one to be released.
+    """
+
+    def __init__(self, max_connections=10, timeout=30, pool_timeout=60, max_redirects=5, context=None):
+        self._max_connections = max_connections
+        self._timeout = timeout
+        self._pool_timeout = pool_timeout
+        self._max_redirects = max_redirects
+        self._context = context
+        self._pools = {}
+        self._condition = Condition()
+
+    def _host_pool(self, key):
+        with self._condition:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = self._pools[key] = _HostPool(self._max_connections)
+            return pool
+
+    def _connection_factory(self, scheme, host, port, timeout):
+        if scheme == "https":
+            if self._context is None:
+                self._context = ssl.create_default_context()
+            return lambda: HTTPSConnection(host, port, timeout=timeout, context=self._context)
+        return lambda: HTTPConnection(host, port, timeout=timeout)
+
+    def urlopen(self, method, url, body=None, headers=None, timeout=None):
+        headers = dict(headers) if headers else {}
+        headers.setdefault("User-Agent", USER_AGENT)
+        for _ in range(self._max_redirects + 1):
+            response = self._urlopen(method, url, body, headers, timeout)
+            location = response.getheader("Location")
+            if response.status not in REDIRECT_CODES or not location:
+                return response
+            response.close()
+
+            redirect_url = urljoin(url, location)
+            if urlparse(redirect_url).netloc != urlparse(url).netloc:
+                # Do not leak credentials to other hosts (e.g. signed asset URLs)
+                headers.pop("Authorization", None)
+            if response.status == 303 or (response.status in (301, 302) and method not in ("GET", "HEAD")):
+                method, body = "GET", None
+            logging.debug("Following HTTP %s redirect to %s", response.status, redirect_url)
+            url = redirect_url
+
+        raise HTTPException("Too many redirects for {}".format(url))
+
+    def _urlopen(self, method, url, body, headers, timeout):
+        parsed_url = urlparse(url)
+        scheme = parsed_url.scheme
+        port = parsed_url.port or (443 if scheme == "https" else 80)
+        host = parsed_url.hostname
+        path = parsed_url.path or "/"
+        if parsed_url.query:
+            path += "?" + parsed_url.query
+        if timeout is None:
+            timeout = self._timeout
+
+        pool = self._host_pool((scheme, host, port))
+        connection, reused = pool.acquire(self._connection_factory(scheme, host, port, timeout), self._pool_timeout)
+        try:
+            connection.timeout = timeout
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout)
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+            except (HTTPException, socket.error):
+                if not reused:
+                    raise
+                # The server may have closed an idle keep-alive connection, so retry with a new one
+                logging.debug("Reused connection to %s failed, retrying with a new connection", host)
+                connection.close()
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+        except Exception:
+            connection.close()
+            pool.release(None)
+            raise
+
+        return _PooledResponse(response, connection, pool, method)
+
+    def close(self):
+        with self._condition:
+            for pool in self._pools.values():
+                pool.close()
+            self._pools.clear()
+
+
+class _PooledResponse(object):
+    """
+    Wrapper of an HTTPResponse which releases the connection back to its pool when closed.
+    The connection is only reused if the response body was fully read.
+    """
+
+    def __init__(self, response, connection, pool, method):
+        self._response = response
+        self._connection = connection
+        self._pool = pool
+        if method == "HEAD" or response.status in (204, 304) or response.getheader("Content-Length") == "0":
+            # Nothing to read, so the connection can already be reused
+            response.read()
+
+    @property
+    def status(self):
+        return self._response.status
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def read(self, *args):
+        return self._response.read(*args)
+
+    def info(self):
+        return self._response.msg
+
+    def getcode(self):
+        return self._response.status
+
+    def close(self):
+        if self._connection is None:
+            return
+        connection, self._connection = self._connection, None
+        reusable = self._response.isclosed() and not self._response.will_close
+        self._response.close()
+        if not reusable:
+            connection.close()
+        self._pool.release(connection if reusable else None)
+
+
+default_pool = HTTPConnectionPool()
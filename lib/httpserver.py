@@ -2,7 +2,8 @@
 
 import logging
 import re
-from shutil import copyfileobj
+import time
+from threading import Lock
 
 try:
     import urlparse
@@ -13,51 +14,169 @@ except ImportError:
     from socketserver import ThreadingMixIn
     from http.server import BaseHTTPRequestHandler, HTTPServer
 
-from lib.utils import str_to_bytes
+from lib.metrics import default_registry
+from lib.timing import Timings, request_timings, timed
+from lib.utils import ByteRange, str_to_bytes, remove_prefix
+
+_requests = default_registry.counter(
+    "http_requests_total", "HTTP requests handled, by route and status code", ("route", "code"))
+_request_duration = default_registry.histogram(
+    "http_request_duration_seconds", "Time spent handling HTTP requests (including the body), by route", ("route",))
+_response_bytes = default_registry.counter(
+    "http_response_bytes_total", "Bytes sent on HTTP response bodies, by route", ("route",))
+active_connections = default_registry.gauge("http_active_connections", "Open client connections")
+active_connections.set(0)
+
+
+class Router(object):
+    """
+    Maps request paths to handlers. Static paths are looked up on a dict, while parameterized
+    routes are matched all at once, using a single regex which combines all of them (in the order
+    they were added). Static routes take precedence over parameterized ones.
+    """
+
+    def __init__(self):
+        self._static = {}
+        self._patterns = []
+        self._compiled = None
+        self._lock = Lock()
+
+    def add_static(self, path, handler):
+        with self._lock:
+            self._static.setdefault(path, handler)
+
+    def add_pattern(self, pattern, handler):
+        """
+        Add a route for the (unanchored) regex ``pattern``, whose groups are passed to ``handler``.
+        """
+        with self._lock:
+            self._patterns.append((pattern, re.compile(pattern).groups, handler))
+            self._compiled = None
+
+    def _compile(self):
+        parts = []
+        routes = []
+        index = 1
+        for i, (pattern, groups, handler) in enumerate(self._patterns):
+            # The route group is the last one to close, so it is the match lastgroup
+            parts.append("(?P<_{}>{})".format(i, pattern))
+            routes.append((index, groups, handler))
+            index += groups + 1
+        return re.compile("(?:{})$".format("|".join(parts))), routes
+
+    def resolve(self, path):
+        """
+        Get the handler for ``path`` and the arguments to call it with, or (None, ()) if there is none.
+        """
+        handler = self._static.get(path)
+        if handler is not None:
+            return handler, ()
+        compiled = self._compiled
+        if compiled is None:
+            with self._lock:
+                compiled = self._compiled = self._compile()
+        regex, routes = compiled
+        match = regex.match(path)
+        if match is None:
+            return None, ()
+        index, groups, handler = routes[int(match.lastgroup[1:])]
+        return handler, match.groups()[index:index + groups]
 
 
 class HTTPRequestHandler(BaseHTTPRequestHandler, object):
     protocol_version = "HTTP/1.1"
-    get_routes = []
+    # Headers and body are written separately, which would otherwise be delayed on keep-alive connections
+    disable_nagle_algorithm = True
+    get_routes = Router()
 
     url_clean_regex = ((re.compile(r"\\"), "/"), (re.compile(r"/{2,}"), "/"))
     url_placeholders_patterns = ((re.escape("{w}"), "([^/]+)"), (re.escape("{p}"), "(.+)"))
+    forwarded_response_headers = ("Content-Range", "Accept-Ranges", "ETag", "Last-Modified")
+    profile_name_regex = re.compile(r"[^\w.-]+")
+    # Set to a lib.timing.SamplingProfiler to profile a sample of the requests
+    profiler = None
+    _bytes_sent = 0
+    _timings = None
 
     @classmethod
     def add_get_route(cls, pattern, handle):
-        cls.get_routes.append((cls.generate_pattern(pattern), handle))
+        """
+        Add a route for GET (and HEAD) requests. Routes without placeholders are static.
+        """
+        path = cls.clean_path(pattern)
+        if any(p in path for p in ("{w}", "{p}")):
+            cls.get_routes.add_pattern(cls.generate_pattern(path), handle)
+        else:
+            cls.get_routes.add_static(path, handle)
 
     @classmethod
     def generate_pattern(cls, s):
-        pattern = s
-        for regex, repl in cls.url_clean_regex:
-            pattern = regex.sub(repl, pattern)
-        pattern = re.escape(pattern)
+        pattern = re.escape(cls.clean_path(s))
         for p in cls.url_placeholders_patterns:
             pattern = pattern.replace(*p)
-        return re.compile(pattern + "$")
+        return pattern
+
+    @classmethod
+    def clean_path(cls, path):
+        # Most paths are already clean, so avoid the substitutions
+        if "\\" in path or "//" in path:
+            for regex, repl in cls.url_clean_regex:
+                path = regex.sub(repl, path)
+        return path
+
+    @property
+    def is_head(self):
+        return self.command == "HEAD"
+
+    def setup(self):
+        super(HTTPRequestHandler, self).setup()
+        active_connections.inc()
+
+    def finish(self):
+        try:
+            super(HTTPRequestHandler, self).finish()
+        finally:
+            active_connections.dec()
 
     # noinspection PyPep8Naming
     def do_GET(self):
         self._handle_request(self.get_routes)
 
+    # noinspection PyPep8Naming
+    def do_HEAD(self):
+        # Handlers are the same as for GET, but bodies are not sent (see is_head)
+        self._handle_request(self.get_routes)
+
     def _handle_request(self, routes):
         self._response_started = False
+        self._request_started = time.time()
+        self._route = "none"
+        self._status_code = None
+        self._bytes_sent = 0
+        self._timings = Timings()
         try:
-            self.url = urlparse.urlparse(self.path)
-            self.query = dict(urlparse.parse_qsl(self.url.query))
+            with request_timings(self._timings):
+                if self.profiler is None:
+                    self._dispatch(routes)
+                else:
+                    name = self.profile_name_regex.sub("_", self.path).strip("_")[:64] or "root"
+                    with self.profiler.profile(name):
+                        self._dispatch(routes)
+        finally:
+            self._record_request()
 
-            self.url_path = self.url.path
-            for r, s in self.url_clean_regex:
-                self.url_path = r.sub(s, self.url_path)
+    def _dispatch(self, routes):
+        try:
+            self.url = urlparse.urlparse(self.path)
+            self.query = dict(urlparse.parse_qsl(self.url.query)) if self.url.query else {}
+            self.url_path = self.clean_path(self.url.path)
 
-            for pattern, handler in routes:
-                match = pattern.match(self.url_path)
-                if match:
-                    handler(self, *match.groups())
-                    break
-            else:
+            handler, args = routes.resolve(self.url_path)
+            if handler is None:
                 self.send_response_and_end(404)
+            else:
+                self._route = handler.__name__
+                handler(self, *args)
         except Exception as e:
             if self._response_started:
                 raise e
@@ -65,24 +184,87 @@ class HTTPRequestHandler(BaseHTTPRequestHandler, object):
                 logging.error(e, exc_info=True)
                 self.send_response_and_end(500)
 
-    def send_response(self, *args, **kwargs):
+    def _record_request(self):
+        duration = time.time() - self._request_started
+        _requests.inc(route=self._route, code=self._status_code or "none")
+        _request_duration.observe(duration, route=self._route)
+        _response_bytes.inc(self._bytes_sent, route=self._route)
+        logging.debug("request method=%s path=%s route=%s status=%s bytes=%d duration_ms=%.1f%s",
+                      self.command, self.path, self._route, self._status_code, self._bytes_sent, duration * 1000,
+                      "".join(" {}_ms={:.1f}".format(n, d * 1000) for n, d in self._timings.items()))
+
+    def send_response(self, code, message=None):
         # noinspection PyAttributeOutsideInit
         self._response_started = True
-        super(HTTPRequestHandler, self).send_response(*args, **kwargs)
+        # noinspection PyAttributeOutsideInit
+        self._status_code = code
+        super(HTTPRequestHandler, self).send_response(code, message=message)
+
+    def end_headers(self):
+        # The body transfer is not known yet, so it is only included on the request log line
+        if self._timings is not None:
+            server_timing = self._timings.server_timing()
+            self.send_header("Server-Timing", "{}app;dur={:.1f}".format(
+                server_timing + ", " if server_timing else "", (time.time() - self._request_started) * 1000))
+        super(HTTPRequestHandler, self).end_headers()
 
     def log_message(self, fmt, *args):
         logging.debug(fmt, *args)
 
-    def send_response_with_data(self, data, content_type, code=200):
+    def send_response_with_data(self, data, content_type, code=200, headers=None):
         self.send_response(code)
         self.send_header("Content-Type", content_type)
         self.send_header("Content-Length", str(len(data)))
+        self._send_headers(headers)
         self.end_headers()
-        self.wfile.write(data)
+        if not self.is_head:
+            with timed("send"):
+                self._write_body(data)
+
+    def send_not_modified(self, headers=None):
+        self.send_response(304)
+        self._send_headers(headers)
+        self.end_headers()
+
+    def _send_headers(self, headers):
+        if headers:
+            for name, value in headers.items():
+                self.send_header(name, value)
+
+    def etag_matches(self, *etags):
+        """
+        Check if any of ``etags`` matches the request If-None-Match header (using weak comparison).
+        """
+        value = self.headers.get("If-None-Match")
+        if not value:
+            return False
+        for tag in value.split(","):
+            tag = tag.strip()
+            if tag == "*" or remove_prefix(tag, "W/") in etags:
+                return True
+        return False
+
+    def accepts_encoding(self, encoding):
+        value = self.headers.get("Accept-Encoding")
+        if not value:
+            return False
+        for coding in value.split(","):
+            params = coding.strip().split(";")
+            if params[0].strip().lower() in (encoding, "*"):
+                for param in params[1:]:
+                    name, _, q = param.strip().partition("=")
+                    if name.strip() == "q":
+                        try:
+                            return float(q) > 0
+                        except ValueError:
+                            return False
+                return True
+        return False
 
-    def send_response_and_end(self, code, message=None):
+    def send_response_and_end(self, code, message=None, headers=None):
         self.send_response(code, message=message)
         self.send_header("Content-Length", "0")
+        self._send_headers(headers)
         self.end_headers()
 
     def send_redirect(self, url, code=301):
@@ -92,27 +274,66 @@ class HTTPRequestHandler(BaseHTTPRequestHandler, object):
         self.end_headers()
 
     def send_file_contents(self, fp, code, length=None, content_type=None,
-                           content_disposition=None, chunked=True):
+                           content_disposition=None, chunked=True, headers=None):
+        chunked = self._send_file_headers(code, length, content_type, content_disposition, chunked, headers)
+        if self.is_head:
+            return
+        with timed("send"):
+            if chunked:
+                self._send_chunked(fp)
+            else:
+                self._send_raw(fp)
+
+    def stream_response(self, response):
+        """
+        Send an upstream response (lib.utils.Response) to the client. The response is closed once sent.
+        """
+        with response:
+            self.send_file_contents(
+                response.raw, response.status_code,
+                length=response.headers.get("Content-Length"),
+                content_type=response.headers.get("Content-Type"),
+                content_disposition=response.headers.get("Content-Disposition"),
+                headers=self.forwarded_headers(response))
+
+    def forwarded_headers(self, response):
+        return {h: response.headers.get(h) for h in self.forwarded_response_headers if response.headers.get(h)}
+
+    def get_range(self):
+        return ByteRange.parse(self.headers.get("Range"))
+
+    def _send_file_headers(self, code, length, content_type, content_disposition, chunked, headers=None):
         self.send_response(code)
 
         if content_type:
             self.send_header("Content-Type", content_type)
         if content_disposition:
             self.send_header("Content-Disposition", content_disposition)
+        self._send_headers(headers)
         if length:
             self.send_header("Content-Length", length)
             chunked = False
+        elif self.is_head:
+            # The length is not known, but there is no body either, so the connection can be kept alive
+            chunked = False
         else:
             if chunked:
                 self.send_header("Transfer-Encoding", "chunked")
             self.send_header("Connection", "close")
 
         self.end_headers()
+        return chunked
 
-        if chunked:
-            self._send_chunked(fp)
-        else:
-            copyfileobj(fp, self.wfile)
+    def _write_body(self, data):
+        self.wfile.write(data)
+        self._bytes_sent += len(data)
+
+    def _send_raw(self, fp, chunk_size=16 * 1024):
+        while True:
+            buf = fp.read(chunk_size)
+            if not buf:
+                break
+            self._write_body(buf)
 
     def _send_chunked(self, fp, chunk_size=16 * 1024):
         while True:
@@ -120,11 +341,14 @@ class HTTPRequestHandler(BaseHTTPRequestHandler, object):
             if not buf:
                 self.wfile.write(b"0\r\n\r\n")
                 break
-            self.wfile.write(str_to_bytes(format(len(buf), "x")))
-            self.wfile.write(b"\r\n")
-            self.wfile.write(buf)
+            self.wfile.write(self.chunk_header(buf))
+            self._write_body(buf)
             self.wfile.write(b"\r\n")
 
+    @staticmethod
+    def chunk_header(buf):
+        return str_to_bytes(format(len(buf), "x")) + b"\r\n"
+
 
 class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
     """
@@ -137,6 +361,21 @@ def threaded_http_server(host, port):
     return ThreadedHTTPServer((host, port), HTTPRequestHandler)
 
 
+ENGINE_THREADED = "threaded"
+ENGINE_ASYNCIO = "asyncio"
+ENGINES = (ENGINE_THREADED, ENGINE_ASYNCIO)
+
+
+def create_http_server(host, port, engine=ENGINE_THREADED):
+    if engine == ENGINE_THREADED:
+        return threaded_http_server(host, port)
+    elif engine == ENGINE_ASYNCIO:
+        # Only available on python 3
+        from lib.asyncserver import async_http_server
+        return async_http_server(host, port)
+    raise ValueError("Unknown server engine: {}".format(engine))
+
+
 def add_get_route(pattern):
     def wrapper(func):
         HTTPRequestHandler.add_get_route(pattern, func)
@@ -33,6 +33,18 @@ def get_repository_port():
     return int(ADDON.getSetting("repository_port"))
 
 
+def get_cache_size():
+    return int(ADDON.getSetting("cache_size")) * 1024 * 1024
+
+
+def get_fetch_strategy():
+    return ADDON.getSetting("fetch_strategy")
+
+
+def get_graphql():
+    return ADDON.getSetting("graphql") == "true"
+
+
 class KodiLogHandler(logging.Handler):
     levels = {
         logging.CRITICAL: xbmc.LOGFATAL,
@@ -0,0 +1,153 @@
+"""
+Minimal metrics registry, exposed using the Prometheus text format (version 0.0.4).
+"""
+
+from bisect import bisect_left
+from collections import OrderedDict
+from threading import Lock
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace("\"", "\\\"")
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if value == float("inf"):
+            return "+Inf"
+        return repr(value)
+    return str(value)
+
+
+class _Metric(object):
+    type = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = OrderedDict()
+        self._lock = Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError("Expected labels {} for metric {}".format(self.label_names, self.name))
+        return tuple(str(labels[n]) for n in self.label_names)
+
+    def samples(self):
+        """
+        Get a list of (name, label pairs, value) samples.
+        """
+        with self._lock:
+            return [(self.name, tuple(zip(self.label_names, k)), v) for k, v in self._values.items()]
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} {}".format(self.name, self.type)]
+        for name, labels, value in self.samples():
+            if labels:
+                name += "{" + ",".join("{}=\"{}\"".format(k, _escape(v)) for k, v in labels) + "}"
+            lines.append("{} {}".format(name, _format_value(value)))
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def dec(self, value=1, **labels):
+        self.inc(-value, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                # Per bucket (non cumulative) counts, followed by the +Inf bucket count and the sum
+                values = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            values[bisect_left(self.buckets, value)] += 1
+            values[-1] += value
+
+    def samples(self):
+        samples = []
+        for _, labels, values in super(Histogram, self).samples():
+            count = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), values[:-1]):
+                count += bucket_count
+                samples.append((self.name + "_bucket", labels + (("le", _format_value(float(bound))),), count))
+            samples.append((self.name + "_sum", labels, values[-1]))
+            samples.append((self.name + "_count", labels, count))
+        return samples
+
+
+class MetricsRegistry(object):
+    """
+    Registry of metrics. Besides the registered metrics, ``collectors`` (callables which return
+    a list of metrics) are called on each render, for values which are only read when needed.
+    """
+
+    def __init__(self):
+        self._metrics = OrderedDict()
+        self._collectors = []
+        self._lock = Lock()
+
+    def _register(self, metric_class, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = metric_class(name, *args, **kwargs)
+            elif not isinstance(metric, metric_class):
+                raise ValueError("Metric {} is already registered as {}".format(name, metric.type))
+            return metric
+
+    def counter(self, name, documentation, label_names=()):
+        return self._register(Counter, name, documentation, label_names)
+
+    def gauge(self, name, documentation, label_names=()):
+        return self._register(Gauge, name, documentation, label_names)
+
+    def histogram(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, documentation, label_names, buckets=buckets)
+
+    def add_collector(self, collector):
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+        for collector in collectors:
+            metrics.extend(collector())
+        return ("\n".join(m.render() for m in metrics) + "\n").encode("utf-8")
+
+
+default_registry = MetricsRegistry()
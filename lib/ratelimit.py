@@ -0,0 +1,185 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from hashlib import sha1
+
+from lib.utils import str_to_bytes
+
+PRIORITY_HIGH = 0
+PRIORITY_LOW = 1
+
+RESOURCE_CORE = "core"
+RESOURCE_GRAPHQL = "graphql"
+
+_local = threading.local()
+
+
+def get_priority():
+    return getattr(_local, "priority", PRIORITY_HIGH)
+
+
+@contextmanager
+def request_priority(priority):
+    """
+    Set the priority of the GitHub calls done by the current thread (e.g. PRIORITY_LOW for background refreshes).
+    """
+    previous = get_priority()
+    _local.priority = priority
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+def propagate_priority(func):
+    """
+    Wrap ``func`` so that it runs with the priority of the current thread (e.g. when submitted to a thread pool).
+    """
+    priority = get_priority()
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with request_priority(priority):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+class PriorityExecutor(object):
+    """
+    Wrap ``executor`` so that calls submitted to it run with the priority of the thread submitting them.
+    """
+
+    def __init__(self, executor):
+        self._executor = executor
+
+    def submit(self, func, *args, **kwargs):
+        return self._executor.submit(propagate_priority(func), *args, **kwargs)
+
+    def map(self, func, *iterables):
+        return self._executor.map(propagate_priority(func), *iterables)
+
+
+class RateLimitExceeded(Exception):
+    def __init__(self, message, reset=None):
+        super(RateLimitExceeded, self).__init__(message)
+        self.reset = reset
+
+
+class _Budget(object):
+    __slots__ = ["limit", "remaining", "reset", "blocked_until"]
+
+    def __init__(self):
+        self.limit = None
+        self.remaining = None
+        self.reset = None
+        self.blocked_until = None
+
+
+class RateLimiter(object):
+    """
+    Tracks the GitHub rate limit budget of each token (and resource), as reported by the
+    X-RateLimit-* and Retry-After response headers.
+
+    Calls which are known to fail are refused beforehand. Low priority calls are also deferred
+    when the remaining budget is below ``reserve`` (a fraction of the limit), so that it is
+    kept for user-facing requests. Deferred (or blocked) low priority calls wait until the budget
+    is reset, if that happens within ``max_delay`` seconds, and are refused otherwise.
+    """
+
+    def __init__(self, reserve=0.2, max_delay=60):
+        self._reserve = reserve
+        self._max_delay = max_delay
+        self._budgets = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def token_id(token):
+        # Avoid keeping/exposing the token itself
+        return sha1(str_to_bytes(token)).hexdigest()[:8] if token else "anonymous"
+
+    def _budget(self, token, resource):
+        key = (self.token_id(token), resource)
+        budget = self._budgets.get(key)
+        if budget is None:
+            budget = self._budgets[key] = _Budget()
+        return budget
+
+    def acquire(self, token, resource=RESOURCE_CORE, priority=None):
+        if priority is None:
+            priority = get_priority()
+        deadline = time.time() + self._max_delay
+        while True:
+            try:
+                return self._acquire(token, resource, priority)
+            except RateLimitExceeded as e:
+                # User-facing calls are not delayed, as cached data can be served instead
+                if priority == PRIORITY_HIGH or e.reset is None or e.reset > deadline:
+                    raise
+                delay = max(0, e.reset - time.time())
+                logging.debug("Delaying low priority call for %.1f seconds: %s", delay, e)
+                time.sleep(delay)
+
+    def _acquire(self, token, resource, priority):
+        now = time.time()
+        with self._lock:
+            budget = self._budget(token, resource)
+            if budget.blocked_until is not None:
+                if now < budget.blocked_until:
+                    raise RateLimitExceeded("Rate limited until {}".format(budget.blocked_until), budget.blocked_until)
+                budget.blocked_until = None
+            if budget.remaining is None:
+                return
+            if budget.reset is not None and now >= budget.reset:
+                # The rate limit window was reset, so the budget is unknown until the next response
+                budget.remaining = budget.reset = None
+                return
+            if budget.remaining <= 0:
+                raise RateLimitExceeded("Rate limit exhausted until {}".format(budget.reset), budget.reset)
+            if priority != PRIORITY_HIGH and budget.limit and budget.remaining <= budget.limit * self._reserve:
+                raise RateLimitExceeded("Deferring low priority call, remaining budget is reserved", budget.reset)
+            # Account for this call until the response updates the budget
+            budget.remaining -= 1
+
+    def update(self, token, response, resource=RESOURCE_CORE):
+        """
+        Update the budget with the response headers. Returns True if ``response`` was rejected due to rate limiting.
+        """
+        headers = response.headers
+        resource = headers.get("X-RateLimit-Resource") or resource
+        remaining = headers.get("X-RateLimit-Remaining")
+        retry_after = headers.get("Retry-After")
+        with self._lock:
+            budget = self._budget(token, resource)
+            if remaining is not None:
+                try:
+                    budget.remaining = int(remaining)
+                    budget.limit = int(headers.get("X-RateLimit-Limit") or 0) or budget.limit
+                    budget.reset = int(headers.get("X-RateLimit-Reset") or 0) or None
+                except ValueError:
+                    pass
+
+            limited = False
+            if response.status_code in (403, 429):
+                if retry_after is not None and retry_after.isdigit():
+                    budget.blocked_until = time.time() + int(retry_after)
+                    limited = True
+                elif budget.remaining == 0 and remaining is not None:
+                    budget.blocked_until = budget.reset
+                    limited = True
+            if limited:
+                logging.warning("GitHub rate limit reached (resource=%s), blocked until %s",
+                                resource, budget.blocked_until)
+            return limited
+
+    def budgets(self):
+        """
+        Get a dict of the last observed budgets, as (token_id, resource) -> (limit, remaining, reset).
+        """
+        with self._lock:
+            return {k: (b.limit, b.remaining, b.reset) for k, b in self._budgets.items()}
+
+
+default_rate_limiter = RateLimiter()
@@ -1,18 +1,35 @@
 import json
 import logging
+import os
 import re
+import time
+import zlib
 from collections import namedtuple, OrderedDict
 from concurrent.futures import ThreadPoolExecutor
-from hashlib import md5
-from xml.etree import ElementTree  # nosec
-
-from lib.cache import LoadingCache
-from lib.github import GitHubRepositoryApi, GitHubApiError
-from lib.utils import string_types, is_http_like, request, remove_prefix
-from lib.version import try_parse_version
-
+from hashlib import md5, sha1
+from io import BytesIO
+from threading import Lock
+
+from lib.cache import LoadingCache, BlobCache
+from lib.github import GitHubRepositoryApi, GitHubCdnApi, GitHubGraphQLApi, GitHubApiError, GitHubTransientError, \
+    GitHubNotModifiedError
+from lib.ratelimit import PriorityExecutor
+from lib.tags import TagIndex, literal_prefix
+from lib.timing import timed
+from lib.utils import string_types, is_http_like, request, xml_fragment, Response, RawResponse
+from lib.zipstream import ZipRerooter
+
+FETCH_API = "api"
+FETCH_CDN = "cdn"
+FETCH_CDN_FALLBACK = "cdn_fallback"
+FETCH_STRATEGIES = (FETCH_API, FETCH_CDN, FETCH_CDN_FALLBACK)
+
+Source = namedtuple("Source", ("validators", "digest", "addons"))
+AddonsXml = namedtuple("AddonsXml", ("content", "md5", "etag", "gzip", "gzip_etag"))
+AddonsXmlState = namedtuple("AddonsXmlState", ("addons", "version", "expires", "fragments", "document"))
 Addon = namedtuple("Addon", (
-    "id", "username", "branch", "assets", "asset_prefix", "repository", "tag_pattern", "token", "platforms"))
+    "id", "username", "branch", "assets", "asset_prefix", "repository", "tag_pattern", "token", "platforms",
+    "fetch_strategy"))
 EntrySchema = namedtuple("EntrySchema", ("required", "validators"))
 
 
@@ -52,6 +69,11 @@ def validate_string_list(key, value):
         raise InvalidSchemaError("Expected list[str] for '{}'".format(key))
 
 
+def validate_fetch_strategy(key, value):
+    if value not in FETCH_STRATEGIES:
+        raise InvalidSchemaError("Expected one of {} for '{}'".format(", ".join(FETCH_STRATEGIES), key))
+
+
 _entry_schema = EntrySchema(required=("id", "username"), validators=dict(
     id=validate_string,
     username=validate_string,
@@ -62,6 +84,7 @@ _entry_schema = EntrySchema(required=("id", "username"), validators=dict(
     tag_pattern=validate_string,
     token=validate_string,
     platforms=validate_string_list,
+    fetch_strategy=validate_fetch_strategy,
 ))
 
 
@@ -85,38 +108,32 @@ def validate_schema(data):
         validate_entry_schema(entry)
 
 
-class TagMatchPredicate(object):
-    def __init__(self, version, tag_pattern=None):
-        self._version = version
-        self._tag_pattern = tag_pattern
-        self._tag_group = tag_pattern.groupindex.get("version", 1) if tag_pattern and tag_pattern.groups else None
-        self._parsed_version = try_parse_version(version)
-
-    def __call__(self, value):
-        if self._tag_pattern:
-            match = self._tag_pattern.match(value)
-            if not match:
-                return False
-            elif self._tag_group:
-                value = match.group(self._tag_group)
-
-        return value == self._version or (
-                self._parsed_version and self._parsed_version == try_parse_version(value))
-
-
 class Repository(object):
     ZIP_EXTENSION = ".zip"
     VERSION_SEPARATOR = "-"
     RELEASE_ASSET_PREFIX = "release_asset://"
+    ZIPBALL_ASSET = "zipball"
+    ADDONS_XML_HEADER = b"<?xml version='1.0' encoding='utf-8'?>\n"
+    _commit_sha_re = re.compile(r"^[0-9a-f]{40}$")
 
     def __init__(self, files=(), urls=(), max_threads=5, platform=None,
-                 cache_ttl=60 * 60, default_branch="main", token=None):
+                 cache_ttl=60 * 60, default_branch="main", token=None,
+                 cache_dir=None, cache_size=256 * 1024 * 1024, api_url="https://api.github.com",
+                 graphql=False, graphql_batch_size=50, fetch_strategy=FETCH_API,
+                 raw_url="https://raw.githubusercontent.com", codeload_url="https://codeload.github.com"):
         self.files = files
         self.urls = urls
         self._max_threads = max_threads
         self._default_branch = default_branch
         self._token = token
+        self._api_url = api_url
+        self._graphql = graphql
+        self._graphql_batch_size = graphql_batch_size
+        self._fetch_strategy = fetch_strategy or FETCH_API
+        self._raw_url = raw_url
+        self._codeload_url = codeload_url
         self._addons = OrderedDict()
+        self._sources = {}
 
         if platform is None:
             from lib.platform.core import PLATFORM
@@ -124,32 +141,84 @@ class Repository(object):
         else:
             self._platform = platform
 
-        self._addons_xml_cache = LoadingCache(self._get_addons_xml, cache_ttl)
-        self._fallback_ref_cache = LoadingCache(self._get_fallback_ref, cache_ttl)
-        self._refs_tags_cache = LoadingCache(self._get_refs_tags, cache_ttl)
+        # Shared by all requests and refreshes, so that threads are not created for every addons.xml assembly
+        self._executor = PriorityExecutor(ThreadPoolExecutor(max_threads)) if max_threads > 1 else None
+        self._addon_xml_cache = LoadingCache(
+            self._get_addon_xml_fragment, cache_ttl, max_size=None, stale_while_revalidate=True,
+            executor=self._executor)
+        self._addons_xml = None  # type: AddonsXmlState
+        self._addons_xml_lock = Lock()
+        self._fallback_ref_cache = LoadingCache(
+            self._get_fallback_ref, cache_ttl, max_size=None, stale_while_revalidate=True, executor=self._executor)
+        self._refs_tags_cache = LoadingCache(
+            self._get_refs_tags, cache_ttl, max_size=None, stale_while_revalidate=True, executor=self._executor)
+        self._blob_cache = BlobCache(cache_dir, max_bytes=cache_size, ttl_seconds=cache_ttl) if cache_dir else None
         self.update()
 
     def update(self, clear=False):
+        """
+        Reload the add-on entries from ``urls`` and ``files``. Sources which did not change since the last
+        update (same modification time/size, validators or content digest) are not parsed again, unless
+        ``clear`` is set. Only the cached data of add-ons which were added, changed or removed is invalidated.
+        Returns the ids of those add-ons.
+        """
         logging.debug("Updating repository (clear=%s)", clear)
         if clear:
-            self._addons.clear()
+            self._sources.clear()
+        addons = OrderedDict()
         for u in self.urls:
-            self._load_url(u)
+            addons.update(self._load_url(u))
         for f in self.files:
-            self._load_file(f)
+            addons.update(self._load_file(f))
+
+        previous_addons, self._addons = self._addons, addons
+        changed = [addon_id for addon_id in set(previous_addons).union(addons)
+                   if previous_addons.get(addon_id) != addons.get(addon_id)]
+        for addon_id in changed:
+            self._invalidate_addon(addon_id, previous_addons.get(addon_id))
+        if changed:
+            logging.debug("Updated addons: %s", ", ".join(sorted(changed)))
+        return changed
 
     def _load_file(self, path):
-        with open(path) as f:
-            self._load_data(json.load(f))
+        stat = os.stat(path)
+        validators = (stat.st_mtime, stat.st_size)
+        source = self._sources.get(path)
+        if source is not None and source.validators == validators:
+            return source.addons
+        with open(path, "rb") as f:
+            return self._load_source(path, validators, f.read())
 
     def _load_url(self, url):
-        with request(url) as r:
+        source = self._sources.get(url)
+        headers = {}
+        if source is not None:
+            etag, last_modified = source.validators
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        with request(url, headers=headers) as r:
+            if r.status_code == 304 and source is not None:
+                return source.addons
             r.raise_for_status()
-            self._load_data(r.json())
+            return self._load_source(url, (r.headers.get("ETag"), r.headers.get("Last-Modified")), r.content)
+
+    def _load_source(self, name, validators, content):
+        digest = sha1(content).hexdigest()
+        source = self._sources.get(name)
+        if source is None or source.digest != digest:
+            logging.debug("Loading entries from %s", name)
+            addons = self._parse_addons(json.loads(content.decode("utf-8")))
+        else:
+            addons = source.addons
+        self._sources[name] = Source(validators, digest, addons)
+        return addons
 
-    def _load_data(self, data):
+    def _parse_addons(self, data):
         validate_schema(data)
         platform_name = self._platform.name()
+        addons = OrderedDict()
         for addon_data in data:
             addon_id = addon_data["id"]
             platforms = addon_data.get("platforms")
@@ -159,7 +228,7 @@ class Repository(object):
                 logging.debug("Skipping addon %s as it does not support platform %s", addon_id, platform_name)
                 continue
 
-            self._addons[addon_id] = Addon(
+            addons[addon_id] = Addon(
                 id=addon_id,
                 username=addon_data["username"],
                 branch=addon_data.get("branch"),
@@ -169,59 +238,131 @@ class Repository(object):
                 tag_pattern=re.compile(tag_pattern) if tag_pattern else None,
                 token=addon_data.get("token"),
                 platforms=platforms,
+                fetch_strategy=addon_data.get("fetch_strategy"),
             )
+        return addons
+
+    def _invalidate_addon(self, addon_id, previous_addon=None):
+        self._addon_xml_cache.invalidate(addon_id)
+        if previous_addon is not None:
+            repo = self._get_repository_api(previous_addon)
+            self._fallback_ref_cache.invalidate(repo, tag_pattern=previous_addon.tag_pattern)
+            self._refs_tags_cache.invalidate(repo, literal_prefix(previous_addon.tag_pattern))
 
     def clear_cache(self):
         logging.debug("Clearing repository cache")
-        self._addons_xml_cache.clear()
+        self._addon_xml_cache.clear()
         self._fallback_ref_cache.clear()
         self._refs_tags_cache.clear()
 
-    def _get_addon_xml(self, addon):
-        with self._get_asset(addon, "addon.xml") as r:
+    def refresh_ahead(self, margin, jitter=0.0):
+        """
+        Refresh the cached entries which expire within ``margin`` seconds and (re)build addons.xml,
+        so that requests are always served from warm data. Refs are refreshed before the add-on
+        fragments, as the latter depend on them.
+        """
+        refreshed = 0
+        for cache in (self._refs_tags_cache, self._fallback_ref_cache, self._addon_xml_cache):
+            refreshed += cache.refresh_expiring(margin, jitter=jitter)
+        self.get_addons_xml_document()
+        return refreshed
+
+    def get_cache_stats(self):
+        return OrderedDict((
+            ("addon_xml", self._addon_xml_cache.stats()),
+            ("fallback_ref", self._fallback_ref_cache.stats()),
+            ("refs_tags", self._refs_tags_cache.stats()),
+        ))
+
+    def _get_addon_xml(self, addon, revalidate=False):
+        with self._get_asset(addon, "addon.xml", revalidate=revalidate) as r:
             r.raise_for_status()
-            addon_xml = r.content
+            return r.content
 
+    def _get_addon_xml_fragment(self, addon_id):
+        # Reloads (e.g. refreshes) must check addon.xml upstream, as its cached blob is about as old as the
+        # fragment. Otherwise, the blob would be reused (and the fragment kept) for up to another TTL
+        revalidate = self._addon_xml_cache.stored(addon_id)
+        addon = self._addons.get(addon_id)
+        if addon is None:
+            # Removed by an update while being loaded (its cached entry is invalidated by the update)
+            return None
+        # The document is only validated, and its raw bytes (without the XML declaration) are used as is
         try:
-            return ElementTree.fromstring(addon_xml)
-        except Exception as e:
-            logging.error("Failed getting '%s' addon XML: %s", addon.id, e, exc_info=True)
+            return xml_fragment(self._get_addon_xml(addon, revalidate=revalidate), root_tag="addon")
+        except ValueError as e:
+            logging.error("Failed getting '%s' addon XML: %s", addon_id, e)
             return None
 
-    def _get_addons_xml(self):
-        root = ElementTree.Element("addons")
-        num_threads = min(self._max_threads, len(self._addons))
-        if num_threads <= 1:
-            results = map(self._get_addon_xml, self._addons.values())
-        else:
-            with ThreadPoolExecutor(num_threads) as pool:
-                futures = [pool.submit(self._get_addon_xml, addon) for addon in self._addons.values()]
-                results = map(lambda f: f.result(), futures)
-
-        for result in results:
-            if result is not None:
-                root.append(result)
+    def _get_addons_xml_fragments(self, addons):
+        cache = self._addon_xml_cache
+        # Only missing fragments need to be loaded (expired ones are refreshed in background)
+        missing = [addon_id for addon_id in addons if not cache.stored(addon_id)]
+        if len(missing) > 1 and self._executor is not None:
+            for _ in self._executor.map(cache.get, missing):
+                pass
+        return tuple(map(cache.get, addons))
+
+    def get_addons_xml_document(self):
+        # Each fragment is cached (and refreshed) on its own, so the document can be reused as long as
+        # no fragment is changed or expires, and only needs to be assembled again when any of these changes
+        addons = self._addons
+        version, expires = self._addon_xml_cache.version, self._addon_xml_cache.next_expiry()
+        state = self._addons_xml
+        if state is not None and state.addons is addons and state.version == version and (
+                state.expires is None or time.time() < state.expires):
+            return state.document
+
+        if self._graphql:
+            with timed("prefetch"):
+                self._prefetch_metadata()
+        with timed("fragments"):
+            fragments = self._get_addons_xml_fragments(addons)
+        with self._addons_xml_lock:
+            state = self._addons_xml
+            if state is not None and len(fragments) == len(state.fragments) and all(
+                    a is b for a, b in zip(fragments, state.fragments)):
+                addons_xml = state.document
+            else:
+                logging.debug("Assembling addons.xml from %d fragments", len(fragments))
+                addons_xml = self._make_addons_xml(self.ADDONS_XML_HEADER + b"<addons>" + b"".join(
+                    f for f in fragments if f is not None) + b"</addons>")
+            self._addons_xml = AddonsXmlState(addons, version, expires, fragments, addons_xml)
+        return addons_xml
 
-        return ElementTree.tostring(root, encoding="utf-8", method="xml")
+    @staticmethod
+    def _make_addons_xml(content):
+        # Digests and the compressed copy are only computed when the document changes
+        digest = md5(content).hexdigest()
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return AddonsXml(
+            content=content,
+            md5=digest.encode("utf-8"),
+            etag='"{}"'.format(digest),
+            gzip=compressor.compress(content) + compressor.flush(),
+            gzip_etag='"{}-gzip"'.format(digest))
 
     def get_addons_xml(self):
-        return self._addons_xml_cache.get()
+        return self.get_addons_xml_document().content
 
     def get_addons_xml_md5(self):
-        m = md5()
-        m.update(self.get_addons_xml())
-        return m.hexdigest().encode("utf-8")
+        return self.get_addons_xml_document().md5
 
-    def get_asset(self, addon_id, asset):
+    def get_asset(self, addon_id, asset, byte_range=None, if_range=None, head=False):
+        """
+        Get a Response for an add-on asset. If ``head`` is set, only its headers are meant to be used,
+        so these are resolved from the cache or an upstream HEAD request, without downloading the body.
+        """
         addon = self._addons.get(addon_id)
         if addon is None:
             raise AddonNotFound("No such addon: {}".format(addon_id))
-        return self._get_asset(addon, asset)
+        return self._get_asset(addon, asset, byte_range=byte_range, if_range=if_range, head=head)
 
-    def _get_asset(self, addon, asset):
+    def _get_asset(self, addon, asset, byte_range=None, if_range=None, head=False, revalidate=False):
         logging.debug("Getting asset for addon %s: %s", addon.id, asset)
-        repo = GitHubRepositoryApi(addon.username, addon.repository, token=addon.token or self._token)
-        ref = addon.branch or self._fallback_ref_cache.get(repo, tag_pattern=addon.tag_pattern)
+        repo = self._get_repository_api(addon)
+        with timed("fallback_ref"):
+            ref = addon.branch or self._fallback_ref_cache.get(repo, tag_pattern=addon.tag_pattern)
         logging.debug("Using ref %s for addon %s", ref, addon.id)
         formats = dict(
             id=addon.id, username=addon.username, repository=addon.repository,
@@ -237,53 +378,224 @@ class Repository(object):
         except KeyError:
             if is_zip:
                 version = formats["version"]
-                zip_ref = self._get_version_tag(repo, version, tag_pattern=addon.tag_pattern, default=ref)
+                with timed("version_tag"):
+                    zip_ref = self._get_version_tag(repo, version, tag_pattern=addon.tag_pattern, default=ref)
                 logging.debug("Automatically detected zip ref. Wanted %s, detected %s", version, zip_ref)
-                return repo.get_zip(zip_ref)
+                zip_name = addon.id + self.VERSION_SEPARATOR + version + self.ZIP_EXTENSION
+                # The archive is rewritten, so ranges are never forwarded upstream (but are served once cached)
+                return self._get_cached_asset(
+                    addon, zip_ref, "{}/{}".format(self.ZIPBALL_ASSET, addon.id),
+                    lambda _, method: self._get_zipball(
+                        self._get_content_api(addon, repo), zip_ref, addon.id, zip_name, method=method),
+                    immutable=lambda: self._is_pinned_ref(addon, repo, zip_ref),
+                    byte_range=byte_range, if_range=if_range, head=head, revalidate=revalidate)
             asset_path = self._format(addon.asset_prefix, **formats) + asset
 
         if asset_path.startswith(self.RELEASE_ASSET_PREFIX):
             release_tag, asset_name = asset_path[len(self.RELEASE_ASSET_PREFIX):].rsplit("/", maxsplit=1)
-            release = repo.get_release_by_tag(release_tag)
-            for release_asset in release.assets:
-                if release_asset.name == asset_name:
-                    response = repo.get_release_asset(release_asset.id)
-                    break
-            else:
+
+            def fetch(headers, method):
+                release = repo.get_release_by_tag(release_tag)
+                for release_asset in release.assets:
+                    if release_asset.name == asset_name:
+                        if method == "HEAD":
+                            # The release already describes the asset
+                            return Response(RawResponse(BytesIO(), {
+                                "Content-Length": release_asset.get("size"),
+                                "Content-Type": release_asset.get("content_type")}))
+                        return repo.get_release_asset(release_asset.id, headers=headers)
                 raise ReleaseAssetNotFound("Unable to find release asset: {}".format(asset_path))
+
+            return self._get_cached_asset(
+                addon, release_tag, asset_path, fetch, immutable=True, byte_range=byte_range, if_range=if_range,
+                head=head, revalidate=revalidate)
         elif is_http_like(asset_path):
-            response = request(asset_path)
+            return self._get_cached_asset(
+                addon, ref, asset_path, lambda headers, method: request(asset_path, headers=headers, method=method),
+                byte_range=byte_range, if_range=if_range, head=head, revalidate=revalidate)
         else:
-            response = repo.get_contents(asset_path, ref)
-
+            return self._get_cached_asset(
+                addon, ref, asset_path,
+                lambda headers, method: self._get_content_api(addon, repo).get_contents(
+                    asset_path, ref, headers=headers, method=method),
+                immutable=lambda: self._is_pinned_ref(addon, repo, ref), byte_range=byte_range, if_range=if_range,
+                head=head, revalidate=revalidate)
+
+    def _get_cached_asset(self, addon, ref, asset_path, fetch, immutable=False, byte_range=None, if_range=None,
+                          head=False, revalidate=False):
+        """
+        Get an asset from the blob cache, or using ``fetch(headers, method)`` if not cached. HEAD requests
+        are never stored, and ranges are not forwarded on these. If ``revalidate`` is set, cached assets
+        which are not immutable are revalidated upstream, even if not expired. ``immutable`` may also be
+        a callable, which is only called if needed (e.g. when storing a downloaded asset).
+        """
+        if head:
+            byte_range = None
+        range_headers = None
+        if byte_range is not None:
+            # Ranges which are not served from cache are forwarded upstream
+            range_headers = {"Range": byte_range.header()}
+            if if_range:
+                range_headers["If-Range"] = if_range
+
+        method = "HEAD" if head else "GET"
+        if self._blob_cache is None:
+            return fetch(range_headers, method)
+        key = (addon.username, addon.repository, ref, asset_path)
+        with timed("cache"):
+            skip_cache = revalidate and not (immutable() if callable(immutable) else immutable)
+            response = None if skip_cache else self._blob_cache.get(
+                key, byte_range=byte_range, if_range=if_range)
+        if response is None:
+            try:
+                if head:
+                    response = fetch(None, method)
+                elif byte_range is None:
+                    # Concurrent downloads of the same asset share a single upstream download. Expired blobs
+                    # are revalidated, so that these are only downloaded again if modified
+                    headers = self._blob_cache.revalidation_headers(key)
+                    response = self._blob_cache.fetch(key, lambda: fetch(headers, method), immutable=immutable)
+                    if response.status_code == 304:
+                        response.close()
+                        logging.debug("Cached asset %s for addon %s was not modified", asset_path, addon.id)
+                        response = self._blob_cache.get(key) if self._blob_cache.renew(key) else None
+                        if response is None:
+                            # The blob was evicted in the meantime
+                            response = self._blob_cache.fetch(key, lambda: fetch({}, method), immutable=immutable)
+                else:
+                    # Partial responses (206) are not stored, but full ones are (even if a range was requested)
+                    response = self._blob_cache.wrap(key, fetch(range_headers, method), immutable=immutable)
+            except GitHubTransientError:
+                # Serve an expired entry (if any) instead of failing
+                response = self._blob_cache.get(key, byte_range=byte_range, if_range=if_range, allow_expired=True)
+                if response is None:
+                    raise
+                logging.debug("GitHub unavailable, serving expired cached asset %s for addon %s", asset_path, addon.id)
+                return response
+        else:
+            logging.debug("Serving cached asset %s for addon %s (ref %s)", asset_path, addon.id, ref)
         return response
 
+    @staticmethod
+    def _get_zipball(content_api, ref, addon_id, zip_name, method="GET"):
+        # Archives have a "{username}-{repository}-{sha}" (or "{repository}-{ref}" if downloaded
+        # from the CDN) top-level directory, while Kodi expects the add-on id
+        headers = {"Content-Type": "application/zip", "Content-Disposition": "attachment; filename={}".format(zip_name)}
+        response = content_api.get_zip(ref, method=method)
+        if method == "HEAD":
+            # The size of the rewritten archive is not known until it is downloaded
+            response.close()
+            return Response(RawResponse(BytesIO(), headers, code=response.status_code))
+        return Response(RawResponse(ZipRerooter(response.raw, addon_id), headers))
+
+    def _is_pinned_ref(self, addon, repo, ref):
+        # Tags are never fetched just for this, so refs not found on the cached tags are considered not pinned
+        if ref == addon.branch:
+            return False
+        if self._commit_sha_re.match(ref):
+            return True
+        tag_index = self._refs_tags_cache.peek(repo, literal_prefix(addon.tag_pattern))
+        return tag_index is not None and ref in tag_index
+
+    def _get_repository_api(self, addon):
+        return GitHubRepositoryApi(
+            addon.username, addon.repository, base_url=self._api_url, token=addon.token or self._token)
+
+    def _get_content_api(self, addon, repo):
+        """
+        Get the client used for fetching contents and archives of ``addon``, according to its fetch strategy.
+        Metadata (refs, releases, ...) is always fetched using ``repo``.
+        """
+        strategy = addon.fetch_strategy or self._fetch_strategy
+        if strategy == FETCH_API:
+            return repo
+        return GitHubCdnApi(
+            addon.username, addon.repository, raw_url=self._raw_url, codeload_url=self._codeload_url,
+            token=addon.token or self._token, fallback=repo if strategy == FETCH_CDN_FALLBACK else None)
+
+    def _prefetch_metadata(self):
+        """
+        Resolve the fallback refs of all add-ons missing on cache using batched GraphQL queries,
+        instead of (up to) three REST calls per add-on. GraphQL requires a token, so add-ons
+        without one are left to be resolved using the REST API.
+        """
+        pending = OrderedDict()
+        for addon in self._addons.values():
+            token = addon.token or self._token
+            if addon.branch or not token:
+                continue
+            repo = self._get_repository_api(addon)
+            if not self._fallback_ref_cache.contains(repo, tag_pattern=addon.tag_pattern):
+                pending.setdefault(token, []).append((addon, repo))
+
+        for token, entries in pending.items():
+            api = GitHubGraphQLApi(self._api_url + "/graphql", token=token)
+            for i in range(0, len(entries), self._graphql_batch_size):
+                batch = entries[i:i + self._graphql_batch_size]
+                try:
+                    results = api.get_repositories_metadata([(a.username, a.repository) for a, _ in batch])
+                except GitHubApiError as e:
+                    logging.warning("Failed prefetching repositories metadata: %s", e)
+                    continue
+                for (addon, repo), metadata in zip(batch, results):
+                    if metadata is not None:
+                        self._fill_metadata(addon, repo, metadata)
+
+    def _fill_metadata(self, addon, repo, metadata):
+        tag_index = TagIndex(metadata.refs_tags)
+        if metadata.refs_tags_complete:
+            self._refs_tags_cache.put(tag_index, repo, "")
+            prefix = literal_prefix(addon.tag_pattern)
+            if prefix:
+                self._refs_tags_cache.put(TagIndex(
+                    t for t in metadata.refs_tags if t.ref.startswith("refs/tags/" + prefix)), repo, prefix)
+
+        # Even if incomplete, the last matching tag is the same one the REST API would provide
+        if addon.tag_pattern is None:
+            ref = metadata.latest_release or tag_index.latest()
+        else:
+            ref = tag_index.latest(addon.tag_pattern)
+            if ref is None and not metadata.refs_tags_complete:
+                # A matching tag may exist on the remaining pages
+                return
+            ref = ref or metadata.latest_release
+
+        self._fallback_ref_cache.put(
+            ref or metadata.default_branch or self._default_branch, repo, tag_pattern=addon.tag_pattern)
+
     def _get_fallback_ref(self, repo, tag_pattern=None):
         if tag_pattern is None:
-            ref = self._get_latest_release_tag(repo) or self._get_matching_tag(repo, lambda _: True)
+            ref = self._get_latest_release_tag(repo) or self._get_tag_index(repo).latest()
         else:
-            ref = self._get_matching_tag(repo, tag_pattern.match) or self._get_latest_release_tag(repo)
+            ref = self._get_tag_index(repo, tag_pattern).latest(tag_pattern) or self._get_latest_release_tag(repo)
         return ref or self._get_repository_default_branch(repo) or self._default_branch
 
-    def _get_matching_tag(self, repo, predicate, default=None):
-        return next((tag_name for tag_name in (
-            remove_prefix(tag.ref, "refs/tags/") for tag in reversed(self._refs_tags_cache.get(repo))
-        ) if predicate(tag_name)), default)
-
     def _get_version_tag(self, repo, version, tag_pattern=None, default=None):
-        return self._get_matching_tag(repo, TagMatchPredicate(version, tag_pattern=tag_pattern), default=default)
+        return self._get_tag_index(repo, tag_pattern).find(version, tag_pattern=tag_pattern) or default
 
-    @staticmethod
-    def _get_refs_tags(repo):
+    def _get_tag_index(self, repo, tag_pattern=None):
+        # Only the tags which may match tag_pattern are fetched
+        return self._refs_tags_cache.get(repo, literal_prefix(tag_pattern))
+
+    def _get_refs_tags(self, repo, prefix, conditional=True):
         try:
-            return repo.get_refs_tags()
+            return TagIndex(repo.get_refs_tags(prefix, conditional=conditional))
+        except GitHubNotModifiedError:
+            # Only the validators of the refs are stored, as these are kept (indexed) on cache
+            tag_index = self._refs_tags_cache.peek(repo, prefix)
+            return self._get_refs_tags(repo, prefix, conditional=False) if tag_index is None else tag_index
+        except GitHubTransientError:
+            # Do not cache a fallback value, so that stale data keeps being used
+            raise
         except GitHubApiError:
-            return []
+            return TagIndex([])
 
     @staticmethod
     def _get_latest_release_tag(repo):
         try:
             return repo.get_latest_release().tag_name
+        except GitHubTransientError:
+            raise
         except GitHubApiError:
             return None
 
@@ -291,6 +603,8 @@ class Repository(object):
     def _get_repository_default_branch(repo):
         try:
             return repo.get_repository_info().default_branch
+        except GitHubTransientError:
+            raise
         except GitHubApiError:
             return None
 
@@ -0,0 +1,116 @@
+import logging
+import random
+import time
+from threading import Lock
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class RetryPolicy(object):
+    """
+    Bounded retries with "full jitter" exponential backoff: the n-th retry waits a random
+    time between 0 and ``min(max_backoff, backoff * 2 ** n)`` seconds.
+    """
+
+    def __init__(self, retries=2, backoff=0.5, max_backoff=8.0):
+        self.retries = retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self._max_backoff, self._backoff * 2 ** attempt))
+
+    def sleep(self, attempt):
+        time.sleep(self.delay(attempt))
+
+
+class CircuitBreaker(object):
+    """
+    Fails fast after ``failure_threshold`` consecutive failures. Once ``reset_timeout`` seconds
+    have passed, a single trial call is allowed (half-open state), which either closes the
+    circuit (success) or opens it again (failure). If the outcome of the trial call is not
+    recorded within ``trial_timeout`` seconds, another trial call is allowed.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30, trial_timeout=60):
+        self._name = name
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._trial_timeout = trial_timeout
+        self._failures = 0
+        self._state = self.CLOSED
+        self._opened_at = None
+        self._trial_started = None
+        self._lock = Lock()
+
+    @property
+    def state(self):
+        return self._state
+
+    def allow(self):
+        with self._lock:
+            if self._state == self.CLOSED:
+                return
+            now = time.time()
+            if (self._state == self.OPEN and now - self._opened_at >= self._reset_timeout) or (
+                    self._state == self.HALF_OPEN and now - self._trial_started >= self._trial_timeout):
+                logging.debug("Circuit for %s is half-open, allowing a trial call", self._name)
+                self._state = self.HALF_OPEN
+                self._trial_started = now
+                return
+            raise CircuitOpenError("Circuit for {} is open".format(self._name))
+
+    def release(self):
+        """
+        Give up a call allowed by ``allow`` without recording its outcome (e.g. it was not done).
+        If it was the trial call, another one is allowed right away.
+        """
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                self._state = self.OPEN
+
+    def record_success(self):
+        with self._lock:
+            if self._state != self.CLOSED:
+                logging.info("Circuit for %s is closed", self._name)
+            self._failures = 0
+            self._state = self.CLOSED
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or (
+                    self._state == self.CLOSED and self._failures >= self._failure_threshold):
+                logging.warning("Circuit for %s is open after %d failures", self._name, self._failures)
+                self._state = self.OPEN
+                self._opened_at = time.time()
+
+
+class CircuitBreakers(object):
+    def __init__(self, failure_threshold=5, reset_timeout=30, trial_timeout=60):
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._trial_timeout = trial_timeout
+        self._breakers = {}
+        self._lock = Lock()
+
+    def get(self, name):
+        with self._lock:
+            breaker = self._breakers.get(name)
+            if breaker is None:
+                breaker = self._breakers[name] = CircuitBreaker(
+                    name, failure_threshold=self._failure_threshold, reset_timeout=self._reset_timeout,
+                    trial_timeout=self._trial_timeout)
+            return breaker
+
+    def states(self):
+        with self._lock:
+            return {name: breaker.state for name, breaker in self._breakers.items()}
+
+
+default_circuit_breakers = CircuitBreakers()
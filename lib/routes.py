@@ -1,36 +1,99 @@
 from lib.httpserver import HTTPRequestHandler, add_get_route
+from lib.metrics import CONTENT_TYPE, Counter, Gauge, MetricsRegistry, default_registry
+from lib.ratelimit import RateLimiter, default_rate_limiter
 from lib.repository import Repository, NotFoundException
+from lib.scheduler import RefreshScheduler
 
 
-def add_repository_routes(repository):
-    # type: (Repository) -> None
+def add_repository_routes(repository, scheduler=None):
+    # type: (Repository, RefreshScheduler) -> None
 
     @add_get_route("/addons.xml")
     def route_get_addons(ctx):
         # type: (HTTPRequestHandler) -> None
-        ctx.send_response_with_data(repository.get_addons_xml(), "application/xml")
+        addons_xml = repository.get_addons_xml_document()
+        if ctx.accepts_encoding("gzip"):
+            data, etag, headers = addons_xml.gzip, addons_xml.gzip_etag, {"Content-Encoding": "gzip"}
+        else:
+            data, etag, headers = addons_xml.content, addons_xml.etag, {}
+        headers.update({"ETag": etag, "Vary": "Accept-Encoding"})
+        if ctx.etag_matches(etag):
+            ctx.send_not_modified(headers)
+        else:
+            ctx.send_response_with_data(data, "application/xml", headers=headers)
 
     @add_get_route("/addons.xml.md5")
     def route_get_addons_md5(ctx):
         # type: (HTTPRequestHandler) -> None
-        ctx.send_response_with_data(repository.get_addons_xml_md5(), "text/plain")
+        addons_xml = repository.get_addons_xml_document()
+        headers = {"ETag": addons_xml.etag}
+        if ctx.etag_matches(addons_xml.etag):
+            ctx.send_not_modified(headers)
+        else:
+            ctx.send_response_with_data(addons_xml.md5, "text/plain", headers=headers)
 
     @add_get_route("/{w}/{p}")
     def route_get_assets(ctx, addon_id, asset):
         # type: (HTTPRequestHandler, str, str) -> None
         try:
-            with repository.get_asset(addon_id, asset) as response:
-                ctx.send_file_contents(
-                    response.raw, response.status_code,
-                    length=response.headers.get("Content-Length"),
-                    content_type=response.headers.get("Content-Type"),
-                    content_disposition=response.headers.get("Content-Disposition"))
+            ctx.stream_response(repository.get_asset(
+                addon_id, asset, byte_range=ctx.get_range(), if_range=ctx.headers.get("If-Range"), head=ctx.is_head))
         except NotFoundException:
             ctx.send_response_and_end(404)
 
     @add_get_route("/update")
     def route_update(ctx):
         # type: (HTTPRequestHandler) -> None
-        repository.update()
-        repository.clear_cache()
+        if ctx.is_head:
+            # Updating is not safe (nor idempotent), so it is only done on GET requests
+            ctx.send_response_and_end(405, headers={"Allow": "GET"})
+            return
+        if repository.update() and scheduler is not None:
+            # Build addons.xml in background, so that the next client poll is served from warm data
+            scheduler.wake()
         ctx.send_response_and_end(200)
+
+
+def _repository_metrics(repository, rate_limiter):
+    # type: (Repository, RateLimiter) -> list
+    label_names = ("cache",)
+    hits = Counter("cache_hits_total", "Cache hits on fresh values, by cache", label_names)
+    stale_hits = Counter("cache_stale_hits_total", "Cache hits on stale values, by cache", label_names)
+    misses = Counter("cache_misses_total", "Cache misses, by cache", label_names)
+    loads = Counter("cache_loads_total", "Values loaded, by cache", label_names)
+    load_failures = Counter("cache_load_failures_total", "Values which failed loading, by cache", label_names)
+    load_time = Counter("cache_load_seconds_total", "Time spent loading values, by cache", label_names)
+    evictions = Counter("cache_evictions_total", "Values evicted, by cache", label_names)
+    size = Gauge("cache_entries", "Values currently cached, by cache", label_names)
+    for name, stats in repository.get_cache_stats().items():
+        hits.inc(stats.hits, cache=name)
+        stale_hits.inc(stats.stale_hits, cache=name)
+        misses.inc(stats.misses, cache=name)
+        loads.inc(stats.loads, cache=name)
+        load_failures.inc(stats.load_failures, cache=name)
+        load_time.inc(stats.load_time, cache=name)
+        evictions.inc(stats.evictions, cache=name)
+        size.set(stats.size, cache=name)
+
+    label_names = ("token", "resource")
+    limit = Gauge("github_rate_limit_limit", "Last observed GitHub rate limit, by token and resource", label_names)
+    remaining = Gauge("github_rate_limit_remaining",
+                      "Last observed GitHub remaining rate limit budget, by token and resource", label_names)
+    reset = Gauge("github_rate_limit_reset_timestamp_seconds",
+                  "Last observed GitHub rate limit reset time, by token and resource", label_names)
+    for (token_id, resource), values in sorted(rate_limiter.budgets().items()):
+        for gauge, value in zip((limit, remaining, reset), values):
+            if value is not None:
+                gauge.set(value, token=token_id, resource=resource)
+
+    return [hits, stale_hits, misses, loads, load_failures, load_time, evictions, size, limit, remaining, reset]
+
+
+def add_metrics_route(repository, registry=default_registry, rate_limiter=default_rate_limiter):
+    # type: (Repository, MetricsRegistry, RateLimiter) -> None
+    registry.add_collector(lambda: _repository_metrics(repository, rate_limiter))
+
+    @add_get_route("/metrics")
+    def route_get_metrics(ctx):
+        # type: (HTTPRequestHandler) -> None
+        ctx.send_response_with_data(registry.render(), CONTENT_TYPE, headers={"Cache-Control": "no-store"})
@@ -0,0 +1,66 @@
+import logging
+import random
+import threading
+
+from lib.ratelimit import request_priority, PRIORITY_LOW
+
+
+class RefreshScheduler(threading.Thread):
+    """
+    Background thread which builds addons.xml at startup and then periodically refreshes the
+    repository caches shortly before they expire (every ``interval`` seconds, with jitter).
+    A refresh (and rebuild) can also be requested with ``wake``, e.g. after updating the repository.
+    When stopped, a refresh in progress is waited for at most ``stop_timeout`` seconds (it is a daemon thread).
+    """
+
+    def __init__(self, repository, interval=60, margin=5 * 60, jitter=0.2, stop_timeout=5):
+        super(RefreshScheduler, self).__init__()
+        self.daemon = True
+        self._repository = repository
+        self._interval = interval
+        self._margin = margin
+        self._jitter = jitter
+        self._stop_timeout = stop_timeout
+        self._wake_event = threading.Event()
+        self._stopped = False
+
+    def _next_delay(self):
+        return self._interval * random.uniform(1 - self._jitter, 1 + self._jitter)
+
+    def run(self):
+        logging.debug("Warming up repository caches")
+        self._refresh()
+        while True:
+            self._wake_event.wait(self._next_delay())
+            self._wake_event.clear()
+            if self._stopped:
+                break
+            self._refresh()
+        logging.debug("Refresh scheduler terminated")
+
+    def _refresh(self):
+        try:
+            # Background refreshes must not use the rate limit budget reserved for user requests
+            with request_priority(PRIORITY_LOW):
+                refreshed = self._repository.refresh_ahead(self._margin, jitter=self._jitter)
+            logging.debug("Refreshed %d cache entries ahead of expiration", refreshed)
+        except Exception as e:
+            logging.warning("Failed refreshing repository caches: %s", e, exc_info=True)
+
+    def wake(self):
+        self._wake_event.set()
+
+    def stop(self):
+        self._stopped = True
+        self._wake_event.set()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+        self.join(self._stop_timeout)
+        if self.is_alive():
+            logging.debug("Refresh scheduler is still refreshing, not waiting for it")
+        return False
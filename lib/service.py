@@ -11,10 +11,12 @@ except ImportError:
 import xbmc
 
 from lib.entries import ENTRIES_PATH
-from lib.httpserver import threaded_http_server
-from lib.kodi import ADDON_PATH, get_repository_port, set_logger, notification, translate
+from lib.httpserver import create_http_server, ENGINE_THREADED
+from lib.kodi import ADDON_PATH, ADDON_DATA, get_repository_port, get_cache_size, get_fetch_strategy, get_graphql, \
+    set_logger, notification, translate
 from lib.repository import Repository
-from lib.routes import add_repository_routes
+from lib.routes import add_repository_routes, add_metrics_route
+from lib.scheduler import RefreshScheduler
 
 REPO_DIR_XPATH = "extension[@point='xbmc.addon.repository']/dir"
 REPO_INFO_XPATH = "info"
@@ -22,8 +24,13 @@ REPO_CHECKSUM_XPATH = "checksum"
 REPO_DATADIR_XPATH = "datadir"
 
 set_logger()
-add_repository_routes(Repository(
-    files=(os.path.join(ADDON_PATH, "resources", "repository.json"), ENTRIES_PATH)))
+repository = Repository(
+    files=(os.path.join(ADDON_PATH, "resources", "repository.json"), ENTRIES_PATH),
+    cache_dir=os.path.join(ADDON_DATA, "cache"), cache_size=get_cache_size(), fetch_strategy=get_fetch_strategy(),
+    graphql=get_graphql())
+scheduler = RefreshScheduler(repository)
+add_repository_routes(repository, scheduler=scheduler)
+add_metrics_route(repository)
 
 
 def update_repository_port(port, xml_path=os.path.join(ADDON_PATH, "addon.xml")):
@@ -57,13 +64,14 @@ class ServiceMonitor(xbmc.Monitor):
 
 
 class HTTPServerRunner(threading.Thread):
-    def __init__(self, port):
+    def __init__(self, port, engine=ENGINE_THREADED):
         self._port = port
+        self._engine = engine
         self._server = None
         super(HTTPServerRunner, self).__init__()
 
     def run(self):
-        self._server = server = threaded_http_server("127.0.0.1", self._port)
+        self._server = server = create_http_server("127.0.0.1", self._port, engine=self._engine)
         logging.debug("Server started at port %d", self._port)
         server.serve_forever()
         logging.debug("Closing server")
@@ -90,5 +98,5 @@ def run():
     if not validate_repository_port(port):
         notification(translate(30020))
         update_repository_port(port)
-    with HTTPServerRunner(port):
+    with HTTPServerRunner(port), scheduler:
         ServiceMonitor(port).waitForAbort()
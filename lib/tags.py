@@ -0,0 +1,110 @@
+import re
+from threading import Lock
+
+from lib.utils import remove_prefix
+from lib.version import try_parse_version
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+_prefixes = {}
+
+
+def literal_prefix(tag_pattern):
+    """
+    Get the literal prefix every tag matching ``tag_pattern`` starts with (e.g. "plugin-" for "plugin-(.+)"),
+    or an empty string if there is none.
+    """
+    if tag_pattern is None:
+        return ""
+    prefix = _prefixes.get(tag_pattern)
+    if prefix is None:
+        chars = []
+        if not tag_pattern.flags & re.IGNORECASE:
+            for op, value in sre_parse.parse(tag_pattern.pattern, tag_pattern.flags):
+                if op == sre_parse.LITERAL:
+                    chars.append(chr(value))
+                elif op != sre_parse.AT or value != sre_parse.AT_BEGINNING:
+                    break
+        prefix = _prefixes[tag_pattern] = "".join(chars)
+    return prefix
+
+
+class _TagView(object):
+    """
+    Tags of a repository matching a tag pattern, indexed by their (raw and parsed) version.
+    Positions are kept so that, as when scanning the refs list backwards, the last tag wins.
+    """
+    __slots__ = ["latest", "_by_value", "_by_version"]
+
+    def __init__(self, names, tag_pattern=None):
+        self.latest = None
+        self._by_value = {}
+        self._by_version = {}
+        tag_group = tag_pattern.groupindex.get("version", 1) if tag_pattern and tag_pattern.groups else None
+
+        for position, name in enumerate(names):
+            value = name
+            if tag_pattern:
+                match = tag_pattern.match(name)
+                if not match:
+                    continue
+                elif tag_group:
+                    value = match.group(tag_group)
+
+            self.latest = name
+            self._by_value[value] = (position, name)
+            version = try_parse_version(value)
+            if version is not None:
+                self._by_version[version] = (position, name)
+
+    def find(self, version):
+        candidates = [self._by_value.get(version)]
+        parsed_version = try_parse_version(version)
+        if parsed_version is not None:
+            candidates.append(self._by_version.get(parsed_version))
+        candidates = [c for c in candidates if c is not None]
+        return max(candidates)[1] if candidates else None
+
+
+class TagIndex(object):
+    """
+    Index of the tags of a repository, built once per refs fetch. Tags are expected in the
+    order provided by the refs API (ascending), and views for each tag pattern are built lazily.
+    """
+
+    def __init__(self, refs_tags):
+        self._names = [remove_prefix(tag.ref, "refs/tags/") for tag in refs_tags]
+        self._names_set = frozenset(self._names)
+        self._views = {}
+        self._lock = Lock()
+
+    def __contains__(self, name):
+        return name in self._names_set
+
+    def __len__(self):
+        return len(self._names)
+
+    def _view(self, tag_pattern):
+        view = self._views.get(tag_pattern)
+        if view is None:
+            with self._lock:
+                view = self._views.get(tag_pattern)
+                if view is None:
+                    view = self._views[tag_pattern] = _TagView(self._names, tag_pattern=tag_pattern)
+        return view
+
+    def latest(self, tag_pattern=None):
+        """
+        Get the last tag (in refs order) matching ``tag_pattern``, or None.
+        """
+        return self._view(tag_pattern).latest
+
+    def find(self, version, tag_pattern=None):
+        """
+        Get the last tag whose version (the "version" or first group of ``tag_pattern``, if any)
+        is either ``version`` or equivalent to it (e.g. "v1.0" for "1.0.0"), or None.
+        """
+        return self._view(tag_pattern).find(version)
@@ -0,0 +1,112 @@
+import cProfile
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import count
+
+_local = threading.local()
+
+
+class Timings(object):
+    """
+    Durations (in seconds) of the phases of a request, in the order they were first recorded.
+    Phases recorded more than once (e.g. several upstream calls) are summed.
+    """
+
+    def __init__(self):
+        self._phases = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, name, duration):
+        with self._lock:
+            self._phases[name] = self._phases.get(name, 0) + duration
+
+    def items(self):
+        with self._lock:
+            return list(self._phases.items())
+
+    def server_timing(self):
+        """
+        Get the value of a Server-Timing header, with durations in milliseconds.
+        """
+        return ", ".join("{};dur={:.1f}".format(name, duration * 1000) for name, duration in self.items())
+
+
+def get_timings():
+    return getattr(_local, "timings", None)
+
+
+@contextmanager
+def request_timings(timings):
+    """
+    Record the phases timed by the current thread (see ``timed``) on ``timings``.
+    """
+    previous = get_timings()
+    _local.timings = timings
+    try:
+        yield timings
+    finally:
+        _local.timings = previous
+
+
+def add_timing(name, duration):
+    timings = get_timings()
+    if timings is not None:
+        timings.add(name, duration)
+
+
+@contextmanager
+def timed(name):
+    """
+    Time the block as phase ``name`` of the current request (if any).
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        add_timing(name, time.time() - start)
+
+
+class SamplingProfiler(object):
+    """
+    Profiles one of every ``every`` requests with cProfile, dumping the stats (which can be loaded
+    with pstats or snakeviz) to ``path``. Only the thread handling the request is profiled.
+    """
+
+    def __init__(self, path, every=100):
+        if every < 1:
+            raise ValueError("Expected a positive sampling interval")
+        self._path = path
+        self._every = every
+        self._counter = count(1)
+        self._lock = threading.Lock()
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    @contextmanager
+    def profile(self, name):
+        with self._lock:
+            number = next(self._counter)
+        if number % self._every:
+            yield
+            return
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # Only one profiler can be active at a time on recent python versions
+            logging.debug("Not profiling request %d: %s", number, e)
+            yield
+            return
+        try:
+            yield
+        finally:
+            profiler.disable()
+            path = os.path.join(self._path, "{}-{:06d}-{}.prof".format(
+                time.strftime("%Y%m%d%H%M%S"), number, name))
+            profiler.dump_stats(path)
+            logging.debug("Dumped request %d profile to %s", number, path)
@@ -1,9 +1,13 @@
+import codecs
 import json
 import logging
 import sys
+from email.message import Message
+from xml.etree import ElementTree  # nosec
+from xml.parsers import expat  # nosec
 
 try:
-    from urllib.request import urlopen, Request
+    from urllib.request import urlopen, Request, getproxies
     from urllib.parse import urlparse, urlencode
     from urllib.error import HTTPError
 except ImportError:
@@ -12,7 +16,9 @@ except ImportError:
     # noinspection PyUnresolvedReferences
     from urlparse import urlparse
     # noinspection PyUnresolvedReferences
-    from urllib import urlencode
+    from urllib import urlencode, getproxies
+
+from lib.httpclient import default_pool
 
 PY3 = sys.version_info.major >= 3
 
@@ -39,6 +45,98 @@ def remove_prefix(text, prefix):
     return text[len(prefix):] if text.startswith(prefix) else text
 
 
+def iter_json_array(fp, chunk_size=16 * 1024, **kwargs):
+    """
+    Incrementally parse the JSON array read from ``fp`` (UTF-8), yielding its items as soon as
+    they are read, so that the whole document is never loaded into memory.
+    """
+    decoder = json.JSONDecoder(**kwargs)
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buf, eof = "", False
+    # 0: expecting "[", 1: expecting an item or "]", 2: expecting "," or "]", 3: expecting an item
+    state = 0
+    while True:
+        buf = buf.lstrip()
+        if buf:
+            c = buf[0]
+            if state == 0:
+                if c != "[":
+                    raise ValueError("Expecting JSON array")
+                buf, state = buf[1:], 1
+                continue
+            if c == "]":
+                if state == 3:
+                    raise ValueError("Expecting value")
+                return
+            if state == 2:
+                if c != ",":
+                    raise ValueError("Expecting ',' delimiter")
+                buf, state = buf[1:], 3
+                continue
+            try:
+                item, end = decoder.raw_decode(buf)
+            except ValueError:
+                if eof:
+                    raise
+            else:
+                # Values at the end of the buffer (e.g. numbers) may still be incomplete
+                if end < len(buf) or eof:
+                    buf, state = buf[end:], 2
+                    yield item
+                    continue
+        elif eof:
+            raise ValueError("Unexpected end of JSON array")
+        data = fp.read(chunk_size)
+        eof = not data
+        buf += text_decoder.decode(data, final=eof)
+
+
+def xml_fragment(data, root_tag=None):
+    """
+    Validate the XML document ``data`` (bytes) and get its root element as UTF-8 bytes, without
+    the XML declaration (or anything else preceding the root element), so that it can be spliced
+    into another document. Raises ValueError if the document is not well-formed or its root
+    element is not ``root_tag``. Documents with a DOCTYPE are serialized again instead, as the
+    entities they declare would not be defined on the other document.
+    """
+    parser = expat.ParserCreate()
+    info = {}
+
+    def xml_decl_handler(_version, encoding, _standalone):
+        info["encoding"] = encoding
+
+    def doctype_handler(*_args):
+        info["doctype"] = True
+
+    def start_element_handler(name, _attributes):
+        if "root" not in info:
+            info["root"] = (name, parser.CurrentByteIndex)
+
+    parser.XmlDeclHandler = xml_decl_handler
+    parser.StartElementHandler = start_element_handler
+    parser.StartDoctypeDeclHandler = doctype_handler
+    parser.EntityDeclHandler = doctype_handler
+    try:
+        parser.Parse(data, True)
+    except expat.ExpatError as e:
+        raise ValueError("Invalid XML: {}".format(e))
+
+    name, index = info["root"]
+    if root_tag is not None and name != root_tag:
+        raise ValueError("Expecting root element {} but got {}".format(root_tag, name))
+    if info.get("doctype"):
+        try:
+            # Entities are expanded, and non ASCII characters are escaped (no XML declaration is added)
+            return ElementTree.tostring(ElementTree.fromstring(data))
+        except ElementTree.ParseError as e:
+            raise ValueError("Invalid XML: {}".format(e))
+    fragment = data[index:].rstrip()
+    encoding = (info.get("encoding") or "utf-8").lower()
+    if encoding not in ("utf-8", "utf8", "us-ascii", "ascii"):
+        fragment = fragment.decode(encoding).encode("utf-8")
+    return fragment
+
+
 def is_http_like(s):
     try:
         result = urlparse(s)
@@ -47,21 +145,82 @@ def is_http_like(s):
         return False
 
 
-def request(url, params=None, data=None, headers=None, **kwargs):
+def request(url, params=None, data=None, headers=None, method=None, pool=None, **kwargs):
     if params:
         url += "?" + urlencode(params)
-    request_params = Request(url, data=data, headers=headers if headers else {})
-    logging.debug("Doing a HTTP %s request to %s", request_params.get_method(), url)
-    try:
-        response = urlopen(request_params, **kwargs)
-    except HTTPError as e:
-        response = e
-    logging.debug(
-        "HTTP %s response from %s received with status %s",
-        request_params.get_method(), url, response.getcode())
+    if method is None:
+        method = "GET" if data is None else "POST"
+    logging.debug("Doing a HTTP %s request to %s", method, url)
+    if urlparse(url).scheme in getproxies():
+        # Keep honoring proxies configured on the environment
+        request_params = Request(url, data=data, headers=headers if headers else {})
+        request_params.get_method = lambda: method
+        try:
+            response = urlopen(request_params, **kwargs)
+        except HTTPError as e:
+            response = e
+    else:
+        response = (pool or default_pool).urlopen(method, url, body=data, headers=headers, **kwargs)
+    logging.debug("HTTP %s response from %s received with status %s", method, url, response.getcode())
     return Response(response)
 
 
+class ByteRange(object):
+    """
+    Single byte range, as in the HTTP Range header. ``start`` is None for suffix ranges, in
+    which case ``end`` is the number of bytes. ``end`` (inclusive) is None for open ranges.
+    """
+    __slots__ = ["start", "end"]
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+    @classmethod
+    def parse(cls, value):
+        """
+        Parse a Range header value. Returns None if the value is invalid or has multiple ranges.
+        """
+        if not value:
+            return None
+        unit, _, ranges = value.partition("=")
+        if unit.strip().lower() != "bytes" or "," in ranges:
+            return None
+        start, sep, end = ranges.strip().partition("-")
+        if not sep or not (start or end) or (start and not start.isdigit()) or (end and not end.isdigit()):
+            return None
+        start = int(start) if start else None
+        end = int(end) if end else None
+        if start is not None and end is not None and end < start:
+            return None
+        return cls(start, end)
+
+    def resolve(self, size):
+        """
+        Get the (start, end) inclusive offsets of the range for a body of ``size`` bytes,
+        or None if the range is not satisfiable.
+        """
+        if self.start is None:
+            if self.end == 0 or size == 0:
+                return None
+            return max(size - self.end, 0), size - 1
+        if self.start >= size:
+            return None
+        return self.start, size - 1 if self.end is None else min(self.end, size - 1)
+
+    def header(self):
+        return "bytes={}-{}".format("" if self.start is None else self.start, "" if self.end is None else self.end)
+
+
+def make_headers(headers=None):
+    message = Message()
+    if headers:
+        for name, value in headers.items():
+            if value is not None:
+                message[name] = value
+    return message
+
+
 class HTTPResponseError(Exception):
     def __init__(self, message, response):
         super(HTTPResponseError, self).__init__(message)
@@ -108,3 +267,27 @@ class Response(object):
 
     def __exit__(self, *exc_info):
         self.close()
+
+
+class RawResponse(object):
+    """
+    File backed object which mimics the interface of the objects returned by urlopen,
+    so that locally stored bodies can be wrapped by Response.
+    """
+
+    def __init__(self, fp, headers=None, code=200):
+        self._fp = fp
+        self._headers = make_headers(headers)
+        self._code = code
+
+    def read(self, *args):
+        return self._fp.read(*args)
+
+    def info(self):
+        return self._headers
+
+    def getcode(self):
+        return self._code
+
+    def close(self):
+        self._fp.close()
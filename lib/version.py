@@ -1,5 +1,6 @@
 import re
 from functools import total_ordering
+from threading import Lock
 
 _digits_re = re.compile(r"(\d+)")
 
@@ -42,7 +43,21 @@ class NegativeInfinityType(object):
 
 @total_ordering
 class _BaseVersion(object):
-    _key = None
+    __slots__ = ["_key"]
+
+    @classmethod
+    def parse(cls, value):
+        """
+        Get the (interned) version of ``value``, using a bounded cache of parsed values.
+        Raises ValueError if ``value`` is not a valid version.
+        """
+        version = _parse_cache.get(cls, value)
+        if version is None:
+            raise ValueError("Invalid version {}".format(repr(value)))
+        return version
+
+    def __hash__(self):
+        return hash(self._key)
 
     def __eq__(self, other):
         if not isinstance(other, self.__class__):
@@ -56,6 +71,7 @@ class _BaseVersion(object):
 
 
 class Version(_BaseVersion):
+    __slots__ = ["_release", "_extra", "_build"]
     _version_re = re.compile(r"""
         ^v?
         (?P<release>[0-9]+(?:\.[0-9]+)*)
@@ -72,39 +88,72 @@ class Version(_BaseVersion):
         if match is None:
             raise ValueError("Invalid version {}".format(repr(value)))
 
-        self._release = tuple(int(i) for i in match.group("release").split("."))
-        self._extra = match.group("extra")
-        self._build = match.group("build")
+        release, self._extra, self._build = match.group("release", "extra", "build")
+        self._release = tuple(map(int, release.split(".")))
         self._key = self._make_key()
 
     def _make_key(self):
-        for i, v in enumerate(reversed(self._release)):
-            if v != 0:
-                release = self._release[:len(self._release) - i]
-                break
-        else:
-            release = ()
+        release = self._release
+        end = len(release)
+        while end and release[end - 1] == 0:
+            end -= 1
 
         extra = _nat_tuple(self._extra + "0") if self._extra else Infinity
 
-        return release, extra
+        return release[:end], extra
 
 
 class DebianVersion(_BaseVersion):
+    __slots__ = []
+
     def __init__(self, version):
-        self._key = _nat_tuple(version, lambda v: v.split("~") + [Infinity])
+        self._key = _nat_tuple(version, lambda v: tuple(v.split("~")) + (Infinity,))
+
+
+class _ParseCache(object):
+    """
+    Bounded cache of parsed versions (invalid values are stored as None). Versions are immutable,
+    so equal strings share the same instance. The cache is simply emptied when full.
+    """
+
+    def __init__(self, max_size=16384):
+        self._max_size = max_size
+        self._values = {}
+        self._lock = Lock()
+
+    def get(self, cls, value):
+        key = (cls, value)
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        try:
+            version = cls(value)
+        except ValueError:
+            version = None
+        with self._lock:
+            if len(self._values) >= self._max_size:
+                self._values.clear()
+            return self._values.setdefault(key, version)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
 
 
 Infinity = InfinityType()
 NegativeInfinity = NegativeInfinityType()
+_parse_cache = _ParseCache()
 
 
 def try_parse_version(version, default=None):
-    try:
-        return Version(version)
-    except ValueError:
-        return default
+    parsed_version = _parse_cache.get(Version, version)
+    return default if parsed_version is None else parsed_version
 
 
-def _nat_tuple(value, converter=lambda a: a):
-    return tuple(converter(c) if i % 2 == 0 else int(c) for i, c in enumerate(_digits_re.split(value)))
+def _nat_tuple(value, converter=None):
+    parts = _digits_re.split(value)
+    parts[1::2] = map(int, parts[1::2])
+    if converter is not None:
+        parts[::2] = map(converter, parts[::2])
+    return tuple(parts)
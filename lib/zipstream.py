@@ -0,0 +1,207 @@
+import struct
+import zlib
+
+LOCAL_FILE_HEADER = b"PK\x03\x04"
+CENTRAL_DIRECTORY_HEADER = b"PK\x01\x02"
+END_OF_CENTRAL_DIRECTORY = b"PK\x05\x06"
+DATA_DESCRIPTOR = b"PK\x07\x08"
+
+_local_header = struct.Struct("<HHHHHIIIHH")
+_central_header = struct.Struct("<HHHHHHIIIHHHHHII")
+_end_of_central_directory = struct.Struct("<HHHHIIH")
+_data_descriptor = struct.Struct("<III")
+
+_FLAG_DATA_DESCRIPTOR = 0x08
+_METHOD_DEFLATED = 8
+_ZIP64_MARKER = 0xFFFFFFFF
+
+
+class ZipRerooter(object):
+    """
+    File-like object which reads the zip archive from ``fp`` and streams it with the top-level
+    directory of every entry renamed to ``root`` (e.g. "user-repo-sha/addon.xml" becomes
+    "plugin.id/addon.xml"). Entries are copied as they are read, without being recompressed,
+    so the archive is never fully loaded into memory.
+
+    Only the central directory offsets and names are rewritten. Entries with data descriptors (unknown
+    sizes) are supported for both stored and deflated data. Zip64 archives are not supported,
+    in which case ValueError is raised while reading.
+    """
+
+    def __init__(self, fp, root, chunk_size=64 * 1024):
+        self._fp = fp
+        self._root = root.encode("utf-8")
+        self._chunk_size = chunk_size
+        self._buffer = b""
+        self._in_offset = 0
+        self._out_offset = 0
+        self._offsets = {}
+        self._chunks = self._rewrite()
+        self._pending = b""
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return self._pending + b"".join(self._iter_chunks())
+        data = [self._pending]
+        length = len(self._pending)
+        while length < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._out_offset += len(chunk)
+            data.append(chunk)
+            length += len(chunk)
+        data = b"".join(data)
+        self._pending = data[size:]
+        return data[:size]
+
+    def _iter_chunks(self):
+        self._pending = b""
+        for chunk in self._chunks:
+            self._out_offset += len(chunk)
+            yield chunk
+
+    def close(self):
+        self._fp.close()
+
+    def _rename(self, name):
+        index = name.find(b"/")
+        return name if index < 0 else self._root + name[index:]
+
+    def _fill(self):
+        data = self._fp.read(self._chunk_size)
+        if not data:
+            raise ValueError("Unexpected end of zip archive")
+        self._buffer += data
+
+    def _read(self, size):
+        while len(self._buffer) < size:
+            self._fill()
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        self._in_offset += size
+        return data
+
+    def _read_some(self):
+        if not self._buffer:
+            self._fill()
+        data, self._buffer = self._buffer, b""
+        self._in_offset += len(data)
+        return data
+
+    def _unread(self, data):
+        self._buffer = data + self._buffer
+        self._in_offset -= len(data)
+
+    def _copy(self, size):
+        while size > 0:
+            if not self._buffer:
+                self._fill()
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+            self._in_offset += len(data)
+            size -= len(data)
+            yield data
+
+    def _copy_deflated(self):
+        # The compressed size is unknown, so decompress the data just to find where it ends
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        while not decompressor.unused_data:
+            data = self._read_some()
+            decompressor.decompress(data)
+            if decompressor.unused_data:
+                self._unread(decompressor.unused_data)
+                data = data[:len(data) - len(decompressor.unused_data)]
+            yield data
+
+    def _copy_until_descriptor(self):
+        # The size is unknown and the data can not be decompressed to find where it ends, so look for
+        # the data descriptor (with or without signature) whose CRC-32 and sizes match the data before it.
+        # Data is only copied once every descriptor which could start within it was checked.
+        crc = size = 0
+        window = b""
+        while True:
+            window += self._read_some()
+            candidates = []
+            index = window.find(b"PK")
+            while index >= 0:
+                signature = window[index:index + 4]
+                if signature == DATA_DESCRIPTOR:
+                    candidates.append((index, 16))
+                elif signature in (LOCAL_FILE_HEADER, CENTRAL_DIRECTORY_HEADER) and index >= 12:
+                    candidates.append((index - 12, 12))
+                index = window.find(b"PK", index + 1)
+
+            for start, length in sorted(candidates):
+                if start + 16 > len(window):
+                    break
+                descriptor = window[start:start + length]
+                descriptor_crc, compressed_size, uncompressed_size = _data_descriptor.unpack(descriptor[-12:])
+                data_size = (size + start) & 0xFFFFFFFF
+                if compressed_size == uncompressed_size == data_size and \
+                        zlib.crc32(window[:start], crc) & 0xFFFFFFFF == descriptor_crc:
+                    self._unread(window[start + length:])
+                    yield window[:start]
+                    yield descriptor
+                    return
+
+            end = max(0, len(window) - 15)
+            if end:
+                data, window = window[:end], window[end:]
+                crc = zlib.crc32(data, crc)
+                size += end
+                yield data
+
+    def _rewrite(self):
+        central_directory_offset = None
+        while True:
+            offset = self._in_offset
+            signature = self._read(4)
+            if signature == LOCAL_FILE_HEADER:
+                fields = list(_local_header.unpack(self._read(_local_header.size)))
+                flags, method, compressed_size, size, name_length, extra_length = (
+                    fields[1], fields[2], fields[6], fields[7], fields[8], fields[9])
+                if _ZIP64_MARKER in (compressed_size, size):
+                    raise ValueError("Zip64 archives are not supported")
+                name = self._rename(self._read(name_length))
+                extra = self._read(extra_length)
+                fields[8] = len(name)
+                self._offsets[offset] = self._out_offset
+                yield LOCAL_FILE_HEADER + _local_header.pack(*fields) + name + extra
+
+                if flags & _FLAG_DATA_DESCRIPTOR:
+                    if method == _METHOD_DEFLATED:
+                        for data in self._copy_deflated():
+                            yield data
+                        # The data descriptor signature is optional
+                        descriptor = self._read(4)
+                        yield descriptor + self._read(12 if descriptor == DATA_DESCRIPTOR else 8)
+                    else:
+                        for data in self._copy_until_descriptor():
+                            yield data
+                else:
+                    for data in self._copy(compressed_size):
+                        yield data
+
+            elif signature == CENTRAL_DIRECTORY_HEADER:
+                if central_directory_offset is None:
+                    central_directory_offset = self._out_offset
+                fields = list(_central_header.unpack(self._read(_central_header.size)))
+                name_length, extra_length, comment_length, local_offset = fields[9], fields[10], fields[11], fields[15]
+                if local_offset == _ZIP64_MARKER:
+                    raise ValueError("Zip64 archives are not supported")
+                name = self._rename(self._read(name_length))
+                fields[9] = len(name)
+                fields[15] = self._offsets[local_offset]
+                yield CENTRAL_DIRECTORY_HEADER + _central_header.pack(*fields) + name + self._read(
+                    extra_length + comment_length)
+
+            elif signature == END_OF_CENTRAL_DIRECTORY:
+                if central_directory_offset is None:
+                    central_directory_offset = self._out_offset
+                fields = list(_end_of_central_directory.unpack(self._read(_end_of_central_directory.size)))
+                fields[4] = self._out_offset - central_directory_offset
+                fields[5] = central_directory_offset
+                yield END_OF_CENTRAL_DIRECTORY + _end_of_central_directory.pack(*fields) + self._read(fields[6])
+                return
+
+            else:
+                raise ValueError("Unsupported zip record at offset {}".format(offset))
@@ -1,21 +1,20 @@
+import argparse
 import logging
 import os
 
-from lib.httpserver import threaded_http_server
+from lib.httpserver import HTTPRequestHandler, create_http_server, ENGINES, ENGINE_THREADED
 from lib.platform.os_platform import get_platform
-from lib.repository import Repository
-from lib.routes import add_repository_routes
+from lib.repository import Repository, FETCH_STRATEGIES, FETCH_API
+from lib.routes import add_repository_routes, add_metrics_route
+from lib.scheduler import RefreshScheduler
+from lib.timing import SamplingProfiler
 
 addon_path = os.path.dirname(__file__)
-logging.basicConfig(level=logging.DEBUG, format="%(asctime)s %(levelname)s %(message)s")
-add_repository_routes(Repository(
-    files=(os.path.join(addon_path, "resources", "repository.json"),),
-    platform=get_platform()))
 
 
-def run(port):
-    server = threaded_http_server("", port)
-    logging.debug("Server started at port %d", port)
+def run(port, host="", engine=ENGINE_THREADED):
+    server = create_http_server(host, port, engine=engine)
+    logging.debug("Server (%s) started at port %d", engine, port)
 
     try:
         server.serve_forever()
@@ -26,5 +25,49 @@ def run(port):
         server.server_close()
 
 
+def main():
+    parser = argparse.ArgumentParser(description="GitHub virtual Kodi repository server")
+    parser.add_argument("--host", default="", help="address to listen on (default: all interfaces)")
+    parser.add_argument("--port", type=int, default=8080, help="port to listen on (default: %(default)s)")
+    parser.add_argument("--engine", choices=ENGINES, default=ENGINE_THREADED,
+                        help="HTTP server engine (default: %(default)s)")
+    parser.add_argument("--fetch-strategy", choices=FETCH_STRATEGIES, default=FETCH_API,
+                        help="how add-on contents and zips are downloaded (default: %(default)s)")
+    parser.add_argument("--files", nargs="+", default=[os.path.join(addon_path, "resources", "repository.json")],
+                        help="repository entries files (default: %(default)s)")
+    parser.add_argument("--api-url", default="https://api.github.com", help="GitHub API url (default: %(default)s)")
+    parser.add_argument("--raw-url", default="https://raw.githubusercontent.com",
+                        help="GitHub raw contents url (default: %(default)s)")
+    parser.add_argument("--codeload-url", default="https://codeload.github.com",
+                        help="GitHub archives url (default: %(default)s)")
+    parser.add_argument("--token", default=os.environ.get("GITHUB_TOKEN"),
+                        help="GitHub token used by default (default: $GITHUB_TOKEN)")
+    parser.add_argument("--graphql", action="store_true",
+                        help="batch add-ons metadata requests using the GraphQL API (requires a token)")
+    parser.add_argument("--max-threads", type=int, default=5,
+                        help="threads used for fetching add-ons information (default: %(default)s)")
+    parser.add_argument("--cache-dir", default=os.path.join(addon_path, ".cache"),
+                        help="assets cache directory (default: %(default)s)")
+    parser.add_argument("--log-level", choices=("DEBUG", "INFO", "WARNING", "ERROR"), default="DEBUG",
+                        help="logging level (default: %(default)s)")
+    parser.add_argument("--profile-dir", help="profile a sample of the requests, dumping the stats to this directory")
+    parser.add_argument("--profile-every", type=int, default=100,
+                        help="profile one of every N requests, if --profile-dir is set (default: %(default)s)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.log_level), format="%(asctime)s %(levelname)s %(message)s")
+    if args.profile_dir:
+        HTTPRequestHandler.profiler = SamplingProfiler(args.profile_dir, every=args.profile_every)
+    repository = Repository(
+        files=args.files, platform=get_platform(), max_threads=args.max_threads, cache_dir=args.cache_dir,
+        api_url=args.api_url, raw_url=args.raw_url, codeload_url=args.codeload_url,
+        token=args.token, graphql=args.graphql, fetch_strategy=args.fetch_strategy)
+    scheduler = RefreshScheduler(repository)
+    add_repository_routes(repository, scheduler=scheduler)
+    add_metrics_route(repository)
+    with scheduler:
+        run(args.port, host=args.host, engine=args.engine)
+
+
 if __name__ == "__main__":
-    run(8080)
+    main()
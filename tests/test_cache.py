@@ -0,0 +1,357 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from io import BytesIO
+
+from lib.cache import BlobCache, LoadingCache
+from lib.utils import Response, RawResponse
+
+try:
+    from unittest import mock
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    import mock
+
+
+def _response(data, headers=None):
+    return Response(RawResponse(BytesIO(data), dict({"Content-Length": str(len(data))}, **(headers or {}))))
+
+
+def _content(response):
+    with response:
+        return response.content
+
+
+class _Clock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class _ManualExecutor(object):
+    """
+    Executor whose calls only run when ``run_all`` is called.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def submit(self, func, *args, **kwargs):
+        self.calls.append((func, args, kwargs))
+
+    def run_all(self):
+        calls, self.calls = self.calls, []
+        for func, args, kwargs in calls:
+            func(*args, **kwargs)
+        return len(calls)
+
+
+class _BlockingLoader(object):
+    """
+    Loader which blocks until released, counting its calls.
+    """
+
+    def __init__(self, error=None):
+        self.calls = 0
+        self.release = threading.Event()
+        self._error = error
+
+    def __call__(self, key):
+        self.calls += 1
+        if not self.release.wait(5):
+            raise RuntimeError("Not released")
+        if self._error is not None:
+            raise self._error
+        return key.upper()
+
+
+class LoadingCacheLoadingTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = _Clock()
+        patcher = mock.patch("lib.cache.time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _get_concurrently(self, cache, key, count):
+        """
+        Call ``cache.get(key)`` on ``count`` threads, returning the threads and a list which gets their
+        results (or errors) once done. Returns once all of them are waiting (or loading).
+        """
+        results = []
+
+        def get():
+            try:
+                results.append(cache.get(key))
+            except Exception as e:
+                results.append(e)
+
+        threads = [threading.Thread(target=get) for _ in range(count)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        deadline = time.time() + 5
+        while cache.stats().misses < count and time.time() < deadline:
+            time.sleep(0.001)
+        self.assertEqual(count, cache.stats().misses)
+        return threads, results
+
+    def test_concurrent_callers_share_one_load(self):
+        loader = _BlockingLoader()
+        cache = LoadingCache(loader)
+        threads, results = self._get_concurrently(cache, "a", 5)
+        loader.release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(["A"] * 5, results)
+        self.assertEqual(1, loader.calls)
+        self.assertEqual("A", cache.get("a"))
+        stats = cache.stats()
+        self.assertEqual((1, 5, 1, 0), (stats.hits, stats.misses, stats.loads, stats.load_failures))
+
+    def test_error_reaches_all_waiters(self):
+        error = ValueError("Failed")
+        loader = _BlockingLoader(error=error)
+        cache = LoadingCache(loader)
+        threads, results = self._get_concurrently(cache, "a", 5)
+        loader.release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual([error] * 5, results)
+        self.assertEqual(1, loader.calls)
+        self.assertEqual(1, cache.stats().load_failures)
+        # Errors are not cached
+        self.assertFalse(cache.stored("a"))
+        self.assertRaises(ValueError, cache.get, "a")
+        self.assertEqual(2, loader.calls)
+
+    def test_different_keys_load_in_parallel(self):
+        loader = _BlockingLoader()
+        cache = LoadingCache(loader)
+        threads, results = self._get_concurrently(cache, "a", 1)
+        deadline = time.time() + 5
+        while loader.calls < 1 and time.time() < deadline:
+            time.sleep(0.001)
+        # The load of "a" is blocked, but does not block other keys
+        cache.put("B", "b")
+        self.assertEqual("B", cache.get("b"))
+        loader.release.set()
+        threads[0].join(5)
+        self.assertEqual(["A"], results)
+
+    def test_expired_value_is_loaded_again(self):
+        values = iter(("v1", "v2"))
+        cache = LoadingCache(lambda key: next(values), ttl_seconds=10)
+        self.assertEqual("v1", cache.get("a"))
+        self.clock.now += 10
+        self.assertEqual("v1", cache.get("a"))
+        self.clock.now += 1
+        self.assertEqual("v2", cache.get("a"))
+
+    def test_stale_value_served_while_refreshing(self):
+        values = iter(("v1", "v2"))
+        executor = _ManualExecutor()
+        cache = LoadingCache(lambda key: next(values), ttl_seconds=10, stale_while_revalidate=True, executor=executor)
+        self.assertEqual("v1", cache.get("a"))
+        self.clock.now += 11
+        self.assertEqual("v1", cache.get("a"))
+        self.assertEqual("v1", cache.get("a"))
+        # A single refresh is started, no matter how many callers get the stale value
+        self.assertEqual(1, executor.run_all())
+        self.assertEqual("v2", cache.get("a"))
+        self.assertEqual(0, executor.run_all())
+        stats = cache.stats()
+        self.assertEqual((1, 2, 1, 2), (stats.hits, stats.stale_hits, stats.misses, stats.loads))
+
+    def test_failed_refresh_keeps_stale_value(self):
+        def load(key):
+            if cache.stored(key):
+                raise ValueError("Failed")
+            return "v1"
+
+        executor = _ManualExecutor()
+        cache = LoadingCache(load, ttl_seconds=10, stale_while_revalidate=True, executor=executor)
+        self.assertEqual("v1", cache.get("a"))
+        self.clock.now += 11
+        self.assertEqual("v1", cache.get("a"))
+        self.assertEqual(1, executor.run_all())
+        self.assertEqual(1, cache.stats().load_failures)
+        # The next call tries to refresh it again
+        self.assertEqual("v1", cache.get("a"))
+        self.assertEqual(1, len(executor.calls))
+
+    def test_invalidated_load_is_not_stored(self):
+        loader = _BlockingLoader()
+        cache = LoadingCache(loader)
+        threads, results = self._get_concurrently(cache, "a", 1)
+        cache.invalidate("a")
+        loader.release.set()
+        threads[0].join(5)
+        self.assertEqual(["A"], results)
+        self.assertFalse(cache.stored("a"))
+
+    def test_refresh_expiring(self):
+        values = {"a": iter(("a1", "a2")), "b": iter(("b1", "b2"))}
+        cache = LoadingCache(lambda key: next(values[key]), ttl_seconds=100)
+        cache.get("a")
+        self.clock.now += 50
+        cache.get("b")
+        self.clock.now += 45
+        # Only "a" expires within the next 10 seconds
+        self.assertEqual(1, cache.refresh_expiring(10))
+        self.assertEqual(("a2", "b1"), (cache.get("a"), cache.get("b")))
+
+
+class LoadingCacheEvictionTest(unittest.TestCase):
+    def test_max_size(self):
+        cache = LoadingCache(lambda key: key, max_size=2)
+        for key in ("a", "b", "c"):
+            cache.get(key)
+        self.assertEqual([False, True, True], [cache.stored(k) for k in ("a", "b", "c")])
+        self.assertEqual(1, cache.stats().evictions)
+
+    def test_lru(self):
+        cache = LoadingCache(lambda key: key, max_size=2, lru=True)
+        cache.get("a")
+        cache.get("b")
+        cache.get("a")
+        cache.get("c")
+        self.assertEqual([True, False, True], [cache.stored(k) for k in ("a", "b", "c")])
+
+    def test_max_weight(self):
+        cache = LoadingCache(lambda key: key, max_size=None, max_weight=10, weigher=len)
+        for key in ("aaaa", "bbbb", "cc"):
+            cache.get(key)
+        self.assertEqual((3, 10, 0), (cache.stats().size, cache.stats().weight, cache.stats().evictions))
+        cache.get("ddd")
+        self.assertEqual([False, True, True, True], [cache.stored(k) for k in ("aaaa", "bbbb", "cc", "ddd")])
+        self.assertEqual((3, 9, 1), (cache.stats().size, cache.stats().weight, cache.stats().evictions))
+        # The last stored value is kept, even if heavier than max_weight
+        cache.get("e" * 20)
+        self.assertEqual((1, 20), (cache.stats().size, cache.stats().weight))
+        self.assertTrue(cache.stored("e" * 20))
+
+    def test_weight_of_replaced_values(self):
+        cache = LoadingCache(lambda key: key, max_size=None, max_weight=10, weigher=len)
+        cache.put("aaaa", "a")
+        cache.put("aaaaaa", "a")
+        self.assertEqual((1, 6), (cache.stats().size, cache.stats().weight))
+        cache.invalidate("a")
+        self.assertEqual((0, 0), (cache.stats().size, cache.stats().weight))
+
+
+class LoadingCacheTest(unittest.TestCase):
+    def test_version_changes_on_store_and_remove(self):
+        cache = LoadingCache(lambda key: key.upper())
+        versions = [cache.version]
+        cache.get("a")
+        versions.append(cache.version)
+        cache.get("a")
+        self.assertEqual(versions[-1], cache.version)
+        cache.put("B", "b")
+        versions.append(cache.version)
+        cache.invalidate("a")
+        versions.append(cache.version)
+        cache.clear()
+        versions.append(cache.version)
+        self.assertEqual(len(versions), len(set(versions)))
+
+    def test_next_expiry(self):
+        cache = LoadingCache(lambda key: key, ttl_seconds=10)
+        self.assertIsNone(cache.next_expiry())
+        start = time.time()
+        cache.get("a")
+        cache.get("b")
+        self.assertTrue(start + 10 <= cache.next_expiry() <= time.time() + 10)
+        self.assertRaises(ValueError, LoadingCache(lambda key: key, lru=True).next_expiry)
+
+    def test_stored_includes_expired_values(self):
+        cache = LoadingCache(lambda key: key, ttl_seconds=0)
+        self.assertFalse(cache.stored("a"))
+        cache.get("a")
+        time.sleep(0.01)
+        self.assertFalse(cache.contains("a"))
+        self.assertTrue(cache.stored("a"))
+        self.assertEqual("a", cache.peek("a"))
+
+
+class BlobCacheFetchTest(unittest.TestCase):
+    data = os.urandom(200 * 1024)
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def _read(self, response, size=16 * 1024):
+        chunks = []
+        for chunk in iter(lambda: response.raw.read(size), b""):
+            chunks.append(chunk)
+        response.raw.close()
+        return b"".join(chunks)
+
+    def _spool_files(self):
+        return [name for name in os.listdir(self.path) if name.endswith(BlobCache.TEMP_EXTENSION)]
+
+    def test_follower_reads_committed_download(self):
+        cache = BlobCache(self.path, spool_timeout=5)
+        leader = cache.fetch("key", lambda: _response(self.data))
+        follower = cache.fetch("key", lambda: self.fail("Download was not coalesced"))
+        self.assertEqual(self.data, self._read(leader))
+        self.assertEqual(self.data, self._read(follower))
+        self.assertEqual(self.data, _content(cache.get("key")))
+
+    def test_follower_reads_uncommitted_download(self):
+        # The blob does not fit in the cache, so the download is not committed
+        cache = BlobCache(self.path, max_bytes=10 * 1024, spool_timeout=5)
+        leader = cache.fetch("key", lambda: _response(self.data))
+        follower = cache.fetch("key", lambda: self.fail("Download was not coalesced"))
+        self.assertEqual(self.data[:64 * 1024], leader.raw.read(64 * 1024))
+        self.assertEqual(self.data[:32 * 1024], follower.raw.read(32 * 1024))
+        self.assertEqual(self.data[64 * 1024:], self._read(leader))
+        self.assertEqual(self.data[32 * 1024:], self._read(follower))
+        self.assertIsNone(cache.get("key"))
+        self.assertEqual([], self._spool_files())
+
+    def test_follower_reads_download_with_length_mismatch(self):
+        cache = BlobCache(self.path, spool_timeout=5)
+        leader = cache.fetch("key", lambda: _response(self.data, {"Content-Length": str(len(self.data) + 1)}))
+        follower = cache.fetch("key", lambda: self.fail("Download was not coalesced"))
+        self.assertEqual(self.data, self._read(leader))
+        self.assertEqual(self.data, self._read(follower))
+        self.assertIsNone(cache.get("key"))
+        self.assertEqual([], self._spool_files())
+
+
+class BlobCacheRevalidationTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def test_revalidation_headers(self):
+        cache = BlobCache(self.path)
+        self.assertEqual({}, cache.revalidation_headers("key"))
+        _content(cache.wrap("key", _response(b"data", {"ETag": '"etag"', "Last-Modified": "date"})))
+        self.assertEqual({"If-None-Match": '"etag"', "If-Modified-Since": "date"}, cache.revalidation_headers("key"))
+
+    def test_renew(self):
+        cache = BlobCache(self.path, ttl_seconds=0.05)
+        self.assertFalse(cache.renew("key"))
+        _content(cache.wrap("key", _response(b"data", {"ETag": '"etag"'})))
+        time.sleep(0.1)
+        self.assertIsNone(cache.get("key"))
+        self.assertTrue(cache.renew("key"))
+        self.assertEqual(b"data", _content(cache.get("key")))
+        # The renewal is persisted
+        self.assertEqual(b"data", _content(BlobCache(self.path, ttl_seconds=0.05).get("key")))
+
+
+if __name__ == "__main__":
+    unittest.main()
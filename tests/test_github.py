@@ -0,0 +1,141 @@
+import socket
+import unittest
+
+from io import BytesIO
+
+from lib.github import GitHubRepositoryApi, GitHubGraphQLApi, GitHubRateLimitError, GitHubUnavailableError, \
+    ValidatorStore
+from lib.httpclient import PoolTimeoutError
+from lib.ratelimit import RateLimiter, RateLimitExceeded
+from lib.retry import CircuitBreaker, CircuitBreakers, RetryPolicy
+from lib.utils import Response, RawResponse
+
+try:
+    from unittest import mock
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    import mock
+
+
+class _ExhaustedRateLimiter(RateLimiter):
+    def acquire(self, token, resource=None, priority=None):
+        raise RateLimitExceeded("Rate limit exhausted")
+
+
+class GitHubRepositoryApiBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.api = GitHubRepositoryApi("user", "repo", base_url="http://github.invalid")
+        self.api.circuit_breakers = CircuitBreakers(failure_threshold=1, reset_timeout=0)
+        self.api.rate_limiter = RateLimiter()
+        self.breaker = self.api.circuit_breakers.get("github.invalid")
+        self.breaker.allow()
+        self.breaker.record_failure()
+
+    def test_rate_limited_call_keeps_trial(self):
+        self.api.rate_limiter = _ExhaustedRateLimiter()
+        self.assertRaises(GitHubRateLimitError, self.api.get_repository_info)
+        self.assertEqual(CircuitBreaker.OPEN, self.breaker.state)
+        self.breaker.allow()
+
+    def test_pool_timeout_does_not_trip_breaker(self):
+        with mock.patch("lib.github.request", side_effect=PoolTimeoutError("Timed out")):
+            self.assertRaises(GitHubUnavailableError, self.api.get_repository_info)
+        self.assertEqual(CircuitBreaker.OPEN, self.breaker.state)
+        self.breaker.allow()
+        self.breaker.record_success()
+        with mock.patch("lib.github.request", side_effect=PoolTimeoutError("Timed out")):
+            self.assertRaises(GitHubUnavailableError, self.api.get_repository_info)
+        self.assertEqual(CircuitBreaker.CLOSED, self.breaker.state)
+
+
+class _BrokenReader(object):
+    def __init__(self, data):
+        self._fp = BytesIO(data)
+
+    def read(self, size=-1):
+        data = self._fp.read(size)
+        if not data:
+            raise socket.error("Connection reset")
+        return data
+
+    def close(self):
+        self._fp.close()
+
+
+class GitHubRepositoryApiRefsTest(unittest.TestCase):
+    def test_network_error_while_reading_refs(self):
+        api = GitHubRepositoryApi("user", "repo", base_url="http://github.invalid")
+        api.circuit_breakers = CircuitBreakers()
+        api.rate_limiter = RateLimiter()
+        response = Response(RawResponse(_BrokenReader(b'[{"ref": "refs/tags/v1"}, '), {}))
+        with mock.patch("lib.github.request", return_value=response):
+            refs = api.get_refs_tags(conditional=False)
+            self.assertEqual("refs/tags/v1", next(refs).ref)
+            self.assertRaises(GitHubUnavailableError, next, refs)
+
+
+class GitHubGraphQLApiTest(unittest.TestCase):
+    def setUp(self):
+        self.api = GitHubGraphQLApi("http://github.invalid/graphql", token="token")
+        self.api.circuit_breakers = CircuitBreakers(failure_threshold=2, reset_timeout=60)
+        self.api.rate_limiter = RateLimiter()
+        self.api.retry_policy = RetryPolicy(retries=1, backoff=0)
+
+    @staticmethod
+    def _reply(code, body=b""):
+        return lambda *args, **kwargs: Response(RawResponse(BytesIO(body), {}, code=code))
+
+    def test_retries_transient_failures(self):
+        responses = [self._reply(502)(), self._reply(200, b'{"data": {"r0": null}}')()]
+        with mock.patch("lib.github.request", side_effect=responses) as request:
+            self.assertEqual({"r0": None}, self.api.query("query { r0: viewer { login } }"))
+        self.assertEqual(2, request.call_count)
+        self.assertEqual("POST", request.call_args[1]["method"])
+
+    def test_failing_endpoint_opens_its_circuit(self):
+        with mock.patch("lib.github.request", side_effect=self._reply(502)) as request:
+            self.assertRaises(GitHubUnavailableError, self.api.query, "query { viewer { login } }")
+            self.assertRaises(GitHubUnavailableError, self.api.query, "query { viewer { login } }")
+        self.assertEqual(2, request.call_count)
+        self.assertEqual(CircuitBreaker.OPEN, self.api.circuit_breakers.get("github.invalid/graphql").state)
+        self.assertEqual(CircuitBreaker.CLOSED, self.api.circuit_breakers.get("github.invalid").state)
+
+
+def _response(body, etag='"etag"'):
+    return Response(RawResponse(BytesIO(body), {"ETag": etag, "Content-Length": str(len(body))}))
+
+
+class ValidatorStoreTest(unittest.TestCase):
+    def test_store_body(self):
+        store = ValidatorStore()
+        self.assertEqual(b"body", store.store("key", _response(b"body")).content)
+        stored = store.get("key")
+        self.assertEqual('"etag"', stored.etag)
+        self.assertEqual(b"body", stored.response().content)
+
+    def test_store_validators_only(self):
+        store = ValidatorStore()
+        response = _response(b"body")
+        self.assertIs(response, store.store("key", response, keep_body=False))
+        self.assertEqual(b"body", response.content)
+        stored = store.get("key")
+        self.assertEqual('"etag"', stored.etag)
+        self.assertIsNone(stored.body)
+
+    def test_bounded_by_bytes(self):
+        store = ValidatorStore(max_bytes=3 * (ValidatorStore.ENTRY_SIZE + 1000), max_body_size=1000)
+        for i in range(4):
+            store.store(i, _response(b"x" * 1000)).close()
+        self.assertIsNone(store.get(0))
+        self.assertEqual([1, 2, 3], [i for i in range(4) if store.get(i) is not None])
+        self.assertEqual(3 * (ValidatorStore.ENTRY_SIZE + 1000), store.size)
+
+    def test_big_bodies_are_not_stored(self):
+        store = ValidatorStore(max_body_size=10)
+        self.assertEqual(b"x" * 11, store.store("key", _response(b"x" * 11)).content)
+        self.assertIsNone(store.get("key"))
+        self.assertEqual(0, store.size)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+import threading
+import time
+import unittest
+
+from lib.httpclient import PoolTimeoutError, _HostPool
+
+
+class _Connection(object):
+    def close(self):
+        pass
+
+
+class HostPoolTest(unittest.TestCase):
+    def test_acquire_times_out(self):
+        pool = _HostPool(1)
+        pool.acquire(_Connection, 1)
+        start = time.time()
+        self.assertRaises(PoolTimeoutError, pool.acquire, _Connection, 0.1)
+        self.assertGreaterEqual(time.time() - start, 0.1)
+
+    def test_waiter_keeps_waiting_when_connection_is_taken(self):
+        pool = _HostPool(1)
+        connection, _ = pool.acquire(_Connection, 1)
+        results = []
+
+        def waiter():
+            try:
+                results.append(pool.acquire(_Connection, 5))
+            except PoolTimeoutError as e:
+                results.append(e)
+
+        thread = threading.Thread(target=waiter)
+        thread.start()
+        time.sleep(0.1)
+        # The waiter is notified, but another caller takes the released connection before it wakes up
+        with pool._condition:
+            pool.release(connection)
+            connection, reused = pool.acquire(_Connection, 0)
+        self.assertTrue(reused)
+        time.sleep(0.1)
+        self.assertEqual([], results)
+
+        pool.release(connection)
+        thread.join(5)
+        self.assertEqual(1, len(results))
+        self.assertIs(connection, results[0][0])
+
+
+if __name__ == "__main__":
+    unittest.main()
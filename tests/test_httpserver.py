@@ -0,0 +1,147 @@
+import re
+import threading
+import unittest
+from io import BytesIO
+
+from lib.httpserver import HTTPRequestHandler, Router, ThreadedHTTPServer
+from lib.utils import Response, RawResponse
+
+try:
+    from http.client import HTTPConnection
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from httplib import HTTPConnection
+
+
+class TestServer(object):
+    """
+    Threaded server (on a random port) whose handler has its own routes, added with ``add_get_route``.
+    """
+
+    def __init__(self):
+        self.handler_class = type("TestRequestHandler", (HTTPRequestHandler,), {"get_routes": Router()})
+        self.handler_class.log_message = lambda *args: None
+        self._server = ThreadedHTTPServer(("127.0.0.1", 0), self.handler_class)
+        self._thread = threading.Thread(target=self._server.serve_forever, kwargs={"poll_interval": 0.05})
+        self._thread.daemon = True
+        self._thread.start()
+        self._connection = HTTPConnection("127.0.0.1", self._server.server_address[1], timeout=10)
+
+    def add_get_route(self, pattern):
+        def wrapper(func):
+            self.handler_class.add_get_route(pattern, func)
+            return func
+
+        return wrapper
+
+    def request(self, path, headers=None, method="GET"):
+        """
+        Do a request (reusing the same connection), returning the response and its body.
+        """
+        self._connection.request(method, path, headers=headers or {})
+        response = self._connection.getresponse()
+        return response, response.read()
+
+    def close(self):
+        self._connection.close()
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
+class RouterTest(unittest.TestCase):
+    def setUp(self):
+        self.router = Router()
+
+    def test_static_route(self):
+        handler = object()
+        self.router.add_static("/addons.xml", handler)
+        self.assertEqual((handler, ()), self.router.resolve("/addons.xml"))
+        self.assertEqual((None, ()), self.router.resolve("/addons.xml.md5"))
+
+    def test_pattern_routes(self):
+        assets, files = object(), object()
+        self.router.add_pattern(HTTPRequestHandler.generate_pattern("/{w}/{p}"), assets)
+        self.router.add_pattern(HTTPRequestHandler.generate_pattern("/files/{w}"), files)
+        self.assertEqual(
+            (assets, ("plugin.a", "resources/icon.png")), self.router.resolve("/plugin.a/resources/icon.png"))
+        # Patterns are matched in the order they were added
+        self.assertEqual((assets, ("files", "a")), self.router.resolve("/files/a"))
+        self.assertEqual((None, ()), self.router.resolve("/plugin.a"))
+
+    def test_static_routes_take_precedence(self):
+        static, pattern = object(), object()
+        self.router.add_pattern(HTTPRequestHandler.generate_pattern("/{w}"), pattern)
+        self.router.add_static("/update", static)
+        self.assertEqual((static, ()), self.router.resolve("/update"))
+        self.assertEqual((pattern, ("other",)), self.router.resolve("/other"))
+
+    def test_same_as_sequential_matching(self):
+        patterns = ["/{w}/{p}.zip", "/a/{w}", "/{w}/icon.png", "/{w}/{w}/{p}"]
+        handlers = [object() for _ in patterns]
+        regexes = []
+        for pattern, handler in zip(patterns, handlers):
+            regex = HTTPRequestHandler.generate_pattern(pattern)
+            self.router.add_pattern(regex, handler)
+            regexes.append(regex)
+        for path in ("/a/b", "/a/b.zip", "/x/icon.png", "/x/y/z", "/x/y/z.zip", "/x", "/a/b/c/icon.png"):
+            expected = (None, ())
+            for regex, handler in zip(regexes, handlers):
+                match = re.match(regex + "$", path)
+                if match:
+                    expected = (handler, match.groups())
+                    break
+            self.assertEqual(expected, self.router.resolve(path), path)
+
+
+class HTTPRequestHandlerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = TestServer()
+        self.addCleanup(self.server.close)
+
+        @self.server.add_get_route("/data")
+        def route_data(ctx):
+            ctx.send_response_with_data(b"data", "text/plain")
+
+        @self.server.add_get_route("/stream/{w}")
+        def route_stream(ctx, length):
+            headers = {"Content-Length": length} if length != "unknown" else {}
+            ctx.stream_response(Response(RawResponse(BytesIO(b"stream"), headers)))
+
+    def test_get(self):
+        response, body = self.server.request("/data")
+        self.assertEqual(200, response.status)
+        self.assertEqual(b"data", body)
+
+    def test_not_found(self):
+        response, _ = self.server.request("/other")
+        self.assertEqual(404, response.status)
+
+    def test_clean_path(self):
+        response, body = self.server.request("//data")
+        self.assertEqual(b"data", body)
+
+    def test_head(self):
+        response, body = self.server.request("/data", method="HEAD")
+        self.assertEqual(200, response.status)
+        self.assertEqual("4", response.getheader("Content-Length"))
+        self.assertEqual(b"", body)
+        # The connection is still usable
+        self.assertEqual(b"data", self.server.request("/data")[1])
+
+    def test_stream(self):
+        for length in ("6", "unknown"):
+            response, body = self.server.request("/stream/" + length)
+            self.assertEqual(b"stream", body)
+
+    def test_head_stream_with_unknown_length(self):
+        response, body = self.server.request("/stream/unknown", method="HEAD")
+        self.assertEqual(200, response.status)
+        self.assertIsNone(response.getheader("Transfer-Encoding"))
+        self.assertIsNone(response.getheader("Connection"))
+        self.assertEqual(b"", body)
+        self.assertEqual(b"data", self.server.request("/data")[1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+import unittest
+
+from lib.metrics import Counter, Gauge, MetricsRegistry
+
+
+class MetricsRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = MetricsRegistry()
+
+    def _render(self):
+        return self.registry.render().decode("utf-8").split("\n")
+
+    def test_counter_and_gauge(self):
+        requests = self.registry.counter("requests_total", "Requests, by route", ("route",))
+        connections = self.registry.gauge("connections", "Open connections")
+        requests.inc(route="addons")
+        requests.inc(2, route="addons")
+        requests.inc(route="assets")
+        connections.inc()
+        connections.inc()
+        connections.dec()
+        self.assertEqual([
+            "# HELP requests_total Requests, by route",
+            "# TYPE requests_total counter",
+            'requests_total{route="addons"} 3',
+            'requests_total{route="assets"} 1',
+            "# HELP connections Open connections",
+            "# TYPE connections gauge",
+            "connections 1",
+            "",
+        ], self._render())
+
+    def test_histogram(self):
+        duration = self.registry.histogram("duration_seconds", "Duration", ("route",), buckets=(1.0, 0.1))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            duration.observe(value, route="a")
+        self.assertEqual([
+            "# HELP duration_seconds Duration",
+            "# TYPE duration_seconds histogram",
+            'duration_seconds_bucket{route="a",le="0.1"} 2',
+            'duration_seconds_bucket{route="a",le="1.0"} 3',
+            'duration_seconds_bucket{route="a",le="+Inf"} 4',
+            'duration_seconds_sum{route="a"} 2.65',
+            'duration_seconds_count{route="a"} 4',
+            "",
+        ], self._render())
+
+    def test_label_values_are_escaped(self):
+        self.registry.gauge("value", "Value", ("name",)).set(1.5, name='a "b"\\\n')
+        self.assertEqual('value{name="a \\"b\\"\\\\\\n"} 1.5', self._render()[2])
+
+    def test_labels_must_match(self):
+        counter = self.registry.counter("requests_total", "Requests", ("route",))
+        self.assertRaises(ValueError, counter.inc)
+        self.assertRaises(ValueError, counter.inc, route="a", code=200)
+
+    def test_register_returns_existing_metric(self):
+        counter = self.registry.counter("requests_total", "Requests")
+        self.assertIs(counter, self.registry.counter("requests_total", "Requests"))
+        self.assertRaises(ValueError, self.registry.gauge, "requests_total", "Requests")
+
+    def test_collectors(self):
+        calls = []
+
+        def collect():
+            calls.append(None)
+            gauge = Gauge("cache_entries", "Entries")
+            gauge.set(len(calls))
+            return [gauge, Counter("empty_total", "Nothing")]
+
+        self.registry.add_collector(collect)
+        self.assertEqual([
+            "# HELP cache_entries Entries",
+            "# TYPE cache_entries gauge",
+            "cache_entries 1",
+            "# HELP empty_total Nothing",
+            "# TYPE empty_total counter",
+            "",
+        ], self._render())
+        self.assertEqual("cache_entries 2", self._render()[2])
+
+    def test_empty(self):
+        self.assertEqual(b"\n", self.registry.render())
+
+
+if __name__ == "__main__":
+    unittest.main()
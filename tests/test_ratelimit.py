@@ -0,0 +1,72 @@
+import unittest
+
+from lib.ratelimit import RateLimiter, RateLimitExceeded, PRIORITY_HIGH, PRIORITY_LOW
+from lib.utils import Response, RawResponse
+
+try:
+    from unittest import mock
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    import mock
+
+
+class _Clock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class RateLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = _Clock()
+        patcher = mock.patch("lib.ratelimit.time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.limiter = RateLimiter(reserve=0.2, max_delay=60)
+
+    def _update(self, remaining, reset_in, limit=100, code=200, headers=None):
+        headers = dict({
+            "X-RateLimit-Limit": str(limit),
+            "X-RateLimit-Remaining": str(remaining),
+            "X-RateLimit-Reset": str(int(self.clock.now + reset_in)),
+        }, **(headers or {}))
+        return self.limiter.update("token", Response(RawResponse(None, headers, code=code)))
+
+    def test_unknown_budget(self):
+        self.limiter.acquire("token", priority=PRIORITY_LOW)
+        self.assertEqual([], self.clock.sleeps)
+
+    def test_reserve_is_kept_for_high_priority(self):
+        self._update(remaining=20, reset_in=30)
+        self.limiter.acquire("token", priority=PRIORITY_HIGH)
+        self.assertEqual([], self.clock.sleeps)
+        self.limiter.acquire("token", priority=PRIORITY_LOW)
+        self.assertEqual([30], self.clock.sleeps)
+
+    def test_low_priority_refused_if_reset_is_far(self):
+        self._update(remaining=20, reset_in=600)
+        self.assertRaises(RateLimitExceeded, self.limiter.acquire, "token", priority=PRIORITY_LOW)
+        self.assertEqual([], self.clock.sleeps)
+
+    def test_exhausted_budget(self):
+        self._update(remaining=0, reset_in=10)
+        self.assertRaises(RateLimitExceeded, self.limiter.acquire, "token", priority=PRIORITY_HIGH)
+        self.limiter.acquire("token", priority=PRIORITY_LOW)
+        self.assertEqual([10], self.clock.sleeps)
+
+    def test_retry_after(self):
+        self.assertTrue(self._update(remaining=50, reset_in=600, code=403, headers={"Retry-After": "5"}))
+        self.assertRaises(RateLimitExceeded, self.limiter.acquire, "token", priority=PRIORITY_HIGH)
+        self.limiter.acquire("token", priority=PRIORITY_LOW)
+        self.assertEqual([5], self.clock.sleeps)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from lib.platform.definitions import Arch, System, Platform
+from lib.repository import Repository
+
+ADDON_XML = b'<?xml version="1.0" encoding="UTF-8"?><addon id="{id}" version="1.0.0"/>'
+
+
+class _Repository(Repository):
+    """
+    Repository whose addon.xml documents are generated locally, instead of fetched from GitHub.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.before_get_addon_xml = None
+        super(_Repository, self).__init__(*args, **kwargs)
+
+    def _get_addon_xml(self, addon, revalidate=False):
+        if self.before_get_addon_xml is not None:
+            self.before_get_addon_xml(addon)
+        return ADDON_XML.replace(b"{id}", addon.id.encode("utf-8"))
+
+
+class RepositoryTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.entries_path = os.path.join(self.path, "repository.json")
+        self._write_entries("plugin.a", "plugin.b")
+        self.repository = _Repository(
+            files=[self.entries_path], max_threads=1, platform=Platform(System.linux, "", Arch.x64))
+
+    def _write_entries(self, *addon_ids):
+        with open(self.entries_path, "w") as f:
+            json.dump([{"id": addon_id, "username": "user"} for addon_id in addon_ids], f)
+        # Make sure the update sees a different file, even within the mtime resolution
+        stat = os.stat(self.entries_path)
+        os.utime(self.entries_path, (stat.st_atime, stat.st_mtime + len(addon_ids)))
+
+    def test_addons_xml(self):
+        self.assertEqual(
+            b'<addons><addon id="plugin.a" version="1.0.0"/><addon id="plugin.b" version="1.0.0"/></addons>',
+            self.repository.get_addons_xml().split(b"\n", 1)[1])
+
+    def test_addon_removed_while_loading(self):
+        def remove_addon(addon):
+            if addon.id == "plugin.a":
+                self._write_entries("plugin.a")
+                self.assertEqual(["plugin.b"], self.repository.update())
+
+        self.repository.before_get_addon_xml = remove_addon
+        self.assertEqual(
+            b'<addons><addon id="plugin.a" version="1.0.0"/></addons>',
+            self.repository.get_addons_xml().split(b"\n", 1)[1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+import time
+import unittest
+
+from lib.retry import CircuitBreaker, CircuitOpenError
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def _open_breaker(self, **kwargs):
+        breaker = CircuitBreaker("test", failure_threshold=1, **kwargs)
+        breaker.allow()
+        breaker.record_failure()
+        self.assertEqual(CircuitBreaker.OPEN, breaker.state)
+        return breaker
+
+    def test_opens_after_failures(self):
+        breaker = self._open_breaker(reset_timeout=60)
+        self.assertRaises(CircuitOpenError, breaker.allow)
+
+    def test_half_open_allows_single_trial(self):
+        breaker = self._open_breaker(reset_timeout=0)
+        breaker.allow()
+        self.assertEqual(CircuitBreaker.HALF_OPEN, breaker.state)
+        self.assertRaises(CircuitOpenError, breaker.allow)
+        breaker.record_success()
+        self.assertEqual(CircuitBreaker.CLOSED, breaker.state)
+
+    def test_released_trial_allows_another_trial(self):
+        breaker = self._open_breaker(reset_timeout=0)
+        breaker.allow()
+        breaker.release()
+        self.assertEqual(CircuitBreaker.OPEN, breaker.state)
+        breaker.allow()
+        self.assertEqual(CircuitBreaker.HALF_OPEN, breaker.state)
+
+    def test_trial_times_out(self):
+        breaker = self._open_breaker(reset_timeout=0, trial_timeout=0.05)
+        breaker.allow()
+        self.assertRaises(CircuitOpenError, breaker.allow)
+        time.sleep(0.1)
+        breaker.allow()
+        self.assertEqual(CircuitBreaker.HALF_OPEN, breaker.state)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,178 @@
+import gzip
+import shutil
+import tempfile
+import unittest
+from io import BytesIO
+
+from lib.cache import BlobCache
+from lib.repository import Repository, AddonNotFound
+from lib.routes import add_repository_routes
+from lib.utils import Response, RawResponse
+from tests.test_httpserver import TestServer
+
+try:
+    from unittest import mock
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    import mock
+
+
+ASSET = bytes(bytearray(range(256))) * 4
+ASSET_ETAG = '"asset"'
+
+
+class _Repository(object):
+    """
+    Repository with a single add-on asset ("/plugin.a/icon.png"), which is always served from a BlobCache.
+    """
+
+    def __init__(self, cache_dir):
+        self.updates = 0
+        self.addons_xml = Repository._make_addons_xml(b"<addons><addon id=\"plugin.a\"/></addons>")
+        self.blob_cache = BlobCache(cache_dir)
+        self.blob_cache.wrap("icon", Response(RawResponse(BytesIO(ASSET), {
+            "Content-Length": str(len(ASSET)), "Content-Type": "image/png", "ETag": ASSET_ETAG}))).content
+
+    def get_addons_xml_document(self):
+        return self.addons_xml
+
+    def get_asset(self, addon_id, asset, byte_range=None, if_range=None, head=False):
+        if (addon_id, asset) != ("plugin.a", "icon.png"):
+            raise AddonNotFound("No such addon: {}".format(addon_id))
+        return self.blob_cache.get("icon", byte_range=byte_range, if_range=if_range)
+
+    def update(self):
+        self.updates += 1
+        return ["plugin.a"]
+
+
+class _Scheduler(object):
+    def __init__(self):
+        self.wakes = 0
+
+    def wake(self):
+        self.wakes += 1
+
+
+class RepositoryRoutesTest(unittest.TestCase):
+    def setUp(self):
+        self.server = TestServer()
+        self.addCleanup(self.server.close)
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.repository = _Repository(cache_dir)
+        self.scheduler = _Scheduler()
+        with mock.patch("lib.routes.add_get_route", self.server.add_get_route):
+            add_repository_routes(self.repository, scheduler=self.scheduler)
+
+    def test_addons_xml(self):
+        response, body = self.server.request("/addons.xml")
+        self.assertEqual(200, response.status)
+        self.assertEqual(self.repository.addons_xml.content, body)
+        self.assertEqual(self.repository.addons_xml.etag, response.getheader("ETag"))
+        self.assertEqual("Accept-Encoding", response.getheader("Vary"))
+        self.assertIsNone(response.getheader("Content-Encoding"))
+
+    def test_addons_xml_gzip(self):
+        for accept_encoding in ("gzip", "deflate, gzip;q=0.5", "*"):
+            response, body = self.server.request("/addons.xml", headers={"Accept-Encoding": accept_encoding})
+            self.assertEqual("gzip", response.getheader("Content-Encoding"))
+            self.assertEqual(self.repository.addons_xml.gzip_etag, response.getheader("ETag"))
+            self.assertEqual(self.repository.addons_xml.content, gzip.GzipFile(fileobj=BytesIO(body)).read())
+        response, body = self.server.request("/addons.xml", headers={"Accept-Encoding": "gzip;q=0"})
+        self.assertIsNone(response.getheader("Content-Encoding"))
+        self.assertEqual(self.repository.addons_xml.content, body)
+
+    def test_addons_xml_not_modified(self):
+        addons_xml = self.repository.addons_xml
+        for etag, accept_encoding in ((addons_xml.etag, "identity"), (addons_xml.gzip_etag, "gzip"),
+                                      ('W/' + addons_xml.etag, "identity"), ('"other", ' + addons_xml.etag, ""),
+                                      ("*", "gzip")):
+            response, body = self.server.request(
+                "/addons.xml", headers={"If-None-Match": etag, "Accept-Encoding": accept_encoding})
+            self.assertEqual(304, response.status, etag)
+            self.assertEqual(b"", body)
+
+    def test_addons_xml_etag_depends_on_encoding(self):
+        # The gzip copy has its own entity tag, so it is not mistaken for the uncompressed document
+        addons_xml = self.repository.addons_xml
+        response, _ = self.server.request(
+            "/addons.xml", headers={"If-None-Match": addons_xml.gzip_etag, "Accept-Encoding": "identity"})
+        self.assertEqual(200, response.status)
+        response, _ = self.server.request(
+            "/addons.xml", headers={"If-None-Match": addons_xml.etag, "Accept-Encoding": "gzip"})
+        self.assertEqual(200, response.status)
+
+    def test_addons_xml_md5(self):
+        addons_xml = self.repository.addons_xml
+        response, body = self.server.request("/addons.xml.md5")
+        self.assertEqual(200, response.status)
+        self.assertEqual(addons_xml.md5, body)
+        self.assertEqual(addons_xml.etag, response.getheader("ETag"))
+        response, body = self.server.request("/addons.xml.md5", headers={"If-None-Match": addons_xml.etag})
+        self.assertEqual(304, response.status)
+
+    def test_asset(self):
+        response, body = self.server.request("/plugin.a/icon.png")
+        self.assertEqual(200, response.status)
+        self.assertEqual(ASSET, body)
+        self.assertEqual("image/png", response.getheader("Content-Type"))
+        self.assertEqual(ASSET_ETAG, response.getheader("ETag"))
+        self.assertEqual("bytes", response.getheader("Accept-Ranges"))
+        response, _ = self.server.request("/plugin.b/icon.png")
+        self.assertEqual(404, response.status)
+
+    def _request_range(self, value, if_range=None):
+        headers = {"Range": value}
+        if if_range is not None:
+            headers["If-Range"] = if_range
+        return self.server.request("/plugin.a/icon.png", headers=headers)
+
+    def test_range(self):
+        for value, start, end in (("bytes=0-9", 0, 9), ("bytes=1000-", 1000, 1023), ("bytes=1000-5000", 1000, 1023),
+                                  ("bytes=-24", 1000, 1023), ("bytes=-5000", 0, 1023)):
+            response, body = self._request_range(value)
+            self.assertEqual(206, response.status, value)
+            self.assertEqual(ASSET[start:end + 1], body, value)
+            self.assertEqual("bytes {}-{}/{}".format(start, end, len(ASSET)), response.getheader("Content-Range"))
+            self.assertEqual(str(end - start + 1), response.getheader("Content-Length"))
+
+    def test_range_not_satisfiable(self):
+        for value in ("bytes=1024-", "bytes=5000-6000", "bytes=-0"):
+            response, body = self._request_range(value)
+            self.assertEqual(416, response.status, value)
+            self.assertEqual("bytes */{}".format(len(ASSET)), response.getheader("Content-Range"))
+            self.assertEqual(b"", body)
+
+    def test_invalid_or_multiple_ranges_are_ignored(self):
+        for value in ("bytes=10-5", "items=0-9", "bytes=0-9,20-29", "bytes=a-b", "bytes=-"):
+            response, body = self._request_range(value)
+            self.assertEqual(200, response.status, value)
+            self.assertEqual(ASSET, body)
+
+    def test_if_range(self):
+        response, body = self._request_range("bytes=0-9", if_range=ASSET_ETAG)
+        self.assertEqual(206, response.status)
+        self.assertEqual(ASSET[:10], body)
+        # Weak entity tags never match, and different ones mean the client copy changed
+        for if_range in ('W/' + ASSET_ETAG, '"other"'):
+            response, body = self._request_range("bytes=0-9", if_range=if_range)
+            self.assertEqual(200, response.status, if_range)
+            self.assertEqual(ASSET, body)
+
+    def test_update(self):
+        response, _ = self.server.request("/update")
+        self.assertEqual(200, response.status)
+        self.assertEqual(1, self.repository.updates)
+        self.assertEqual(1, self.scheduler.wakes)
+
+    def test_head_update_is_not_allowed(self):
+        response, _ = self.server.request("/update", method="HEAD")
+        self.assertEqual(405, response.status)
+        self.assertEqual("GET", response.getheader("Allow"))
+        self.assertEqual(0, self.repository.updates)
+        self.assertEqual(0, self.scheduler.wakes)
+
+
+if __name__ == "__main__":
+    unittest.main()
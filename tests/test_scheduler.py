@@ -0,0 +1,55 @@
+import threading
+import time
+import unittest
+
+from lib.scheduler import RefreshScheduler
+
+
+class _Repository(object):
+    def __init__(self):
+        self.refreshes = 0
+        self.refreshed = threading.Condition()
+
+    def refresh_ahead(self, margin, jitter=0.0):
+        with self.refreshed:
+            self.refreshes += 1
+            self.refreshed.notify_all()
+        return 0
+
+    def wait_refreshes(self, count, timeout=5):
+        deadline = time.time() + timeout
+        with self.refreshed:
+            while self.refreshes < count and time.time() < deadline:
+                self.refreshed.wait(deadline - time.time())
+            return self.refreshes >= count
+
+
+class RefreshSchedulerTest(unittest.TestCase):
+    def test_warm_up_and_wake(self):
+        repository = _Repository()
+        with RefreshScheduler(repository, interval=60) as scheduler:
+            self.assertTrue(repository.wait_refreshes(1))
+            scheduler.wake()
+            self.assertTrue(repository.wait_refreshes(2))
+        self.assertFalse(scheduler.is_alive())
+        self.assertEqual(2, repository.refreshes)
+
+    def test_stop_does_not_wait_for_long_refreshes(self):
+        repository = _Repository()
+        refresh_done = threading.Event()
+        repository.refresh_ahead = lambda margin, jitter=0.0: refresh_done.wait(5)
+        scheduler = RefreshScheduler(repository, stop_timeout=0.1)
+        try:
+            started = time.time()
+            with scheduler:
+                pass
+            self.assertLess(time.time() - started, 2)
+            self.assertTrue(scheduler.is_alive())
+        finally:
+            refresh_done.set()
+        scheduler.join(5)
+        self.assertFalse(scheduler.is_alive())
+
+
+if __name__ == "__main__":
+    unittest.main()
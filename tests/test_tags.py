@@ -0,0 +1,88 @@
+import re
+import unittest
+
+from lib.tags import TagIndex, literal_prefix
+from lib.version import try_parse_version
+
+
+class _Ref(object):
+    def __init__(self, name):
+        self.ref = "refs/tags/" + name
+
+
+def _matches(name, version, tag_pattern=None):
+    # Same predicate as used when scanning the refs list for a version tag
+    if tag_pattern:
+        match = tag_pattern.match(name)
+        if not match:
+            return False
+        elif tag_pattern.groups:
+            name = match.group(tag_pattern.groupindex.get("version", 1))
+    parsed_version = try_parse_version(version)
+    return name == version or bool(parsed_version and parsed_version == try_parse_version(name))
+
+
+def _scan(names, predicate):
+    return next((name for name in reversed(names) if predicate(name)), None)
+
+
+TAGS = ["v0.9", "1.0.0", "v1.0", "plugin.a-1.0.0", "plugin.a-v1.1", "plugin.b-1.1.0", "v1.1.0", "1.1", "nightly",
+        "plugin.a-2.0.0-beta", "plugin.a-v2.0", "v2.0.0", "2.0"]
+PATTERNS = [None, re.compile(r"plugin\.a-(.+)"), re.compile(r"plugin\.a-v?(?P<version>[\d.]+)$"),
+            re.compile(r"v(.+)"), re.compile(r"\d"), re.compile(r"(?i)PLUGIN\.B-(.+)")]
+VERSIONS = ["1.0.0", "1.0", "v1.0", "1.1", "1.1.0", "2.0", "2.0.0-beta", "nightly", "3.0", "0.9.0"]
+
+
+class TagIndexTest(unittest.TestCase):
+    def test_find_same_as_scan(self):
+        index = TagIndex(_Ref(name) for name in TAGS)
+        for tag_pattern in PATTERNS:
+            for version in VERSIONS:
+                self.assertEqual(
+                    _scan(TAGS, lambda name: _matches(name, version, tag_pattern)),
+                    index.find(version, tag_pattern=tag_pattern), (version, tag_pattern))
+
+    def test_latest_same_as_scan(self):
+        index = TagIndex(_Ref(name) for name in TAGS)
+        for tag_pattern in PATTERNS:
+            self.assertEqual(
+                _scan(TAGS, tag_pattern.match if tag_pattern else lambda _: True), index.latest(tag_pattern),
+                tag_pattern)
+
+    def test_prefix_tags_are_enough(self):
+        # Only the tags starting with the literal prefix are fetched for a tag pattern
+        full_index = TagIndex(_Ref(name) for name in TAGS)
+        for tag_pattern in PATTERNS:
+            prefix = literal_prefix(tag_pattern)
+            index = TagIndex(_Ref(name) for name in TAGS if name.startswith(prefix))
+            self.assertEqual(full_index.latest(tag_pattern), index.latest(tag_pattern), tag_pattern)
+            for version in VERSIONS:
+                self.assertEqual(full_index.find(version, tag_pattern=tag_pattern),
+                                 index.find(version, tag_pattern=tag_pattern), (version, tag_pattern))
+
+    def test_empty(self):
+        index = TagIndex([])
+        self.assertEqual(0, len(index))
+        self.assertIsNone(index.latest())
+        self.assertIsNone(index.find("1.0"))
+
+    def test_contains(self):
+        index = TagIndex(_Ref(name) for name in TAGS)
+        self.assertEqual(len(TAGS), len(index))
+        self.assertIn("v1.0", index)
+        self.assertNotIn("refs/tags/v1.0", index)
+
+
+class LiteralPrefixTest(unittest.TestCase):
+    def test_literal_prefix(self):
+        for pattern, prefix in ((r"plugin\.a-(.+)", "plugin.a-"), (r"^v(\d+)", "v"), (r"v?(.+)", ""),
+                                (r"release-v[\d.]+", "release-v"), (r"(a|b)-(.+)", ""), (r"ab*c", "a"),
+                                (r"abc", "abc"), (r"(?i)abc", "")):
+            self.assertEqual(prefix, literal_prefix(re.compile(pattern)), pattern)
+
+    def test_no_pattern(self):
+        self.assertEqual("", literal_prefix(None))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import codecs
+import json
+import unittest
+from io import BytesIO
+from xml.etree import ElementTree  # nosec
+
+from lib.utils import iter_json_array, xml_fragment
+
+
+class IterJsonArrayTest(unittest.TestCase):
+    def _parse(self, text, chunk_size=16 * 1024):
+        return list(iter_json_array(BytesIO(text.encode("utf-8")), chunk_size=chunk_size))
+
+    def test_same_as_json_loads(self):
+        text = u' [ {"ref": "refs/tags/v1", "n": [1, 2.5]}, 10, "é", null , true, [] ] '
+        for chunk_size in (1, 2, 3, 7, 1024):
+            self.assertEqual(json.loads(text), self._parse(text, chunk_size=chunk_size))
+
+    def test_empty_array(self):
+        self.assertEqual([], self._parse("[]"))
+        self.assertEqual([], self._parse(" [ ] "))
+
+    def test_invalid_arrays(self):
+        for text in ("[1,]", "[,]", "[1 2]", "[1,", ""):
+            self.assertRaises(ValueError, json.loads, text)
+            self.assertRaises(ValueError, self._parse, text)
+        self.assertRaises(ValueError, self._parse, "{}")
+
+
+class XmlFragmentTest(unittest.TestCase):
+    def test_strips_declaration_and_comments(self):
+        data = b'<?xml version="1.0" encoding="UTF-8"?>\n<!-- comment -->\n<addon id="a"><b/></addon>\n'
+        self.assertEqual(b'<addon id="a"><b/></addon>', xml_fragment(data, root_tag="addon"))
+
+    def test_transcodes_declared_encoding(self):
+        data = u'<?xml version="1.0" encoding="ISO-8859-1"?><addon name="é"/>'.encode("iso-8859-1")
+        self.assertEqual(u'<addon name="é"/>'.encode("utf-8"), xml_fragment(data))
+
+    def test_utf8_bom(self):
+        data = codecs.BOM_UTF8 + u'<?xml version="1.0"?><addon name="é"/>'.encode("utf-8")
+        self.assertEqual(u'<addon name="é"/>'.encode("utf-8"), xml_fragment(data))
+
+    def test_utf16_bom(self):
+        data = u'<?xml version="1.0" encoding="UTF-16"?><addon name="é"/>'.encode("utf-16")
+        self.assertEqual(u'<addon name="é"/>'.encode("utf-8"), xml_fragment(data))
+
+    def test_expands_doctype_entities(self):
+        data = b'<!DOCTYPE addon [<!ENTITY x "y">]><addon>&x;</addon>'
+        fragment = xml_fragment(data, root_tag="addon")
+        self.assertEqual("y", ElementTree.fromstring(b"<addons>" + fragment + b"</addons>")[0].text)
+
+    def test_undefined_entity(self):
+        self.assertRaises(ValueError, xml_fragment, b'<!DOCTYPE addon SYSTEM "addon.dtd"><addon>&x;</addon>')
+
+    def test_invalid_documents(self):
+        self.assertRaises(ValueError, xml_fragment, b"<addon>")
+        self.assertRaises(ValueError, xml_fragment, b"<other/>", root_tag="addon")
@@ -0,0 +1,103 @@
+import io
+import struct
+import unittest
+import zipfile
+
+from lib.zipstream import ZipRerooter
+
+
+class _UnseekableWriter(io.RawIOBase):
+    """
+    Makes zipfile write entries with data descriptors, as when streaming.
+    """
+
+    def __init__(self):
+        super(_UnseekableWriter, self).__init__()
+        self.data = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        return self.data.write(b)
+
+    def seekable(self):
+        return False
+
+
+def _make_zip(files, compression, streamed=False):
+    fp = _UnseekableWriter() if streamed else io.BytesIO()
+    with zipfile.ZipFile(fp, "w", compression) as z:
+        for name, data in files:
+            z.writestr(name, data)
+    return fp.data.getvalue() if streamed else fp.getvalue()
+
+
+class ZipRerooterTest(unittest.TestCase):
+    files = [
+        ("user-repo-abc123/addon.xml", b"<addon/>"),
+        ("user-repo-abc123/resources/data.bin", b"PK\x07\x08" * 1000 + b"PK\x03\x04" * 1000),
+        ("user-repo-abc123/empty.txt", b""),
+    ]
+
+    def _assert_rerooted(self, data, chunk_size=64 * 1024, read_size=-1):
+        reader = ZipRerooter(io.BytesIO(data), "plugin.test", chunk_size=chunk_size)
+        if read_size < 0:
+            output = reader.read()
+        else:
+            output = b"".join(iter(lambda: reader.read(read_size), b""))
+        with zipfile.ZipFile(io.BytesIO(output)) as z:
+            self.assertIsNone(z.testzip())
+            self.assertEqual(
+                [(name.replace("user-repo-abc123", "plugin.test"), content) for name, content in self.files],
+                [(name, z.read(name)) for name in z.namelist()])
+
+    def test_stored(self):
+        self._assert_rerooted(_make_zip(self.files, zipfile.ZIP_STORED))
+
+    def test_deflated(self):
+        self._assert_rerooted(_make_zip(self.files, zipfile.ZIP_DEFLATED))
+
+    def test_deflated_with_data_descriptor(self):
+        self._assert_rerooted(_make_zip(self.files, zipfile.ZIP_DEFLATED, streamed=True), chunk_size=100)
+
+    def test_stored_with_data_descriptor(self):
+        data = _make_zip(self.files, zipfile.ZIP_STORED, streamed=True)
+        for chunk_size in (7, 100, 64 * 1024):
+            self._assert_rerooted(data, chunk_size=chunk_size, read_size=1000)
+
+    def test_stored_with_unsigned_data_descriptor(self):
+        data = _strip_descriptor_signatures(_make_zip(self.files, zipfile.ZIP_STORED, streamed=True))
+        self._assert_rerooted(data, chunk_size=50)
+
+
+def _strip_descriptor_signatures(data):
+    """
+    Remove the (optional) signature of every data descriptor, fixing the offsets in the central directory.
+    """
+    with zipfile.ZipFile(io.BytesIO(data)) as z:
+        infos = z.infolist()
+    output = io.BytesIO()
+    offsets = {}
+    end = 0
+    for info in infos:
+        offsets[info.header_offset] = output.tell()
+        data_end = info.header_offset + 30 + len(info.filename.encode("utf-8")) + len(info.extra) + info.compress_size
+        output.write(data[info.header_offset:data_end])
+        output.write(data[data_end + 4:data_end + 16])
+        end = data_end + 16
+
+    central_directory = bytearray(data[end:])
+    index = 0
+    while central_directory[index:index + 4] == b"PK\x01\x02":
+        name_length, extra_length, comment_length = struct.unpack_from("<HHH", central_directory, index + 28)
+        local_offset, = struct.unpack_from("<I", central_directory, index + 42)
+        struct.pack_into("<I", central_directory, index + 42, offsets[local_offset])
+        index += 46 + name_length + extra_length + comment_length
+    struct.pack_into("<I", central_directory, index + 16, output.tell())
+    output.write(bytes(central_directory))
+    return output.getvalue()
+
+
+if __name__ == "__main__":
+    unittest.main()